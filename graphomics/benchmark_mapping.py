@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import os
+import random
+import sys
+import time
+
+sys.path.append('.')
+
+configuration = os.getenv('ENVIRONMENT', 'development').title()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'graphomics.settings')
+os.environ.setdefault('DJANGO_CONFIGURATION', configuration)
+
+import configurations
+
+configurations.setup()
+
+from linker.constants import NA, GENE_PK, PROTEIN_PK, REACTION_PK
+from linker.views.relation import Relation
+
+
+def make_relation(n, source_prefix, target_prefix, source_pk, target_pk, linked=0.8):
+    """
+    Create a relation between n source ids and n target ids, where only a fraction of each side is linked
+    """
+    num_linked = int(n * linked)
+    sources = ['%s%d' % (source_prefix, random.randrange(num_linked)) for _ in range(n)]
+    targets = ['%s%d' % (target_prefix, random.randrange(num_linked)) for _ in range(n)]
+    source_ids = ['%s%d' % (source_prefix, i) for i in range(n)]
+    target_ids = ['%s%d' % (target_prefix, i) for i in range(n)]
+    return Relation(source_pk, target_pk, sources, targets), source_ids, target_ids
+
+
+def list_orphans(relation, source_ids, target_ids):
+    # the previous implementation: membership tests against the key and value lists
+    keys = relation.keys
+    values = relation.values
+    orphan_sources = [x for x in source_ids if x not in keys]
+    orphan_targets = [x for x in target_ids if x not in values]
+    return orphan_sources, orphan_targets
+
+
+def set_orphans(relation, source_ids, target_ids):
+    return relation.link_orphans(NA, source_ids=source_ids, target_ids=target_ids)
+
+
+def run(n, skip_list_above):
+    relations = [
+        make_relation(n, 'ENSG', 'P', GENE_PK, PROTEIN_PK),
+        make_relation(n, 'P', 'R-HSA-', PROTEIN_PK, REACTION_PK),
+    ]
+
+    start = time.time()
+    for relation, source_ids, target_ids in relations:
+        set_orphans(relation, source_ids, target_ids)
+    set_time = time.time() - start
+
+    if n > skip_list_above:
+        print('%8d entities: set-indexed %8.3fs, list-based (skipped)' % (n, set_time))
+        return
+
+    start = time.time()
+    for relation, source_ids, target_ids in relations:
+        list_orphans(relation, source_ids, target_ids)
+    list_time = time.time() - start
+    print('%8d entities: set-indexed %8.3fs, list-based %8.3fs, speedup %.0fx' %
+          (n, set_time, list_time, list_time / set_time))
+
+
+if __name__ == '__main__':
+    # the list-based implementation is quadratic, set the limit higher to also time it for the larger sizes
+    skip_list_above = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    random.seed(0)
+    for n in [10000, 50000, 100000]:
+        run(n, skip_list_above)
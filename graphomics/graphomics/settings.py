@@ -74,7 +74,7 @@ class Common(Configuration):
         'django_select2',
         'webpack_loader',
         'graphomics.users',
-        'linker',
+        'linker.apps.LinkerConfig',
         'registration'
     ]
 
@@ -5,6 +5,9 @@ from .models import *
 admin.site.register(Analysis)
 admin.site.register(AnalysisData)
 admin.site.register(AnalysisHistory)
+admin.site.register(AnalysisPayload)
 admin.site.register(AnalysisAnnotation)
 admin.site.register(AnalysisGroup)
-admin.site.register(Share)
\ No newline at end of file
+admin.site.register(Share)
+admin.site.register(MappingResult)
+admin.site.register(AnalysisJob)
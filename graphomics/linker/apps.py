@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class LinkerConfig(AppConfig):
     name = 'linker'
+
+    def ready(self):
+        # load the Reactome catalogue from its local file, so that forms and views don't have to query Neo4j
+        # for species and pathway lists. It's kept fresh in the background once it's used.
+        from linker.reactome_catalogue import warm_catalogue
+        warm_catalogue()
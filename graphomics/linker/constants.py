@@ -8,6 +8,11 @@ EXTERNAL_COMPOUND_NAMES = os.path.join(BASE_DIR, 'static', 'data', 'compound_nam
 EXTERNAL_KEGG_TO_CHEBI = os.path.join(BASE_DIR, 'static', 'data', 'kegg_to_chebi.p')
 EXTERNAL_GENE_NAMES = os.path.join(BASE_DIR, 'static', 'data', 'gene_names.p')
 EXTERNAL_GO_DATA = os.path.join(BASE_DIR, 'static', 'data', 'go_data.p')
+EXTERNAL_REFERENCE_DATA = os.path.join(BASE_DIR, 'static', 'data', 'reference_data.sqlite')
+EXTERNAL_REACTOME_SNAPSHOT_DIR = os.path.join(BASE_DIR, 'static', 'data', 'reactome_snapshot')
+EXTERNAL_REACTOME_INDEX = os.path.join(BASE_DIR, 'static', 'data', 'reactome_index.sqlite')
+EXTERNAL_REACTOME_CACHE_DIR = os.path.join(BASE_DIR, 'static', 'data', 'reactome_cache')
+EXTERNAL_REACTOME_CATALOGUE = os.path.join(BASE_DIR, 'static', 'data', 'reactome_catalogue.json')
 
 # list of default species for Add Pathways when creating new data integration analysis
 # now unused since Add Pathways will be removed
@@ -180,6 +185,41 @@ InferenceTypeChoices = (
 )
 SELECT_WIDGET_ATTRS = {'style': 'width: 400px'}
 
+# Constants used by the analysis creation and extension jobs
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_COMPLETED = 'completed'
+JOB_FAILED = 'failed'
+JOB_CANCELLED = 'cancelled'
+
+JobStatusChoices = (
+    (JOB_PENDING, 'Pending'),
+    (JOB_RUNNING, 'Running'),
+    (JOB_COMPLETED, 'Completed'),
+    (JOB_FAILED, 'Failed'),
+    (JOB_CANCELLED, 'Cancelled'),
+)
+
+JOB_TYPE_CREATE = 'create'
+JOB_TYPE_EXTEND = 'extend'
+
+JobTypeChoices = (
+    (JOB_TYPE_CREATE, 'Create analysis'),
+    (JOB_TYPE_EXTEND, 'Extend analysis'),
+)
+
+JOB_STAGE_PARSE = 'parse'
+JOB_STAGE_MAP = 'map'
+JOB_STAGE_PERSIST = 'persist'
+JOB_STAGE_CLUSTER = 'cluster'
+
+JobStageChoices = (
+    (JOB_STAGE_PARSE, 'Reading data'),
+    (JOB_STAGE_MAP, 'Mapping to Reactome'),
+    (JOB_STAGE_PERSIST, 'Saving analysis'),
+    (JOB_STAGE_CLUSTER, 'Clustering data'),
+)
+
 T_TEST_THRESHOLD = 0.05
 
 # Pimp data import constants
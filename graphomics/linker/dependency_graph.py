@@ -0,0 +1,74 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from loguru import logger
+
+from linker.instrumentation import timed, get_context, run_in_context
+
+# number of threads used to run independent stages, set to 1 to run everything sequentially
+MAX_WORKERS = int(os.getenv('MAPPING_WORKERS', 4))
+
+
+class Stage(object):
+    def __init__(self, name, func, depends_on=None):
+        """
+        A unit of work in a dependency graph
+        :param name: the name of this stage, used as the key of its result
+        :param func: a callable taking the results of the stages in depends_on as keyword arguments
+        :param depends_on: the names of the stages that must finish before this one
+        """
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on) if depends_on is not None else []
+
+    def run(self, results):
+        kwargs = {name: results[name] for name in self.depends_on}
+        with timed(self.name):
+            return self.func(**kwargs)
+
+
+def run_stages(stages, max_workers=MAX_WORKERS):
+    """
+    Run stages as soon as all their dependencies are done, so independent stages run concurrently
+    :param stages: a list of Stage objects
+    :param max_workers: the number of threads to use
+    :return: a dictionary of stage name to the result of that stage
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for name in stage.depends_on:
+            if name not in by_name:
+                raise ValueError('Stage %s depends on an unknown stage %s' % (stage.name, name))
+
+    results = {}
+    if max_workers <= 1:
+        pending = list(stages)
+        while len(pending) > 0:
+            ready = [stage for stage in pending if all(name in results for name in stage.depends_on)]
+            if len(ready) == 0:
+                raise ValueError('Cyclic dependencies between stages %s' % [stage.name for stage in pending])
+            for stage in ready:
+                results[stage.name] = stage.run(results)
+                pending.remove(stage)
+        return results
+
+    # stages running in the pool are timed as part of the stages of the calling thread
+    context = get_context()
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            ready = [stage for stage in pending if all(name in results for name in stage.depends_on)]
+            for stage in ready:
+                logger.debug('Starting stage %s' % stage.name)
+                running[executor.submit(run_in_context, context, stage.run, results)] = stage
+                pending.remove(stage)
+
+            if len(running) == 0:
+                raise ValueError('Cyclic dependencies between stages %s' % [stage.name for stage in pending])
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                results[stage.name] = future.result()  # re-raises any exception from the stage
+    return results
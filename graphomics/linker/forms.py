@@ -4,9 +4,9 @@ from django import forms
 from django_select2.forms import Select2Widget, Select2MultipleWidget
 
 from linker.constants import AddNewDataChoices, InferenceTypeChoices, CompoundDatabaseChoices, \
-    MetabolicPathwayOnlyChoices, SELECT_WIDGET_ATTRS, DEFAULT_SPECIES, ShareReadOnlyChoices, MofaResultsChoices
+    MetabolicPathwayOnlyChoices, SELECT_WIDGET_ATTRS, ShareReadOnlyChoices, MofaResultsChoices
 from linker.models import AnalysisUpload
-from linker.reactome import get_species_dict, get_all_pathways
+from linker.reactome_catalogue import get_species_dict
 
 
 def load_example_data(file_path):
@@ -24,21 +24,18 @@ example_genes = ""
 example_proteins = load_example_data('../static/data/uploads/protein_data_example.csv')
 example_compounds = load_example_data('../static/data/uploads/compound_data_example.csv')
 
-SPECIES_CHOICES = []
-initial = None
-for k, v in get_species_dict().items():
-    SPECIES_CHOICES.append((k, v,))
-    if v == 'Homo sapiens':
-        initial = (k, v,)
+# the species are read from the Reactome catalogue when a form is created, not when this module is imported
 
-default_pathways = get_all_pathways(DEFAULT_SPECIES)
-pathway_species_dict = {}
-PATHWAY_CHOICES = []
-for i, item in enumerate(default_pathways):
-    pathway_species, pathway_name, pathway_id = item
-    value = '%s (%s)' % (pathway_name, pathway_species)
-    PATHWAY_CHOICES.append((pathway_id, value))
-    pathway_species_dict[pathway_id] = pathway_species
+
+def get_species_choices():
+    return list(get_species_dict().items())
+
+
+def get_initial_species():
+    for k, v in get_species_dict().items():
+        if v == 'Homo sapiens':
+            return k
+    return None
 
 
 class CreateAnalysisForm(forms.Form):
@@ -48,7 +45,7 @@ class CreateAnalysisForm(forms.Form):
                                   help_text='<div style="color: gray"><small>Publication title, if any</small></div>')
     publication_link = forms.CharField(required=False, widget=forms.TextInput(attrs={'style': 'width: 100%'}),
                                        help_text='<div style="color: gray"><small>Link to publication, if any</small></div>')
-    species = forms.MultipleChoiceField(required=True, choices=SPECIES_CHOICES, initial=initial[0],
+    species = forms.MultipleChoiceField(required=True, choices=get_species_choices, initial=get_initial_species,
                                         widget=Select2MultipleWidget)
     genes = forms.CharField(required=False,
                             widget=forms.Textarea(attrs={'rows': 6, 'cols': 100, 'style': 'width: 100%'}),
@@ -77,7 +74,7 @@ class UploadAnalysisForm(forms.ModelForm):
                                   help_text='<div style="color: gray"><small>Publication title, if any</small></div>')
     publication_link = forms.CharField(required=False, widget=forms.TextInput(attrs={'style': 'width: 100%'}),
                                        help_text='<div style="color: gray"><small>Link to publication, if any</small></div>')
-    species = forms.MultipleChoiceField(required=True, choices=SPECIES_CHOICES, widget=Select2MultipleWidget)
+    species = forms.MultipleChoiceField(required=True, choices=get_species_choices, widget=Select2MultipleWidget)
     metabolic_pathway_only = forms.ChoiceField(required=True, choices=MetabolicPathwayOnlyChoices,
                                                widget=Select2Widget,
                                                label='Limit to',
@@ -104,6 +101,16 @@ class UploadAnalysisForm(forms.ModelForm):
         }
 
 
+class ExtendAnalysisForm(forms.Form):
+    genes = forms.CharField(required=False,
+                            widget=forms.Textarea(attrs={'rows': 6, 'cols': 100, 'style': 'width: 100%'}),
+                            label='Genes/Transcripts')
+    proteins = forms.CharField(required=False,
+                               widget=forms.Textarea(attrs={'rows': 6, 'cols': 100, 'style': 'width: 100%'}))
+    compounds = forms.CharField(required=False,
+                                widget=forms.Textarea(attrs={'rows': 6, 'cols': 100, 'style': 'width: 100%'}))
+
+
 class BaseInferenceForm(forms.Form):
     data_type = forms.ChoiceField(required=True, choices=AddNewDataChoices,
                                   widget=Select2Widget(attrs=SELECT_WIDGET_ATTRS))
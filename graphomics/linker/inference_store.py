@@ -0,0 +1,134 @@
+import os
+import uuid
+from io import StringIO
+
+import jsonpickle
+import numpy as np
+import pandas as pd
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from loguru import logger
+
+try:
+    import pyarrow as pa
+except ImportError:  # inference results are kept in AnalysisHistory.inference_data
+    pa = None
+
+# the key in inference_data of the artifacts of an analysis history, a dictionary of names to files in media storage
+ARTIFACTS = 'artifacts'
+
+# the schema metadata that marks an artifact as a numpy array, and its number of dimensions
+NDARRAY_KEY = b'graphomics.ndarray'
+
+
+def use_inference_store():
+    return pa is not None and os.getenv('INFERENCE_STORE', 'true').lower() not in ['false', '0', 'no']
+
+
+################################################################################
+### Writing artifacts                                                        ###
+################################################################################
+
+
+def store_artifacts(analysis, inference_data):
+    """
+    Replace the dataframes and numpy arrays in inference_data with artifacts, Arrow files in the media folder of
+    analysis. Values that can't be stored as Arrow, or all of them if the store is disabled, are encoded as they
+    were before: dataframes with to_json() and arrays with jsonpickle.
+    :return: inference_data, ready to be saved in an AnalysisHistory
+    """
+    artifacts = dict(inference_data.get(ARTIFACTS, {}))
+    for key, value in list(inference_data.items()):
+        if not isinstance(value, (pd.DataFrame, np.ndarray)):
+            continue
+
+        if use_inference_store():
+            try:
+                artifacts[key] = write_artifact(analysis, key, value)
+                del inference_data[key]
+                continue
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, ValueError) as e:
+                logger.warning('Storing %s as JSON: %s' % (key, e))
+
+        if isinstance(value, pd.DataFrame):
+            inference_data[key] = value.to_json()
+        else:
+            inference_data[key] = jsonpickle.dumps(value)
+
+    if len(artifacts) > 0:
+        inference_data[ARTIFACTS] = artifacts
+    return inference_data
+
+
+def write_artifact(analysis, key, value):
+    """
+    Write a dataframe or a numpy array as an uncompressed Arrow file, so it can be memory-mapped when read
+    :return: the name of the file in the media storage
+    """
+    if isinstance(value, pd.DataFrame):
+        table = pa.Table.from_pandas(value)  # the index and dtypes are restored from the pandas metadata
+    else:
+        df = pd.DataFrame(value if value.ndim == 2 else value[:, np.newaxis])
+        df.columns = [str(col) for col in df.columns]
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[NDARRAY_KEY] = str(value.ndim).encode()
+        table = table.replace_schema_metadata(metadata)
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    filename = os.path.join('analysis_upload_%d' % analysis.pk, 'inference', '%s_%s.arrow' % (key, uuid.uuid4().hex))
+    name = default_storage.save(filename, ContentFile(sink.getvalue().to_pybytes()))
+    logger.debug('Stored %s in %s' % (key, name))
+    return name
+
+
+def delete_artifacts(inference_data):
+    if not isinstance(inference_data, dict):
+        return
+    for name in inference_data.get(ARTIFACTS, {}).values():
+        if default_storage.exists(name):
+            default_storage.delete(name)
+
+
+################################################################################
+### Reading artifacts                                                        ###
+################################################################################
+
+
+def read_artifact(name):
+    """
+    Read an artifact written by write_artifact() from a memory map, there's nothing to parse
+    :return: a dataframe or a numpy array
+    """
+    source = pa.memory_map(default_storage.path(name), 'r')
+    table = pa.ipc.open_file(source).read_all()
+    ndim = (table.schema.metadata or {}).get(NDARRAY_KEY)
+    if ndim is None:
+        return table.to_pandas()
+
+    values = table.to_pandas().to_numpy()
+    return values[:, 0] if int(ndim) == 1 else values
+
+
+def load_dataframe(inference_data, key):
+    """
+    Returns the dataframe stored under key, e.g. 'result_df', from its artifact or from the JSON string of
+    an analysis history saved before the inference store
+    """
+    name = inference_data.get(ARTIFACTS, {}).get(key)
+    if name is not None:
+        return read_artifact(name)
+    return pd.read_json(StringIO(inference_data[key]))
+
+
+def load_array(inference_data, key):
+    """
+    Returns the numpy array stored under key, from its artifact or from the jsonpickle string of an analysis history
+    saved before the inference store
+    """
+    name = inference_data.get(ARTIFACTS, {}).get(key)
+    if name is not None:
+        return read_artifact(name)
+    return jsonpickle.loads(inference_data[key])
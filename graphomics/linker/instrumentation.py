@@ -0,0 +1,161 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from django.utils import timezone
+from loguru import logger
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_local = threading.local()
+_lock = threading.Lock()
+
+
+class Timings(object):
+    """
+    The timings of the stages of one analysis creation. Each stage records its wall time, the time spent in Neo4j
+    queries, the resident set size of the process when it started and finished, and the number of rows it produced,
+    if set. The sizes are of the whole process, so stages running at the same time in other threads are included.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.start = time.time()
+        self.timestamp = timezone.localtime().isoformat()
+
+    def add(self, record):
+        with _lock:
+            self.stages.append(record)
+
+    def to_dict(self):
+        with _lock:
+            stages = sorted(self.stages, key=lambda record: record['start'])
+        return {
+            'timestamp': self.timestamp,
+            'elapsed': time.time() - self.start,
+            # the high-water mark of the process since it started, which may be from an earlier analysis
+            'process_peak_rss': get_peak_rss(),
+            'stages': stages
+        }
+
+
+def save_timings(analysis, timings):
+    """
+    Store the timings of creating an analysis in its metadata, under 'timings'
+    """
+    results = timings.to_dict()
+    for record in results['stages']:
+        logger.info('%s took %.3fs (%d neo4j queries in %.3fs), %s rows' % (
+            record['name'], record['elapsed'], record['neo4j_queries'], record['neo4j_time'], record.get('rows')))
+    metadata = analysis.metadata if analysis.metadata is not None else {}
+    metadata['timings'] = results
+    analysis.metadata = metadata
+    analysis.save(update_fields=['metadata'])
+
+
+def get_current_rss():
+    """
+    Returns the current resident set size of this process in bytes, or None if it can't be determined
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):  # not on Linux
+        return None
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of this process in bytes since it started, or None if it can't be determined
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@contextmanager
+def collect_timings():
+    """
+    Collect the timings of all the stages run by this thread, and by the threads it starts with run_in_context()
+    """
+    previous = get_context()
+    timings = Timings()
+    set_context((timings, []))
+    try:
+        yield timings
+    finally:
+        set_context(previous)
+
+
+@contextmanager
+def timed(name):
+    """
+    Time a stage. The stage can set record['rows'] on the yielded record. Nothing is recorded when timings aren't
+    being collected.
+    """
+    timings, stack = get_context()
+    if timings is None:
+        yield {}
+        return
+
+    record = {
+        'name': name,
+        'parent': stack[-1]['name'] if len(stack) > 0 else None,
+        'start': time.time() - timings.start,
+        'neo4j_time': 0.0,
+        'neo4j_queries': 0,
+        'rss_start': get_current_rss()
+    }
+    set_context((timings, stack + [record]))
+    start = time.time()
+    try:
+        yield record
+    finally:
+        set_context((timings, stack))
+        record['elapsed'] = time.time() - start
+        record['rss_end'] = get_current_rss()
+        if record['rss_start'] is not None and record['rss_end'] is not None:
+            record['rss_delta'] = record['rss_end'] - record['rss_start']
+        else:
+            record['rss_delta'] = None
+        timings.add(record)
+
+
+def record_query(elapsed):
+    """
+    Add the time of a Neo4j query to all the stages that are running in this thread
+    """
+    timings, stack = get_context()
+    if timings is None:
+        return
+    with _lock:
+        for record in stack:
+            record['neo4j_time'] += elapsed
+            record['neo4j_queries'] += 1
+
+
+def get_context():
+    return getattr(_local, 'timings', None), getattr(_local, 'stack', [])
+
+
+def set_context(context):
+    _local.timings, _local.stack = context
+
+
+def run_in_context(context, func, *args, **kwargs):
+    """
+    Run func in another thread as part of the stages in context, from get_context() in the calling thread
+    """
+    previous = get_context()
+    set_context(context)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        set_context(previous)
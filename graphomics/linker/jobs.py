@@ -0,0 +1,282 @@
+import os
+import socket
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+from loguru import logger
+
+from linker.constants import JOB_PENDING, JOB_RUNNING, JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED, JobStageChoices, \
+    JOB_TYPE_CREATE
+from linker.instrumentation import timed
+from linker.models import AnalysisJob
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def use_jobs():
+    return os.getenv('ANALYSIS_JOBS', 'true').lower() not in ['false', '0', 'no']
+
+
+def get_poll_interval():
+    return float(os.getenv('ANALYSIS_JOB_POLL_INTERVAL', 2.0))
+
+
+def get_heartbeat_interval():
+    return float(os.getenv('ANALYSIS_JOB_HEARTBEAT', 30.0))
+
+
+def get_stale_timeout():
+    return float(os.getenv('ANALYSIS_JOB_STALE_TIMEOUT', 300.0))
+
+
+def get_worker_name():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+################################################################################
+### Submitting and cancelling jobs                                           ###
+################################################################################
+
+
+def submit_job(user, parameters, files=None, job_type=JOB_TYPE_CREATE, analysis=None):
+    """
+    Queue a new analysis creation or extension job
+    :param user: the user creating the analysis
+    :param parameters: the JSON-serialisable parameters of the job
+    :param files: a dictionary of uploaded files, these are stored until a worker picks up the job
+    :param job_type: JOB_TYPE_CREATE or JOB_TYPE_EXTEND
+    :param analysis: the analysis to extend
+    :return: the job
+    """
+    job = AnalysisJob.objects.create(user=user, parameters=parameters, job_type=job_type, analysis=analysis)
+    if files is not None:
+        stored_files = {}
+        for key, uploaded_file in files.items():
+            if uploaded_file:
+                filename = os.path.join('analysis_job_%d' % job.pk, uploaded_file.name)
+                stored_files[key] = default_storage.save(filename, uploaded_file)
+        job.parameters['files'] = stored_files
+        job.save(update_fields=['parameters'])
+    logger.info('Submitted job %d' % job.pk)
+    return job
+
+
+def cancel_job(job):
+    """
+    Cancel a job. Pending jobs are cancelled immediately, running jobs are stopped before their next stage.
+    """
+    now = timezone.localtime()
+    if AnalysisJob.objects.filter(pk=job.pk, status=JOB_PENDING).update(
+            status=JOB_CANCELLED, cancel_requested=True, finished=now) > 0:
+        logger.info('Cancelled job %d' % job.pk)
+    elif AnalysisJob.objects.filter(pk=job.pk, status=JOB_RUNNING).update(cancel_requested=True) > 0:
+        logger.info('Requested cancellation of job %d' % job.pk)
+    job.refresh_from_db()
+
+
+def get_job_status(job):
+    """
+    Returns the status of a job and its stages, for the status endpoint
+    """
+    stages = []
+    for stage, label in JobStageChoices:
+        progress = job.progress.get(stage)
+        if progress is None:
+            stage_status = JOB_PENDING
+        elif 'elapsed' in progress:
+            stage_status = JOB_COMPLETED
+        else:
+            stage_status = job.status if job.is_finished() else JOB_RUNNING
+        stages.append({
+            'name': stage,
+            'label': label,
+            'status': stage_status,
+            'elapsed': progress.get('elapsed') if progress is not None else None
+        })
+    return {
+        'id': job.pk,
+        'job_type': job.job_type,
+        'status': job.status,
+        'stage': job.stage,
+        'stages': stages,
+        'cancel_requested': job.cancel_requested,
+        'error': job.error,
+        'analysis_id': job.analysis_id if job.status == JOB_COMPLETED else None
+    }
+
+
+################################################################################
+### Running jobs                                                             ###
+################################################################################
+
+
+def check_cancelled(job):
+    if AnalysisJob.objects.filter(pk=job.pk, cancel_requested=True).exists():
+        raise JobCancelled()
+
+
+@contextmanager
+def job_stage(job, stage):
+    """
+    Record the progress of a stage of a job, and time it. Cancellation is checked before the stage starts.
+    :return: the timing record of the stage, see linker.instrumentation.timed()
+    """
+    check_cancelled(job)
+    logger.info('Job %d: %s' % (job.pk, stage))
+    job.stage = stage
+    job.progress[stage] = {'started': timezone.localtime().isoformat()}
+    job.save(update_fields=['stage', 'progress'])
+
+    start = time.time()
+    with timed(stage) as record:
+        yield record
+    job.progress[stage]['elapsed'] = time.time() - start
+    job.save(update_fields=['progress'])
+
+
+def claim_job(worker_name):
+    """
+    Take the oldest pending job. The status is changed with a conditional update, so that each job is only claimed
+    by one worker.
+    :return: the job, or None if there are no pending jobs
+    """
+    pending = AnalysisJob.objects.filter(status=JOB_PENDING, cancel_requested=False).order_by('timestamp')
+    for job_id in pending.values_list('pk', flat=True)[:10]:
+        now = timezone.localtime()
+        if AnalysisJob.objects.filter(pk=job_id, status=JOB_PENDING, cancel_requested=False).update(
+                status=JOB_RUNNING, worker=worker_name, started=now, heartbeat=now) > 0:
+            return AnalysisJob.objects.get(pk=job_id)
+    return None
+
+
+def send_heartbeats(job_id, stop):
+    """
+    Record that a job is still running every few seconds, until stop is set. Runs in its own thread, see run_job().
+    A failed heartbeat, e.g. when the database is briefly unavailable, is retried on the next one.
+    """
+    try:
+        while not stop.wait(get_heartbeat_interval()):
+            try:
+                AnalysisJob.objects.filter(pk=job_id, status=JOB_RUNNING).update(heartbeat=timezone.localtime())
+            except Exception as e:
+                logger.warning('Failed to record the heartbeat of job %d: %s' % (job_id, str(e)))
+                connection.close()  # reconnect on the next heartbeat
+    finally:
+        connection.close()
+
+
+def clean_up_job(job):
+    """
+    Remove what a job that didn't complete leaves behind: the partial analysis of a creation job and the uploaded files
+    """
+    if job.analysis is not None and job.job_type == JOB_TYPE_CREATE:
+        job.analysis.delete()
+        job.analysis = None
+    for filename in job.parameters.get('files', {}).values():
+        default_storage.delete(filename)
+
+
+def fail_stale_jobs():
+    """
+    Mark the running jobs whose worker has stopped recording heartbeats, e.g. because it was killed, as failed, or as
+    cancelled if that was requested, and clean them up
+    :return: the number of jobs marked
+    """
+    cutoff = timezone.localtime() - timedelta(seconds=get_stale_timeout())
+    stale = AnalysisJob.objects.filter(status=JOB_RUNNING).filter(
+        Q(heartbeat__lt=cutoff) | Q(heartbeat__isnull=True, started__lt=cutoff))
+    count = 0
+    for job in stale:
+        status = JOB_CANCELLED if job.cancel_requested else JOB_FAILED
+        error = None if job.cancel_requested else 'The worker %s stopped while running the job' % job.worker
+        # the conditional update makes sure that only one worker cleans up each job
+        if AnalysisJob.objects.filter(pk=job.pk, status=JOB_RUNNING, heartbeat=job.heartbeat).update(
+                status=status, error=error, finished=timezone.localtime()) == 0:
+            continue
+        logger.warning('Job %d on %s stopped sending heartbeats, marked as %s' % (job.pk, job.worker, status))
+        clean_up_job(job)
+        AnalysisJob.objects.filter(pk=job.pk).update(analysis=job.analysis)
+        count += 1
+    return count
+
+
+def run_job(job, runner):
+    """
+    Run a claimed job
+    :param runner: the function that does the work, called with the job. It sets job.analysis once the analysis
+    has been created, so that it can be removed if the job fails or is cancelled. The analysis of an extension job
+    is kept.
+    """
+    logger.info('Running job %d on %s' % (job.pk, job.worker))
+    stop = threading.Event()
+    heartbeat_thread = threading.Thread(target=send_heartbeats, args=(job.pk, stop), name='job-heartbeat',
+                                        daemon=True)
+    heartbeat_thread.start()
+    try:
+        runner(job)
+        job.status = JOB_COMPLETED
+    except JobCancelled:
+        logger.info('Job %d cancelled' % job.pk)
+        job.status = JOB_CANCELLED
+    except Exception as e:
+        logger.error('Job %d failed\n%s' % (job.pk, traceback.format_exc()))
+        job.status = JOB_FAILED
+        job.error = str(e)
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+
+    if job.status != JOB_COMPLETED:
+        clean_up_job(job)
+    job.finished = timezone.localtime()
+    # the job may have been marked as failed by fail_stale_jobs() in the meantime, which then also cleaned it up
+    if AnalysisJob.objects.filter(pk=job.pk, status=JOB_RUNNING).update(
+            status=job.status, error=job.error, analysis=job.analysis, finished=job.finished) == 0:
+        logger.warning('Job %d was stopped by another worker while it was running' % job.pk)
+        job.refresh_from_db()
+    return job
+
+
+def run_pending_job(job, runner):
+    """
+    Claim and run a specific pending job in this process, e.g. when there are no background workers
+    """
+    now = timezone.localtime()
+    if AnalysisJob.objects.filter(pk=job.pk, status=JOB_PENDING, cancel_requested=False).update(
+            status=JOB_RUNNING, worker=get_worker_name(), started=now, heartbeat=now) > 0:
+        job.refresh_from_db()
+        run_job(job, runner)
+
+
+def run_worker(runners, worker_name=None, once=False):
+    """
+    Process jobs until stopped
+    :param runners: a dictionary of job type to the function that does the work of the jobs of that type,
+    see run_job()
+    :param once: stop when there are no more pending jobs
+    """
+    worker_name = get_worker_name() if worker_name is None else worker_name
+    logger.info('Worker %s started' % worker_name)
+    last_check = 0
+    while True:
+        close_old_connections()
+        # the jobs of workers that died are failed when a worker starts, then every stale timeout
+        if time.time() - last_check > get_stale_timeout():
+            fail_stale_jobs()
+            last_check = time.time()
+        job = claim_job(worker_name)
+        if job is not None:
+            run_job(job, runners[job.job_type])
+        elif once:
+            break
+        else:
+            time.sleep(get_poll_interval())
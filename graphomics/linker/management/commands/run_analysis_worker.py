@@ -0,0 +1,37 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from linker.constants import JOB_TYPE_CREATE, JOB_TYPE_EXTEND
+from linker.jobs import run_worker
+
+
+def start_worker(once):
+    # imported here so that the views are only loaded in the worker processes
+    from linker.views.create_analysis_view import run_analysis_job
+    from linker.views.settings_view import run_extend_job
+    run_worker({JOB_TYPE_CREATE: run_analysis_job, JOB_TYPE_EXTEND: run_extend_job}, once=once)
+
+
+class Command(BaseCommand):
+    help = 'Run the analysis jobs submitted from the create and upload analysis pages and the settings page'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1, help='number of worker processes (default: 1)')
+        parser.add_argument('--once', action='store_true', help='stop when there are no more pending jobs')
+
+    def handle(self, *args, **options):
+        num_processes = options['processes']
+        once = options['once']
+        if num_processes <= 1:
+            start_worker(once)
+            return
+
+        # the database connections can't be shared with the forked processes
+        connections.close_all()
+        processes = [multiprocessing.Process(target=start_worker, args=(once,)) for _ in range(num_processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from loguru import logger
+
+from linker.models import AnalysisData
+from linker.table_store import use_table_store
+
+
+class Command(BaseCommand):
+    help = 'Move the tables of existing analyses from the database to Parquet files in the analysis media folders'
+
+    def handle(self, *args, **options):
+        if not use_table_store():
+            logger.warning('The table store is disabled or pyarrow is not installed')
+            return
+
+        # load them one at a time, the tables can be large
+        pks = list(AnalysisData.objects.filter(Q(table_file='') | Q(table_file__isnull=True)).values_list(
+            'pk', flat=True))
+        for pk in pks:
+            analysis_data = AnalysisData.objects.get(pk=pk)
+            analysis_data.save()  # moves json_data to the table file
+        logger.info('Stored the tables of %d analysis data' % len(pks))
@@ -0,0 +1,72 @@
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from loguru import logger
+
+from linker.models import MappingResult
+from linker.reactome_cache import get_cached_version
+from linker.reference_data import get_reference_path
+
+
+def reuse_mapping():
+    return os.getenv('MAPPING_REUSE', 'true').lower() not in ['false', '0', 'no']
+
+
+def get_reference_version():
+    """
+    Returns the version of the reference data used for mapping: the Reactome version and the modification times of
+    the reference data store and the gene names, compound names and kegg to chebi files
+    :return: the version, or None if the Reactome version can't be determined
+    """
+    reactome_version = get_cached_version()
+    if reactome_version is None:
+        return None
+
+    tokens = [reactome_version]
+    for filename in [get_reference_path(), settings.EXTERNAL_GENE_NAMES, settings.EXTERNAL_COMPOUND_NAMES,
+                     settings.EXTERNAL_KEGG_TO_CHEBI]:
+        try:
+            tokens.append('%d' % os.path.getmtime(filename))
+        except OSError:
+            tokens.append('-')
+    return '|'.join(tokens)
+
+
+def get_mapping_key(gene_ids, protein_ids, compound_ids, compound_database_str, species_list,
+                    metabolic_pathway_only, reference_version):
+    """
+    Hash the normalised inputs of the Reactome mapping. Analyses with the same key have the same mapping results,
+    and only differ in their measurements.
+    :return: the key, a sha1 hex digest
+    """
+    key_data = {
+        'genes': sorted(set(gene_ids)),
+        'proteins': sorted(set(protein_ids)),
+        'compounds': sorted(set(compound_ids)),
+        'compound_database': compound_database_str,
+        'species': sorted(set(species_list)),
+        'metabolic_pathway_only': bool(metabolic_pathway_only),
+        'reference_version': reference_version
+    }
+    return hashlib.sha1(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_mapping_result(key):
+    try:
+        mapping_result = MappingResult.objects.get(key=key)
+    except MappingResult.DoesNotExist:
+        return None
+    logger.info('Reusing mapping result %s' % key)
+    return mapping_result.result
+
+
+def save_mapping_result(key, reference_version, result):
+    # results mapped with older reference data can't be reused anymore
+    MappingResult.objects.exclude(reference_version=reference_version).delete()
+    MappingResult.objects.get_or_create(key=key, defaults={
+        'reference_version': reference_version,
+        'result': result
+    })
+    logger.info('Saved mapping result %s' % key)
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.22 on 2026-10-18 09:12
+
+from django.db import migrations, models
+import django.utils.timezone
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('linker', '0047_auto_20210926_1210'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MappingResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True)),
+                ('reference_version', models.CharField(max_length=100)),
+                ('result', jsonfield.fields.JSONField()),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.localtime)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.2.22 on 2026-10-18 07:12
+
+from django.db import migrations, models
+import linker.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('linker', '0049_analysisjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisdata',
+            name='table_file',
+            field=models.FileField(blank=True, null=True, upload_to=linker.models.get_table_folder),
+        ),
+    ]
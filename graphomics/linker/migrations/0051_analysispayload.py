@@ -0,0 +1,25 @@
+# Generated by Django 2.2.22 on 2026-10-18 07:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('linker', '0050_analysisdata_table_file'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisPayload',
+            fields=[
+                ('analysis_data', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='linker.AnalysisData')),
+                ('history_ids', jsonfield.fields.JSONField(default=list)),
+                ('payload', models.TextField()),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.localtime)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.22 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('linker', '0051_analysispayload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='job_type',
+            field=models.CharField(choices=[('create', 'Create analysis'), ('extend', 'Extend analysis')], default='create', max_length=20),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.22 on 2026-10-18 07:35
+
+from django.db import migrations, models
+import linker.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('linker', '0053_analysisjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='analysispayload',
+            name='payload',
+        ),
+        migrations.AddField(
+            model_name='analysispayload',
+            name='payload_file',
+            field=models.FileField(blank=True, null=True, upload_to=linker.models.get_payload_folder),
+        ),
+    ]
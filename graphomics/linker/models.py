@@ -2,14 +2,19 @@ import os
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from jsonfield import JSONField
 from django.core.files import File
 
 User = get_user_model()
 
-from linker.constants import DataType, DataRelationType, InferenceTypeChoices
+from linker.constants import DataType, DataRelationType, InferenceTypeChoices, JobStatusChoices, JOB_PENDING, \
+    JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED, JobTypeChoices, JOB_TYPE_CREATE
+from linker.inference_store import delete_artifacts
+from linker.table_store import store_table, delete_table_file
 
 class Analysis(models.Model):
     name = models.CharField(max_length=100, null=True)
@@ -189,17 +194,31 @@ class AnalysisUpload(models.Model):
     metadata = models.FileField(blank=True, null=True, upload_to=get_upload_folder)
 
 
+def get_table_folder(instance, filename):
+    upload_folder = "analysis_upload_%s" % instance.analysis.pk
+    return os.path.join(upload_folder, 'tables', filename)
+
+
 class AnalysisData(models.Model):
     analysis = models.ForeignKey(Analysis, on_delete=models.CASCADE)
     data_type = models.IntegerField(choices=DataRelationType)
+    # the rows of the table, None once they have been moved to table_file, see linker.table_store
     json_data = JSONField()
     json_design = JSONField()
     metadata = JSONField(blank=True, null=True)
     timestamp = models.DateTimeField(default=timezone.localtime, null=False)
+    table_file = models.FileField(blank=True, null=True, upload_to=get_table_folder)
 
     class Meta:
         verbose_name_plural = "Analysis Data"
 
+    def save(self, *args, **kwargs):
+        previous = store_table(self)
+        super().save(*args, **kwargs)
+        # in a transaction, the previous table file is still needed if it's rolled back
+        storage = self.table_file.storage
+        transaction.on_commit(lambda: delete_table_file(storage, previous))
+
     def get_data_type_str(self):
         try:
             return dict(DataRelationType)[self.data_type]
@@ -210,6 +229,12 @@ class AnalysisData(models.Model):
         return '%s data for analysis %d' % (self.get_data_type_str(), self.analysis.pk)
 
 
+@receiver(post_delete, sender=AnalysisData)
+def delete_analysis_data_table(sender, instance, **kwargs):
+    if instance.table_file:
+        delete_table_file(instance.table_file.storage, instance.table_file.name)
+
+
 class AnalysisHistory(models.Model):
     analysis = models.ForeignKey(Analysis, on_delete=models.CASCADE)
     display_name = models.CharField(max_length=1000, blank=True, null=True)
@@ -235,6 +260,49 @@ class AnalysisHistory(models.Model):
         return '%s (%s) timestamp=%s' % (self.display_name, self.analysis_data, self.timestamp.strftime("%Y-%m-%d %H:%M:%S"))
 
 
+@receiver(post_delete, sender=AnalysisHistory)
+def delete_analysis_history_artifacts(sender, instance, **kwargs):
+    delete_artifacts(instance.inference_data)
+
+
+def get_payload_folder(instance, filename):
+    upload_folder = "analysis_upload_%s" % instance.analysis_data.analysis_id
+    return os.path.join(upload_folder, 'tables', filename)
+
+
+class AnalysisPayload(models.Model):
+    """
+    The rows of an analysis data merged with the results of its analysis histories, as served to the Firdi tables.
+    The JSON is stored in payload_file, next to the table file. history_ids is the version stamp: the histories that
+    have been merged, in order.
+    """
+    analysis_data = models.OneToOneField(
+        AnalysisData,
+        on_delete=models.CASCADE,
+        primary_key=True,
+    )
+    history_ids = JSONField(default=list)
+    payload_file = models.FileField(blank=True, null=True, upload_to=get_payload_folder)
+    timestamp = models.DateTimeField(default=timezone.localtime, null=False)
+
+    def __str__(self):
+        return 'Payload of %s with %d histories' % (self.analysis_data, len(self.history_ids))
+
+
+@receiver(post_delete, sender=AnalysisPayload)
+def delete_analysis_payload_file(sender, instance, **kwargs):
+    if instance.payload_file:
+        storage, name = instance.payload_file.storage, instance.payload_file.name
+        transaction.on_commit(lambda: delete_table_file(storage, name))
+
+
+@receiver(post_save, sender=AnalysisData)
+def invalidate_analysis_payload(sender, instance, created, **kwargs):
+    # the rows may have changed, e.g. when data is added to the analysis
+    if not created:
+        AnalysisPayload.objects.filter(analysis_data=instance).delete()
+
+
 class AnalysisAnnotation(models.Model):
     analysis = models.ForeignKey(Analysis, on_delete=models.CASCADE)
     data_type = models.IntegerField(choices=DataType)
@@ -262,3 +330,36 @@ class AnalysisGroup(models.Model):
 
     def __str__(self):
         return '%s data_type=%d %s' % (self.analysis.name, self.data_type, self.display_name)
+
+
+class MappingResult(models.Model):
+    key = models.CharField(max_length=40, unique=True)
+    reference_version = models.CharField(max_length=100)
+    result = JSONField()
+    timestamp = models.DateTimeField(default=timezone.localtime, null=False)
+
+    def __str__(self):
+        return '%s reference_version=%s' % (self.key, self.reference_version)
+
+
+class AnalysisJob(models.Model):
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    job_type = models.CharField(max_length=20, choices=JobTypeChoices, default=JOB_TYPE_CREATE)
+    analysis = models.ForeignKey(Analysis, on_delete=models.SET_NULL, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=JobStatusChoices, default=JOB_PENDING)
+    stage = models.CharField(max_length=20, blank=True, null=True)
+    progress = JSONField(default=dict)
+    parameters = JSONField()
+    error = models.TextField(blank=True, null=True)
+    cancel_requested = models.BooleanField(default=False)
+    worker = models.CharField(max_length=100, blank=True, null=True)
+    timestamp = models.DateTimeField(default=timezone.localtime, null=False)
+    started = models.DateTimeField(blank=True, null=True)
+    heartbeat = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    def is_finished(self):
+        return self.status in [JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED]
+
+    def __str__(self):
+        return 'Job %d (%s) user=%s status=%s' % (self.pk, self.parameters.get('analysis_name'), self.user, self.status)
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+from collections import defaultdict
+
+from loguru import logger
+from neo4j import GraphDatabase, basic_auth
+from neo4j.exceptions import ServiceUnavailable, SessionExpired, TransientError
+
+from linker.instrumentation import record_query
+
+# errors that are worth retrying, e.g. the server restarting, a lost connection or a deadlock
+RETRYABLE_ERRORS = (ServiceUnavailable, SessionExpired, TransientError)
+
+
+class Neo4jConnectionManager(object):
+    """
+    Owns the Neo4j driver for the current process. The driver (and its connection pool) is only
+    created when the first query is made, so importing this module doesn't touch the database.
+    All queries go through run_query(), which retries transient errors and records timing counters.
+    """
+
+    def __init__(self):
+        self.server = os.getenv('NEO4J_SERVER', 'bolt://localhost:7687')
+        self.user = os.getenv('NEO4J_USER', 'neo4j')
+        self.password = os.getenv('NEO4J_PASSWORD', 'neo4j')
+        self.max_pool_size = int(os.getenv('NEO4J_MAX_POOL_SIZE', 50))
+        self.acquisition_timeout = float(os.getenv('NEO4J_ACQUISITION_TIMEOUT', 60))
+        self.connection_timeout = float(os.getenv('NEO4J_CONNECTION_TIMEOUT', 15))
+        self.max_retries = int(os.getenv('NEO4J_MAX_RETRIES', 3))
+        self.retry_delay = float(os.getenv('NEO4J_RETRY_DELAY', 1.0))
+        self.chunk_size = int(os.getenv('NEO4J_CHUNK_SIZE', 2000))
+
+        self._driver = None
+        self._driver_lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'count': 0, 'errors': 0, 'retries': 0, 'records': 0, 'time': 0.0})
+        self._stats_lock = threading.Lock()
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            with self._driver_lock:
+                if self._driver is None:
+                    self._driver = self._create_driver()
+        return self._driver
+
+    def _create_driver(self):
+        if 'NEO4J_SERVER' not in os.environ:
+            logger.warning('Using a default neo4j server: %s' % self.server)
+        if 'NEO4J_USER' not in os.environ or 'NEO4J_PASSWORD' not in os.environ:
+            logger.warning('Using a default neo4j username or password: %s' % self.user)
+
+        try:
+            neo4j_driver = GraphDatabase.driver(self.server,
+                                                auth=basic_auth(self.user, self.password),
+                                                max_connection_pool_size=self.max_pool_size,
+                                                connection_acquisition_timeout=self.acquisition_timeout,
+                                                connection_timeout=self.connection_timeout)
+            logger.info('Created graph database driver for %s (%s), pool size %d' %
+                        (self.server, self.user, self.max_pool_size))
+            return neo4j_driver
+        except Exception as e:
+            logger.warning('Failed to connect to graph database: %s' % str(e))
+            raise e
+
+    def session(self):
+        return self.driver.session()
+
+    def close(self):
+        with self._driver_lock:
+            if self._driver is not None:
+                self._driver.close()
+                self._driver = None
+
+    def run_query(self, query, params=None, name=None):
+        """
+        Run a Cypher query and return all its records, retrying on transient errors
+        :param query: the Cypher query
+        :param params: a dictionary of query parameters
+        :param name: a label to record the timing under, defaults to the query itself
+        :return: a list of neo4j Record objects
+        """
+        if name is None:
+            name = ' '.join(query.split())[0:100]
+        logger.debug(query)
+
+        attempt = 0
+        start = time.time()
+        while True:
+            session = None
+            try:
+                session = self.session()
+                records = list(session.run(query, params))
+                self._record(name, time.time() - start, len(records), attempt)
+                return records
+            except RETRYABLE_ERRORS as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._record(name, time.time() - start, 0, attempt - 1, failed=True)
+                    raise
+                delay = self.retry_delay * (2 ** (attempt - 1))
+                logger.warning('Neo4j query %s failed (%s), retrying in %.1fs [%d/%d]' %
+                               (name, str(e), delay, attempt, self.max_retries))
+                time.sleep(delay)
+            except Exception:
+                self._record(name, time.time() - start, 0, attempt, failed=True)
+                raise
+            finally:
+                if session is not None: session.close()
+
+    def stream_query(self, query, params, chunk_key, chunk_size=None, name=None):
+        """
+        Run a query with a large IN-list parameter in chunks, yielding the records of one chunk at a time.
+        Only a chunk of records is held in memory, and each chunk is retried separately on transient errors.
+        :param query: the Cypher query
+        :param params: a dictionary of query parameters
+        :param chunk_key: the name of the list parameter in params to split into chunks
+        :param chunk_size: the maximum number of items in each chunk, defaults to NEO4J_CHUNK_SIZE
+        :param name: a label to record the timing under
+        :return: a generator of neo4j Record objects
+        """
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+        values = list(params[chunk_key])
+        num_chunks = (len(values) + chunk_size - 1) // chunk_size
+        for i in range(0, len(values), chunk_size):
+            if num_chunks > 1:
+                logger.debug('Running chunk %d/%d of %s' % (i // chunk_size + 1, num_chunks, name))
+            chunk_params = dict(params)
+            chunk_params[chunk_key] = values[i:i + chunk_size]
+            for record in self.run_query(query, chunk_params, name=name):
+                yield record
+
+    def _record(self, name, elapsed, num_records, retries, failed=False):
+        record_query(elapsed)
+        with self._stats_lock:
+            stats = self._stats[name]
+            stats['count'] += 1
+            stats['time'] += elapsed
+            stats['records'] += num_records
+            stats['retries'] += retries
+            if failed:
+                stats['errors'] += 1
+
+    def get_stats(self):
+        with self._stats_lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+
+connection_manager = Neo4jConnectionManager()
+
+
+def run_query(query, params=None, name=None):
+    return connection_manager.run_query(query, params, name=name)
+
+
+def stream_query(query, params, chunk_key, chunk_size=None, name=None):
+    return connection_manager.stream_query(query, params, chunk_key, chunk_size=chunk_size, name=name)
+
+
+def get_query_stats():
+    return connection_manager.get_stats()
+
+
+def reset_query_stats():
+    connection_manager.reset_stats()
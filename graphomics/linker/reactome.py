@@ -1,58 +1,53 @@
-from collections import defaultdict
 import os
+import threading
+from collections import defaultdict
 
 import pandas as pd
 import xmltodict
 from bioservices.kegg import KEGG
 from loguru import logger
-from neo4j import GraphDatabase, basic_auth
 
+from linker.neo4j_connection import connection_manager, run_query, stream_query
+from linker.reactome_cache import cached_mapping
+from linker.reactome_index import INDEX_CLOSURE, INDEX_FORMULA, INDEX_PATHWAY, is_indexed, \
+    index_uniprot_to_reaction, index_compound_to_reaction, index_reaction_to_uniprot, index_reaction_to_compound, \
+    index_get_reaction_entities, index_get_all_pathways_formulae, index_get_compound_formulae, \
+    index_store_compound_formulae, index_reaction_to_pathway, index_pathway_to_reactions, index_get_all_pathways, \
+    get_index_connection, index_store_reaction_entities, index_store_pathway_members, index_get_reactome_descriptions, \
+    index_store_reactome_descriptions
+from linker.reactome_snapshot import get_snapshots, query_snapshots
 
-def get_neo4j_driver():
-    NEO4J_SERVER = os.getenv('NEO4J_SERVER', 'bolt://localhost:7687')
-    if 'NEO4J_SERVER' not in os.environ:
-        logger.warning('Using a default neo4j server: %s' % NEO4J_SERVER)
 
-    NEO4J_USER = os.getenv('NEO4J_USER', 'neo4j')
-    NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD', 'neo4j')
-    if 'NEO4J_USER' not in os.environ or 'NEO4J_PASSWORD' not in os.environ:
-        logger.warning('Using a default neo4j username or password: %s' % NEO4J_USER)
+# where the mappings that can be answered by both the snapshots and the closure and pathway indices are read from
+BACKEND_SNAPSHOT = 'snapshot'
+BACKEND_INDEX = 'index'
+BACKEND_NEO4J = 'neo4j'
 
-    try:
-        neo4j_driver = GraphDatabase.driver(NEO4J_SERVER,
-                                            auth=basic_auth(NEO4J_USER, NEO4J_PASSWORD))
-        logger.info('Created graph database driver for %s (%s)' % (NEO4J_SERVER, NEO4J_USER))
-        return neo4j_driver
-    except Exception as e:
-        logger.warning('Failed to connect to graph database: %s' % str(e))
-        raise e
 
+def get_mapping_backend():
+    backend = os.getenv('REACTOME_MAPPING_BACKEND', BACKEND_SNAPSHOT).lower()
+    if backend not in [BACKEND_SNAPSHOT, BACKEND_INDEX, BACKEND_NEO4J]:
+        logger.warning('Unknown REACTOME_MAPPING_BACKEND %s, using %s' % (backend, BACKEND_SNAPSHOT))
+        return BACKEND_SNAPSHOT
+    return backend
 
-driver = get_neo4j_driver()
+
+def get_neo4j_driver():
+    return connection_manager.driver
 
 
 def get_neo4j_session():
-    session = None
-    try:
-        session = driver.session()
-    except Exception:
-        raise
-    return session
+    return connection_manager.session()
 
 
 def get_species_list():
     results = []
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH (n:Species) RETURN n.displayName AS name order by name        
-        """
-        query_res = session.run(query)
-        logger.debug(query)
-        for record in query_res:
-            results.append(record['name'])
-    finally:
-        if session is not None: session.close()
+    query = """
+    MATCH (n:Species) RETURN n.displayName AS name order by name        
+    """
+    query_res = run_query(query, name='get_species_list')
+    for record in query_res:
+        results.append(record['name'])
     return results
 
 
@@ -64,45 +59,56 @@ def get_species_dict():
     return species_dict
 
 
+def get_reactome_version():
+    version = None
+    query = """
+    MATCH (d:DBInfo) RETURN d.version AS version
+    """
+    query_res = run_query(query, name='get_reactome_version')
+    for record in query_res:
+        version = record['version']
+    return version
+
+
 ################################################################################
 ### Gene-related functions                                                   ###
 ################################################################################
 
 
+@cached_mapping
 def ensembl_to_uniprot(ensembl_ids, species_list):
+    # only the snapshots store genes, so they're used with both local backends
+    snapshots = get_snapshots(species_list) if get_mapping_backend() != BACKEND_NEO4J else None
+    if snapshots is not None:
+        return query_snapshots(snapshots, 'ensembl_to_uniprot', ensembl_ids)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH
-            (rg:ReferenceGeneProduct)-[:referenceGene]->
-            (rs:ReferenceSequence)-[:species]->(s:Species)
-        WHERE
-            rs.identifier IN {ensembl_ids} AND
-            rs.databaseName = 'ENSEMBL' AND            
-            s.displayName IN {species}
-        RETURN DISTINCT
-            rs.identifier AS gene_id,
-            rs.databaseName AS gene_db,
-            rg.identifier AS protein_id,
-            rg.databaseName AS protein_db,
-            rg.url as URL
-        """
-        params = {
-            'ensembl_ids': ensembl_ids,
-            'species': species_list
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            gene_id = record['gene_id']
-            protein_id = record['protein_id']
-            results[gene_id].append(protein_id)
-
-    finally:
-        if session is not None: session.close()
+    query = """
+    MATCH
+        (rg:ReferenceGeneProduct)-[:referenceGene]->
+        (rs:ReferenceSequence)-[:species]->(s:Species)
+    WHERE
+        rs.identifier IN {ensembl_ids} AND
+        rs.databaseName = 'ENSEMBL' AND            
+        s.displayName IN {species}
+    RETURN DISTINCT
+        rs.identifier AS gene_id,
+        rs.databaseName AS gene_db,
+        rg.identifier AS protein_id,
+        rg.databaseName AS protein_db,
+        rg.url as URL
+    """
+    params = {
+        'ensembl_ids': ensembl_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'ensembl_ids', name='ensembl_to_uniprot')
+
+    for record in query_res:
+        gene_id = record['gene_id']
+        protein_id = record['protein_id']
+        results[gene_id].append(protein_id)
     return dict(results), id_to_names
 
 
@@ -111,85 +117,89 @@ def ensembl_to_uniprot(ensembl_ids, species_list):
 ################################################################################
 
 
+@cached_mapping
 def uniprot_to_ensembl(uniprot_ids, species_list):
+    # only the snapshots store genes, so they're used with both local backends
+    snapshots = get_snapshots(species_list) if get_mapping_backend() != BACKEND_NEO4J else None
+    if snapshots is not None:
+        return query_snapshots(snapshots, 'uniprot_to_ensembl', uniprot_ids)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH
-            (rg:ReferenceGeneProduct)-[:referenceGene]->
-            (rs:ReferenceSequence)-[:species]->(s:Species)
-        WHERE
-            rg.identifier IN {uniprot_ids} AND
-            rs.databaseName = 'ENSEMBL' AND
-            s.displayName IN {species}
-        RETURN DISTINCT
-            rs.identifier AS gene_id,
-            rs.databaseName AS gene_db,
-            rg.identifier AS protein_id,
-            rg.databaseName AS protein_db,
-            rg.url as URL
-        """
-        params = {
-            'uniprot_ids': uniprot_ids,
-            'species': species_list
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            gene_id = record['gene_id']
-            protein_id = record['protein_id']
-            results[protein_id].append(gene_id)
-
-    finally:
-        if session is not None: session.close()
+    query = """
+    MATCH
+        (rg:ReferenceGeneProduct)-[:referenceGene]->
+        (rs:ReferenceSequence)-[:species]->(s:Species)
+    WHERE
+        rg.identifier IN {uniprot_ids} AND
+        rs.databaseName = 'ENSEMBL' AND
+        s.displayName IN {species}
+    RETURN DISTINCT
+        rs.identifier AS gene_id,
+        rs.databaseName AS gene_db,
+        rg.identifier AS protein_id,
+        rg.databaseName AS protein_db,
+        rg.url as URL
+    """
+    params = {
+        'uniprot_ids': uniprot_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'uniprot_ids', name='uniprot_to_ensembl')
+
+    for record in query_res:
+        gene_id = record['gene_id']
+        protein_id = record['protein_id']
+        results[protein_id].append(gene_id)
     return dict(results), id_to_names
 
 
+@cached_mapping
 def uniprot_to_reaction(uniprot_ids, species_list):
+    backend = get_mapping_backend()
+    if backend == BACKEND_SNAPSHOT:
+        snapshots = get_snapshots(species_list)
+        if snapshots is not None:
+            return query_snapshots(snapshots, 'uniprot_to_reaction', uniprot_ids)
+    elif backend == BACKEND_INDEX and is_indexed(INDEX_CLOSURE, species_list):
+        return index_uniprot_to_reaction(uniprot_ids, species_list)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
 
-        # note that using hasComponent|hasMember|hasCandidate below will
-        # retrieve all the sub-complexes too
-        query = """
-        MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
-              |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
-              |hasCandidate*]->
-              (pe:PhysicalEntity)-[:referenceEntity]->
-              (re:ReferenceEntity)-[:referenceDatabase]->
-              (rd:ReferenceDatabase)
-        WHERE
-            re.identifier IN {uniprot_ids} AND
-            rd.displayName = 'UniProt' AND
-            rle.speciesName IN {species}
-        RETURN DISTINCT
-            re.identifier AS protein_id,
-            re.description AS description,
-            rd.displayName AS protein_db,
-            rle.stId AS reaction_id,
-            rle.displayName AS reaction_name
-        """
-        params = {
-            'uniprot_ids': uniprot_ids,
-            'species': species_list
+    # note that using hasComponent|hasMember|hasCandidate below will
+    # retrieve all the sub-complexes too
+    query = """
+    MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+          |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+          |hasCandidate*]->
+          (pe:PhysicalEntity)-[:referenceEntity]->
+          (re:ReferenceEntity)-[:referenceDatabase]->
+          (rd:ReferenceDatabase)
+    WHERE
+        re.identifier IN {uniprot_ids} AND
+        rd.displayName = 'UniProt' AND
+        rle.speciesName IN {species}
+    RETURN DISTINCT
+        re.identifier AS protein_id,
+        re.description AS description,
+        rd.displayName AS protein_db,
+        rle.stId AS reaction_id,
+        rle.displayName AS reaction_name
+    """
+    params = {
+        'uniprot_ids': uniprot_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'uniprot_ids', name='uniprot_to_reaction')
+
+    for record in query_res:
+        protein_id = record['protein_id']
+        item = {
+            'reaction_id': record['reaction_id'],
+            'reaction_name': record['reaction_name']
         }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            protein_id = record['protein_id']
-            item = {
-                'reaction_id': record['reaction_id'],
-                'reaction_name': record['reaction_name']
-            }
-            results[protein_id].append(item)
-    finally:
-        if session is not None: session.close()
+        results[protein_id].append(item)
     return dict(results), id_to_names
 
 
@@ -200,66 +210,65 @@ def uniprot_to_reaction(uniprot_ids, species_list):
 
 def get_all_compound_ids():
     results = []
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH (di:DatabaseIdentifier)
-        WHERE
-            di.databaseName = 'COMPOUND'
-        RETURN DISTINCT
-            di.displayName AS compound_id
-        """
-        query_res = session.run(query)
-        logger.debug(query)
-
-        for record in query_res:
-            key = record['compound_id'].split(':')  # e.g. 'COMPOUND:C00025'
-            compound_id = key[1]
-            results.append(compound_id)
-    finally:
-        if session is not None: session.close()
+    query = """
+    MATCH (di:DatabaseIdentifier)
+    WHERE
+        di.databaseName = 'COMPOUND'
+    RETURN DISTINCT
+        di.displayName AS compound_id
+    """
+    query_res = run_query(query, name='get_all_compound_ids')
+
+    for record in query_res:
+        key = record['compound_id'].split(':')  # e.g. 'COMPOUND:C00025'
+        compound_id = key[1]
+        results.append(compound_id)
     return results
 
 
+@cached_mapping
 def compound_to_reaction(compound_ids, species_list):
+    backend = get_mapping_backend()
+    if backend == BACKEND_SNAPSHOT:
+        snapshots = get_snapshots(species_list)
+        if snapshots is not None:
+            return query_snapshots(snapshots, 'compound_to_reaction', compound_ids)
+    elif backend == BACKEND_INDEX and is_indexed(INDEX_CLOSURE, species_list):
+        return index_compound_to_reaction(compound_ids, species_list)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
-              |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
-              |hasCandidate*]->
-              (pe:PhysicalEntity)-[:crossReference|:referenceEntity]->
-              (do:DatabaseObject)
-        WHERE
-            do.identifier IN {compound_ids} AND
-            rle.speciesName IN {species}
-        RETURN DISTINCT
-            do.identifier AS compound_id,
-            do.displayName as display_name,
-            do.databaseName AS compound_db,
-            rle.stId AS reaction_id,
-        	rle.displayName AS reaction_name        
-        """
-        params = {
-            'compound_ids': compound_ids,
-            'species': species_list
+    query = """
+    MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+          |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+          |hasCandidate*]->
+          (pe:PhysicalEntity)-[:crossReference|:referenceEntity]->
+          (do:DatabaseObject)
+    WHERE
+        do.identifier IN {compound_ids} AND
+        rle.speciesName IN {species}
+    RETURN DISTINCT
+        do.identifier AS compound_id,
+        do.displayName as display_name,
+        do.databaseName AS compound_db,
+        rle.stId AS reaction_id,
+    	rle.displayName AS reaction_name        
+    """
+    params = {
+        'compound_ids': compound_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'compound_ids', name='compound_to_reaction')
+
+    for record in query_res:
+        compound_id = record['compound_id']
+        item = {
+            'reaction_id': record['reaction_id'],
+            'reaction_name': record['reaction_name']
         }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            compound_id = record['compound_id']
-            item = {
-                'reaction_id': record['reaction_id'],
-                'reaction_name': record['reaction_name']
-            }
-            results[compound_id].append(item)
-            compound_name = record['display_name']
-            id_to_names[compound_id] = compound_name
-    finally:
-        if session is not None: session.close()
+        results[compound_id].append(item)
+        compound_name = record['display_name']
+        id_to_names[compound_id] = compound_name
     return dict(results), id_to_names
 
 
@@ -282,129 +291,144 @@ def produce_kegg_dict(kegg_location, param):
 # get all the entities involved in a reaction
 def get_reaction_entities(reaction_ids):
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH (rle:ReactionLikeEvent)-[rr:input|output|catalystActivity
-              |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
-              |hasCandidate*]->(dbo:DatabaseObject)
-        WHERE
-            rle.stId IN {reaction_ids}
-        RETURN
-            rle.stId AS reaction_id,
-            dbo.stId AS entity_id,
-            dbo.schemaClass AS schema_class,
-            dbo.displayName as display_name,
-            extract(rel IN rr | type(rel)) AS types
-        """
-        params = {
-            'reaction_ids': reaction_ids
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            reaction_id = record['reaction_id']
-            entity_id = record['entity_id']
-            schema_class = record['schema_class']
-            display_name = record['display_name']
-            relationship_types = record['types']
-            item = (schema_class, entity_id, display_name, relationship_types)
-            results[reaction_id].append(item)
-    finally:
-        if session is not None: session.close()
+
+    # look up the indexed reactions first, and only query the remaining ones
+    if get_index_connection() is not None:
+        results = index_get_reaction_entities(reaction_ids)
+        reaction_ids = [x for x in reaction_ids if x not in results]
+        if len(reaction_ids) == 0:
+            return results
+
+    query = """
+    MATCH (rle:ReactionLikeEvent)-[rr:input|output|catalystActivity
+          |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+          |hasCandidate*]->(dbo:DatabaseObject)
+    WHERE
+        rle.stId IN {reaction_ids}
+    RETURN
+        rle.stId AS reaction_id,
+        rle.speciesName AS species,
+        dbo.stId AS entity_id,
+        dbo.schemaClass AS schema_class,
+        dbo.displayName as display_name,
+        extract(rel IN rr | type(rel)) AS types
+    """
+    params = {
+        'reaction_ids': reaction_ids
+    }
+    query_res = stream_query(query, params, 'reaction_ids', name='get_reaction_entities')
+
+    species_entities = []
+    for record in query_res:
+        reaction_id = record['reaction_id']
+        entity_id = record['entity_id']
+        schema_class = record['schema_class']
+        display_name = record['display_name']
+        relationship_types = record['types']
+        item = (schema_class, entity_id, display_name, relationship_types)
+        results[reaction_id].append(item)
+        species_entities.append((record['species'], reaction_id, item))
+    store_in_index(index_store_reaction_entities, species_entities)
     return results
 
 
+@cached_mapping
 def reaction_to_uniprot(reaction_ids, species_list):
+    backend = get_mapping_backend()
+    if backend == BACKEND_SNAPSHOT:
+        snapshots = get_snapshots(species_list)
+        if snapshots is not None:
+            return query_snapshots(snapshots, 'reaction_to_uniprot', reaction_ids)
+    elif backend == BACKEND_INDEX and is_indexed(INDEX_CLOSURE, species_list):
+        return index_reaction_to_uniprot(reaction_ids, species_list)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
 
-        # note that using hasComponent|hasMember|hasCandidate below will
-        # retrieve all the sub-complexes too
-        query = """
-        MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
-              |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
-              |hasCandidate*]->
-              (pe:PhysicalEntity)-[:referenceEntity]->
-              (re:ReferenceEntity)-[:referenceDatabase]->
-              (rd:ReferenceDatabase)
-        WHERE
-            rle.stId IN {reaction_ids} AND
-            rd.displayName = 'UniProt' AND
-            rle.speciesName IN {species}
-        RETURN DISTINCT
-            re.identifier AS protein_id,
-            re.description AS description,
-            rd.displayName AS protein_db,
-            rle.stId AS reaction_id,
-            rle.displayName AS reaction_name
-        """
-        params = {
-            'reaction_ids': reaction_ids,
-            'species': species_list
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            protein_id = record['protein_id']
-            reaction_id = record['reaction_id']
-            results[reaction_id].append(protein_id)
-    finally:
-        if session is not None: session.close()
+    # note that using hasComponent|hasMember|hasCandidate below will
+    # retrieve all the sub-complexes too
+    query = """
+    MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+          |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+          |hasCandidate*]->
+          (pe:PhysicalEntity)-[:referenceEntity]->
+          (re:ReferenceEntity)-[:referenceDatabase]->
+          (rd:ReferenceDatabase)
+    WHERE
+        rle.stId IN {reaction_ids} AND
+        rd.displayName = 'UniProt' AND
+        rle.speciesName IN {species}
+    RETURN DISTINCT
+        re.identifier AS protein_id,
+        re.description AS description,
+        rd.displayName AS protein_db,
+        rle.stId AS reaction_id,
+        rle.displayName AS reaction_name
+    """
+    params = {
+        'reaction_ids': reaction_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'reaction_ids', name='reaction_to_uniprot')
+
+    for record in query_res:
+        protein_id = record['protein_id']
+        reaction_id = record['reaction_id']
+        results[reaction_id].append(protein_id)
     return dict(results), id_to_names
 
 
+@cached_mapping
 def reaction_to_compound(reaction_ids, species_list, use_kegg=False):
+    backend = get_mapping_backend()
+    if backend == BACKEND_SNAPSHOT:
+        snapshots = get_snapshots(species_list)
+        if snapshots is not None:
+            return query_snapshots(snapshots, 'reaction_to_compound', reaction_ids, use_kegg)
+    elif backend == BACKEND_INDEX and is_indexed(INDEX_CLOSURE, species_list):
+        return index_reaction_to_compound(reaction_ids, species_list, use_kegg)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-        query = """
-        MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
-              |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
-              |hasCandidate*]->
-              (pe:PhysicalEntity)-[:crossReference|:referenceEntity]->
-              (do:DatabaseObject)
-        WHERE
-            rle.stId IN {reaction_ids} AND        
-            (do.databaseName = 'COMPOUND' OR do.databaseName = 'ChEBI') AND
-            rle.speciesName IN {species}
-        RETURN DISTINCT
-            do.identifier as compound_id,
-            do.displayName as display_name,            
-            do.databaseName AS compound_db,
-            rle.stId AS reaction_id,
-        	rle.displayName AS reaction_name
-        """
-        params = {
-            'reaction_ids': reaction_ids,
-            'species': species_list
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            reaction_id = record['reaction_id']
-            compound_id = record['compound_id']
-            display_name = record['display_name']
-            database_name = record['compound_db']
-            # TODO: find better ways to remove duplicates between KEGG and ChEBI?
-            valid = False
-            if use_kegg:
-                if database_name == 'COMPOUND':
-                    valid = True
-            else:
-                if database_name == 'ChEBI':
-                    valid = True
-            if valid:
-                results[reaction_id].append(compound_id)
-                id_to_names[compound_id] = display_name
-    finally:
-        if session is not None: session.close()
+    query = """
+    MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+          |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+          |hasCandidate*]->
+          (pe:PhysicalEntity)-[:crossReference|:referenceEntity]->
+          (do:DatabaseObject)
+    WHERE
+        rle.stId IN {reaction_ids} AND        
+        (do.databaseName = 'COMPOUND' OR do.databaseName = 'ChEBI') AND
+        rle.speciesName IN {species}
+    RETURN DISTINCT
+        do.identifier as compound_id,
+        do.displayName as display_name,            
+        do.databaseName AS compound_db,
+        rle.stId AS reaction_id,
+    	rle.displayName AS reaction_name
+    """
+    params = {
+        'reaction_ids': reaction_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'reaction_ids', name='reaction_to_compound')
+
+    for record in query_res:
+        reaction_id = record['reaction_id']
+        compound_id = record['compound_id']
+        display_name = record['display_name']
+        database_name = record['compound_db']
+        # TODO: find better ways to remove duplicates between KEGG and ChEBI?
+        valid = False
+        if use_kegg:
+            if database_name == 'COMPOUND':
+                valid = True
+        else:
+            if database_name == 'ChEBI':
+                valid = True
+        if valid:
+            results[reaction_id].append(compound_id)
+            id_to_names[compound_id] = display_name
     return dict(results), id_to_names
 
 
@@ -414,64 +438,69 @@ def rchop(thestring, ending):
     return thestring
 
 
+@cached_mapping
 def reaction_to_pathway(reaction_ids, species_list, metabolic_pathway_only, leaf=True):
+    # snapshots only store the leaf pathways, the rest of the hierarchy is always read from the pathway index
+    backend = get_mapping_backend()
+    if backend == BACKEND_SNAPSHOT and leaf:
+        snapshots = get_snapshots(species_list)
+        if snapshots is not None:
+            return query_snapshots(snapshots, 'reaction_to_pathway', reaction_ids, metabolic_pathway_only)
+    elif (backend == BACKEND_INDEX or not leaf) and is_indexed(INDEX_PATHWAY, species_list):
+        return index_reaction_to_pathway(reaction_ids, species_list, metabolic_pathway_only, leaf=leaf)
+
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-
-        # initial match clause in the query
-        query = """
-        MATCH (tp:TopLevelPathway)-[:hasEvent*]->
-              (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
-        WHERE
-            tp.speciesName IN {species} AND        
-            rle.stId IN {reaction_ids} AND            
-        """
-
-        if leaf:  # retrieve only the leaf nodes in the pathway hierarchy
-            query += " (p)-[:hasEvent]->(rle) AND "
-
-        if metabolic_pathway_only:  # only retrieves metabolic pathways
-            query += " tp.displayName = 'Metabolism' AND "
 
-        # remove last AND
-        query = rchop(query.strip(), 'AND')
-
-        # add return clause
-        query += """
-        RETURN
-            rle.stId AS reaction_id,
-            rle.displayName AS reaction_name,
-            rle.speciesName AS reaction_species,
-            p.stId AS pathway_id,
-            p.displayName AS pathway_name,
-            tp.speciesName AS pathway_species
-        """
-
-        params = {
-            'reaction_ids': reaction_ids,
-            'species': species_list
+    # initial match clause in the query
+    query = """
+    MATCH (tp:TopLevelPathway)-[:hasEvent*]->
+          (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
+    WHERE
+        tp.speciesName IN {species} AND        
+        rle.stId IN {reaction_ids} AND            
+    """
+
+    if leaf:  # retrieve only the leaf nodes in the pathway hierarchy
+        query += " (p)-[:hasEvent]->(rle) AND "
+
+    if metabolic_pathway_only:  # only retrieves metabolic pathways
+        query += " tp.displayName = 'Metabolism' AND "
+
+    # remove last AND
+    query = rchop(query.strip(), 'AND')
+
+    # add return clause
+    query += """
+    RETURN
+        rle.stId AS reaction_id,
+        rle.displayName AS reaction_name,
+        rle.speciesName AS reaction_species,
+        p.stId AS pathway_id,
+        p.displayName AS pathway_name,
+        tp.speciesName AS pathway_species
+    """
+
+    params = {
+        'reaction_ids': reaction_ids,
+        'species': species_list
+    }
+    query_res = stream_query(query, params, 'reaction_ids', name='reaction_to_pathway')
+
+    for record in query_res:
+        reaction_id = record['reaction_id']
+        reaction_name = record['reaction_name']
+        reaction_species = record['reaction_species']
+        pathway_id = record['pathway_id']
+        pathway_name = record['pathway_name']
+        pathway_species = record['pathway_species']
+        item = {
+            'pathway_id': pathway_id,
+            'pathway_name': pathway_name
         }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            reaction_id = record['reaction_id']
-            reaction_name = record['reaction_name']
-            reaction_species = record['reaction_species']
-            pathway_id = record['pathway_id']
-            pathway_name = record['pathway_name']
-            pathway_species = record['pathway_species']
-            item = {
-                'pathway_id': pathway_id,
-                'pathway_name': pathway_name
-            }
-            results[reaction_id].append(item)
-            id_to_names[reaction_id] = {'name': reaction_name, 'species': reaction_species}
-            id_to_names[pathway_id] = {'name': pathway_name, 'species': pathway_species}
-    finally:
-        if session is not None: session.close()
+        results[reaction_id].append(item)
+        id_to_names[reaction_id] = {'name': reaction_name, 'species': reaction_species}
+        id_to_names[pathway_id] = {'name': pathway_name, 'species': pathway_species}
     return dict(results), id_to_names
 
 
@@ -483,183 +512,287 @@ def reaction_to_pathway(reaction_ids, species_list, metabolic_pathway_only, leaf
 def pathway_to_reactions(pathway_ids):
     id_to_names = {}
     results = defaultdict(list)
-    try:
-        session = get_neo4j_session()
-        # retrieve only the leaf nodes in the pathway hierarchy
-        query = """
-        MATCH (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
-        WHERE
-            p.stId IN {pathway_ids} AND
-            (p)-[:hasEvent]->(rle)
-        RETURN
-            rle.stId AS reaction_id,
-            rle.displayName AS reaction_name,
-            p.stId AS pathway_id,
-            p.displayName AS pathway_name
-        """
-        params = {
-            'pathway_ids': pathway_ids
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            reaction_id = record['reaction_id']
-            reaction_name = record['reaction_name']
-            pathway_id = record['pathway_id']
-            pathway_name = record['pathway_name']
-            results[pathway_id].append(reaction_id)
-            id_to_names[reaction_id] = reaction_name
-            id_to_names[pathway_id] = pathway_name
-    finally:
-        if session is not None: session.close()
+    if get_index_connection() is not None:
+        results, id_to_names = index_pathway_to_reactions(pathway_ids)
+        pathway_ids = [x for x in pathway_ids if x not in results]
+        if len(pathway_ids) == 0:
+            return dict(results), id_to_names
+
+    # retrieve only the leaf nodes in the pathway hierarchy
+    query = """
+    MATCH (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
+    WHERE
+        p.stId IN {pathway_ids} AND
+        (p)-[:hasEvent]->(rle)
+    RETURN
+        rle.stId AS reaction_id,
+        rle.displayName AS reaction_name,
+        p.stId AS pathway_id,
+        p.displayName AS pathway_name
+    """
+    params = {
+        'pathway_ids': pathway_ids
+    }
+    query_res = stream_query(query, params, 'pathway_ids', name='pathway_to_reactions')
+
+    members = []
+    for record in query_res:
+        reaction_id = record['reaction_id']
+        reaction_name = record['reaction_name']
+        pathway_id = record['pathway_id']
+        pathway_name = record['pathway_name']
+        results[pathway_id].append(reaction_id)
+        id_to_names[reaction_id] = reaction_name
+        id_to_names[pathway_id] = pathway_name
+        members.append((pathway_id, pathway_name, reaction_id, reaction_name))
+    store_in_index(index_store_pathway_members, members)
     return dict(results), id_to_names
 
 
 def get_reactome_description(reactome_id, from_parent=False):
-    results = []
-    try:
-        session = get_neo4j_session()
-        if from_parent:
-            query = """
-            MATCH (dbo1:DatabaseObject)<-[:inferredTo*]-(dbo2:DatabaseObject)-[:summation|:literatureReference]-(ss)
-                    WHERE
-                        dbo1.stId = {reactome_id} AND
-                        dbo2.isInferred = False
-                    RETURN
-                        dbo2.stId as reactome_id,
-                        dbo2.speciesName as species,
-                        dbo2.isInferred as inferred,
-                        ss.displayName as display_name,
-                        ss.text as summary_text,
-                        ss.schemaClass as summary_type,
-                        properties(ss) as summary
-            """
-        else:
-            query = """
-            MATCH (dbo:DatabaseObject)-[:summation|:literatureReference]-(ss)
-                    WHERE
-                        dbo.stId = {reactome_id}
-                    RETURN
-                        dbo.stId as reactome_id,
-                        dbo.speciesName as species,
-                        dbo.isInferred as inferred,
-                        ss.displayName as display_name,
-                        ss.text as summary_text,
-                        ss.schemaClass as summary_type,
-                        properties(ss) as summary_props
-            """
-        params = {
-            'reactome_id': reactome_id,
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-        record_list = list(query_res.records())
-        results = list(map(lambda x: x.data(), record_list))
-        first_data = results[0]
-        is_inferred = first_data['inferred']
-    finally:
-        if session is not None: session.close()
+    results = get_reactome_descriptions([reactome_id], from_parent=from_parent)[reactome_id]
+    first_data = results[0]
+    is_inferred = first_data['inferred']
     return results, is_inferred
 
 
+def get_reactome_descriptions(reactome_ids, from_parent=False):
+    """
+    Get the summations and literature references of Reactome entities. Descriptions are stored in the
+    local index, so only the ids that haven't been seen before are queried from Neo4j.
+    :param reactome_ids: a list of reactome ids
+    :param from_parent: whether to get the descriptions of the entities these ids are inferred from
+    :return: a dictionary of reactome id to a list of description dictionaries
+    """
+    results = index_get_reactome_descriptions(reactome_ids, from_parent)
+    reactome_ids = [x for x in reactome_ids if x not in results]
+    if len(reactome_ids) == 0:
+        return results
+
+    if from_parent:
+        query = """
+        MATCH (dbo1:DatabaseObject)<-[:inferredTo*]-(dbo2:DatabaseObject)-[:summation|:literatureReference]-(ss)
+                WHERE
+                    dbo1.stId IN {reactome_ids} AND
+                    dbo2.isInferred = False
+                RETURN
+                    dbo1.stId as query_id,
+                    dbo2.stId as reactome_id,
+                    dbo2.speciesName as species,
+                    dbo2.isInferred as inferred,
+                    ss.displayName as display_name,
+                    ss.text as summary_text,
+                    ss.schemaClass as summary_type,
+                    properties(ss) as summary
+        """
+    else:
+        query = """
+        MATCH (dbo:DatabaseObject)-[:summation|:literatureReference]-(ss)
+                WHERE
+                    dbo.stId IN {reactome_ids}
+                RETURN
+                    dbo.stId as query_id,
+                    dbo.stId as reactome_id,
+                    dbo.speciesName as species,
+                    dbo.isInferred as inferred,
+                    ss.displayName as display_name,
+                    ss.text as summary_text,
+                    ss.schemaClass as summary_type,
+                    properties(ss) as summary_props
+        """
+    params = {
+        'reactome_ids': reactome_ids,
+    }
+    query_res = stream_query(query, params, 'reactome_ids', name='get_reactome_descriptions')
+
+    descriptions = defaultdict(list)
+    for record in query_res:
+        data = record.data()
+        query_id = data.pop('query_id')
+        descriptions[query_id].append(data)
+    store_in_index(index_store_reactome_descriptions, descriptions, from_parent)
+    results.update(descriptions)
+    return results
+
+
+def store_in_index(store_func, *args):
+    # the index is only a cache of query results here, so failing to write it shouldn't fail the request
+    try:
+        store_func(*args)
+    except Exception as e:
+        logger.warning('Failed to store results in the local index: %s' % str(e))
+
+
+def prefetch_reactome_info(reaction_ids, pathway_ids):
+    """
+    Query the descriptions, participants and pathway reactions shown in the info panels of an analysis
+    in a few batched queries, so they can be served from the local index
+    """
+    logger.info('Prefetching Reactome info for %d reactions and %d pathways' % (len(reaction_ids), len(pathway_ids)))
+    descriptions = get_reactome_descriptions(list(reaction_ids) + list(pathway_ids))
+    inferred_ids = [x for x in descriptions if len(descriptions[x]) > 0 and descriptions[x][0]['inferred']]
+    get_reactome_descriptions(inferred_ids, from_parent=True)
+    get_reaction_entities(reaction_ids)
+    pathway_to_reactions(pathway_ids)
+    logger.info('Finished prefetching Reactome info')
+
+
+def start_prefetch(reaction_ids, pathway_ids):
+    if os.getenv('REACTOME_PREFETCH', 'true').lower() in ['false', '0', 'no']:
+        return None
+
+    def run():
+        try:
+            prefetch_reactome_info(reaction_ids, pathway_ids)
+        except Exception as e:
+            logger.warning('Failed to prefetch Reactome info: %s' % str(e))
+
+    thread = threading.Thread(target=run, name='reactome-prefetch', daemon=True)
+    thread.start()
+    return thread
+
+
+# maximum number of entries that can be retrieved in a single KEGG get request
+KEGG_MAX_ENTRIES = 10
+
+
 def retrieve_kegg_formula(reactome_compound_name):
+    return retrieve_kegg_formulae([reactome_compound_name]).get(reactome_compound_name)
+
+
+def retrieve_kegg_formulae(reactome_compound_names):
+    """
+    Retrieve the formulae of compounds from KEGG, requesting up to KEGG_MAX_ENTRIES compounds at a time
+    :param reactome_compound_names: compound names in Reactome, e.g. COMPOUND:C00031
+    :return: a dictionary of compound name to formula, or to None if KEGG has no formula for the compound.
+    Compounds whose request failed are left out.
+    """
     k = KEGG()
-    compound_name = reactome_compound_name.replace('COMPOUND', 'cpd')
-    res = k.get(compound_name).split('\n')
-    for line in res:
-        if line.startswith('FORMULA'):
-            formula = line.split()[1]  # get the second token
-            return formula
-    return None
+    results = {}
+    reactome_compound_names = list(reactome_compound_names)
+    for i in range(0, len(reactome_compound_names), KEGG_MAX_ENTRIES):
+        batch = reactome_compound_names[i:i + KEGG_MAX_ENTRIES]
+        kegg_id_to_name = {name.split(':')[-1]: name for name in batch}
+        res = k.get('+'.join(name.replace('COMPOUND', 'cpd') for name in batch))
+        if res == 404:  # none of the compounds are in KEGG
+            results.update({name: None for name in batch})
+            continue
+        if not isinstance(res, str):  # bioservices returns the status code on errors
+            logger.warning('Failed to retrieve %s from kegg: %s' % (batch, res))
+            continue
+
+        results.update({name: None for name in batch})
+        kegg_id = None
+        for line in res.split('\n'):
+            if line.startswith('ENTRY'):
+                kegg_id = line.split()[1]
+            elif line.startswith('FORMULA') and kegg_id in kegg_id_to_name:
+                results[kegg_id_to_name[kegg_id]] = line.split()[1]  # get the second token
+    return results
+
+
+def get_compound_formulae(compound_names):
+    """
+    Get the formulae of compounds missing from Reactome. Formulae retrieved from KEGG are stored
+    in the local index, so each compound is only requested once. Compounds without a formula in KEGG are stored
+    with a None formula, and are only requested again if their request failed.
+    :return: a dictionary of compound name to formula or None, for the compounds that could be requested
+    """
+    results = index_get_compound_formulae(compound_names)
+    missing = [name for name in compound_names if name not in results]
+    if len(missing) > 0:
+        retrieved = retrieve_kegg_formulae(missing)
+        found = sum(1 for formula in retrieved.values() if formula is not None)
+        logger.debug('Missing formulae for %d compounds, retrieved %d from kegg' % (len(missing), found))
+        index_store_compound_formulae(retrieved)
+        results.update(retrieved)
+    return results
 
 
 def get_all_pathways(species_list):
+    if is_indexed(INDEX_PATHWAY, species_list):
+        return index_get_all_pathways(species_list)
+
     results = []
-    try:
-        session = get_neo4j_session()
 
-        # retrieve only the leaf nodes in the pathway hierarchy
-        query = """
-            MATCH (tp:TopLevelPathway)-[:hasEvent*]->(p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
-            WHERE
-                tp.displayName = 'Metabolism' AND
-                tp.speciesName IN {species_list} AND
-                (p)-[:hasEvent]->(rle)
-            RETURN DISTINCT
-                p.speciesName AS species_name,            
-                p.displayName AS pathway_name,
-                p.stId AS pathway_id                       
-            ORDER BY species_name, pathway_name
-        """
-        params = {
-            'species_list': species_list
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        for record in query_res:
-            pathway_species = record['species_name']
-            pathway_name = record['pathway_name']
-            pathway_id = record['pathway_id']
-            results.append((pathway_species, pathway_name, pathway_id))
-    finally:
-        if session is not None: session.close()
+    # retrieve only the leaf nodes in the pathway hierarchy
+    query = """
+        MATCH (tp:TopLevelPathway)-[:hasEvent*]->(p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
+        WHERE
+            tp.displayName = 'Metabolism' AND
+            tp.speciesName IN {species_list} AND
+            (p)-[:hasEvent]->(rle)
+        RETURN DISTINCT
+            p.speciesName AS species_name,            
+            p.displayName AS pathway_name,
+            p.stId AS pathway_id                       
+        ORDER BY species_name, pathway_name
+    """
+    params = {
+        'species_list': species_list
+    }
+    query_res = run_query(query, params, name='get_all_pathways')
+
+    for record in query_res:
+        pathway_species = record['species_name']
+        pathway_name = record['pathway_name']
+        pathway_id = record['pathway_id']
+        results.append((pathway_species, pathway_name, pathway_id))
     return results
 
 
 def get_all_pathways_formulae(species):
+    if is_indexed(INDEX_FORMULA, [species]):
+        return index_get_all_pathways_formulae(species)
+    return query_all_pathways_formulae(species)
+
+
+def query_all_pathways_formulae(species):
     results = defaultdict(set)
     pathway_id_to_name = {}
-    try:
-        session = get_neo4j_session()
 
-        # retrieve only the leaf nodes in the pathway hierarchy
-        query = """
-        MATCH (tp:TopLevelPathway)-[:hasEvent*]->
-              (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent),
-              (rle)-[:input|output|catalystActivity|physicalEntity|regulatedBy|regulator|hasComponent
-              |hasMember|hasCandidate*]->(pe:PhysicalEntity),
-              (pe:PhysicalEntity)-[:crossReference]->(di:DatabaseIdentifier)<-[:crossReference]-(rm:ReferenceMolecule)
-        WHERE
-              tp.displayName = 'Metabolism' AND
-              tp.speciesName = {species} AND
-              di.databaseName = 'COMPOUND' AND
-              (p)-[:hasEvent]->(rle)
-        RETURN DISTINCT
-            p.schemaClass,
-            p.displayName AS pathway_name,
-            p.stId AS pathway_id,
-            di.displayName as compound_name,
-            rm.formula AS formula,
-            di.url
-        """
-        params = {
-            'species': species
-        }
-        query_res = session.run(query, params)
-        logger.debug(query)
-
-        i = 0
-        retrieved = {}
-        for record in query_res:
-            pathway_id = record['pathway_id']
-            pathway_name = record['pathway_name']
-            pathway_id_to_name[pathway_id] = pathway_name
-            compound_name = record['compound_name']
-            formula = record['formula']
-            if formula is None:
-                if compound_name not in retrieved:
-                    formula = retrieve_kegg_formula(compound_name)
-                    logger.debug('Missing formula for %s, retrieved %s from kegg' %
-                                 (compound_name, formula))
-                    retrieved[compound_name] = formula
-                else:
-                    formula = retrieved[compound_name]
-            assert formula is not None, 'Formula is missing for %s' % compound_name
-            results[pathway_id].add(formula)
-    finally:
-        if session is not None: session.close()
+    # retrieve only the leaf nodes in the pathway hierarchy
+    query = """
+    MATCH (tp:TopLevelPathway)-[:hasEvent*]->
+          (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent),
+          (rle)-[:input|output|catalystActivity|physicalEntity|regulatedBy|regulator|hasComponent
+          |hasMember|hasCandidate*]->(pe:PhysicalEntity),
+          (pe:PhysicalEntity)-[:crossReference]->(di:DatabaseIdentifier)<-[:crossReference]-(rm:ReferenceMolecule)
+    WHERE
+          tp.displayName = 'Metabolism' AND
+          tp.speciesName = {species} AND
+          di.databaseName = 'COMPOUND' AND
+          (p)-[:hasEvent]->(rle)
+    RETURN DISTINCT
+        p.schemaClass,
+        p.displayName AS pathway_name,
+        p.stId AS pathway_id,
+        di.displayName as compound_name,
+        rm.formula AS formula,
+        di.url
+    """
+    params = {
+        'species': species
+    }
+    query_res = run_query(query, params, name='get_all_pathways_formulae')
+
+    missing = list(set(record['compound_name'] for record in query_res if record['formula'] is None))
+    retrieved = get_compound_formulae(missing)
+    unresolved = set()
+    for record in query_res:
+        pathway_id = record['pathway_id']
+        pathway_name = record['pathway_name']
+        pathway_id_to_name[pathway_id] = pathway_name
+        compound_name = record['compound_name']
+        formula = record['formula']
+        if formula is None:
+            formula = retrieved.get(compound_name)
+        if formula is None:
+            unresolved.add(compound_name)
+            continue
+        results[pathway_id].add(formula)
+    if len(unresolved) > 0:
+        logger.warning('Leaving out %d compounds without a formula: %s' % (len(unresolved), sorted(unresolved)))
     return dict(results), pathway_id_to_name
 
 
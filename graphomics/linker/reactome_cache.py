@@ -0,0 +1,216 @@
+import functools
+import gzip
+import hashlib
+import inspect
+import os
+import pickle
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+from loguru import logger
+
+from linker.constants import EXTERNAL_REACTOME_CACHE_DIR
+
+
+def use_cache():
+    return os.getenv('REACTOME_USE_CACHE', 'true').lower() not in ['false', '0', 'no']
+
+
+def get_cache_dir():
+    return os.getenv('REACTOME_CACHE_DIR', EXTERNAL_REACTOME_CACHE_DIR)
+
+
+################################################################################
+### Reactome version                                                         ###
+################################################################################
+
+# how long (in seconds) the Reactome version is trusted before it's checked again
+VERSION_TTL = int(os.getenv('REACTOME_CACHE_VERSION_TTL', 600))
+
+# how long (in seconds) to wait before checking again after a failed check, e.g. while Neo4j is down
+VERSION_RETRY_TTL = int(os.getenv('REACTOME_CACHE_VERSION_RETRY_TTL', 30))
+
+_version_lock = threading.Lock()
+_version = {
+    'value': None,
+    'checked': 0,
+    'failed': False,
+    'checking': False
+}
+
+
+def get_cached_version():
+    """
+    Returns the version of the Reactome database, asking Neo4j at most once every VERSION_TTL seconds, or every
+    VERSION_RETRY_TTL seconds after a failed check. Only one thread asks Neo4j at a time, and the lock is not held
+    while it waits, so the other threads get the last known version in the meantime.
+    :return: the version, or None if it has never been determined
+    """
+    from linker.reactome import get_reactome_version
+    from linker.reactome_index import clear_stale_rows
+
+    with _version_lock:
+        ttl = VERSION_RETRY_TTL if _version['failed'] else VERSION_TTL
+        if _version['checking'] or time.time() - _version['checked'] <= ttl:
+            return _version['value']
+        _version['checking'] = True
+
+    version = None
+    try:
+        version = get_reactome_version()
+    except Exception as e:
+        logger.warning('Failed to get Reactome version: %s' % str(e))
+    finally:
+        with _version_lock:
+            previous = _version['value']
+            if version is not None:
+                _version['value'] = str(version)
+            _version['failed'] = version is None
+            _version['checked'] = time.time()
+            _version['checking'] = False
+            current = _version['value']
+
+    if previous is not None and current != previous:
+        logger.info('Reactome version changed from %s to %s, clearing mapping cache' % (previous, current))
+        mapping_cache.clear()
+        mapping_cache.remove_stale(current)
+    if version is not None:
+        # the index is shared by all processes, so it's checked even if this process hasn't seen the version change
+        try:
+            clear_stale_rows(current)
+        except Exception as e:
+            logger.warning('Failed to clear the stale rows of the Reactome index: %s' % str(e))
+    return current
+
+
+################################################################################
+### Two-tier cache                                                           ###
+################################################################################
+
+class MappingCache(object):
+    """
+    A cache of mapping results, made of an in-memory LRU in front of a directory of gzipped pickles.
+    Values are stored pickled in both tiers, so callers always get their own copy of the results.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, version, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+        if data is None:
+            data = self._read(version, key)
+            if data is not None:
+                self._remember(key, data)
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+    def set(self, version, key, value):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._remember(key, data)
+        self._write(version, key, data)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+
+    def remove_stale(self, version):
+        """
+        Delete the disk entries of all other Reactome versions
+        """
+        cache_dir = get_cache_dir()
+        if not os.path.isdir(cache_dir):
+            return
+        for name in os.listdir(cache_dir):
+            if name != version:
+                shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+    def _remember(self, key, data):
+        with self.lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+    def _get_path(self, version, key):
+        return os.path.join(get_cache_dir(), version, '%s.pkl.gz' % key)
+
+    def _read(self, version, key):
+        filename = self._get_path(version, key)
+        try:
+            with gzip.open(filename, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('Failed to read cached mapping %s: %s' % (filename, str(e)))
+            return None
+
+    def _write(self, version, key, data):
+        filename = self._get_path(version, key)
+        try:
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            # write to a temporary file first so other processes never see a partial entry
+            tmp_filename = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+            with gzip.open(tmp_filename, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_filename, filename)
+        except Exception as e:
+            logger.warning('Failed to write cached mapping %s: %s' % (filename, str(e)))
+
+
+mapping_cache = MappingCache(max_size=int(os.getenv('REACTOME_CACHE_SIZE', 256)))
+
+
+def normalise(value):
+    # the order and duplicates of ids and species don't change the results of the mapping functions
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sorted(set(str(v) for v in value))
+    return value
+
+
+def make_key(func_name, arguments, backend=None):
+    key = [func_name, backend] + [(name, normalise(value)) for name, value in sorted(arguments.items())]
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def cached_mapping(func):
+    """
+    Cache the results of a mapping function in linker.reactome. The cache key is made from the function
+    name, the mapping backend and all its arguments (e.g. ids, species list, use_kegg), and entries are
+    kept separately for each version of the Reactome database.
+    """
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from linker.reactome import get_mapping_backend
+
+        if not use_cache():
+            return func(*args, **kwargs)
+
+        version = get_cached_version()
+        if version is None:
+            return func(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        key = make_key(func.__name__, bound.arguments, get_mapping_backend())
+        results = mapping_cache.get(version, key)
+        if results is not None:
+            logger.debug('Cache hit for %s' % func.__name__)
+            return results
+
+        results = func(*args, **kwargs)
+        mapping_cache.set(version, key, results)
+        return results
+
+    return wrapper
@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+
+from loguru import logger
+
+from linker.constants import EXTERNAL_REACTOME_CATALOGUE
+from linker.reactome_cache import get_cached_version
+
+# how often (in seconds) the background thread checks whether the Reactome version has changed
+REFRESH_INTERVAL = int(os.getenv('REACTOME_CATALOGUE_REFRESH', 3600))
+
+
+def get_catalogue_path():
+    return os.getenv('REACTOME_CATALOGUE', EXTERNAL_REACTOME_CATALOGUE)
+
+
+def pathways_key(species_list):
+    return '|'.join(sorted(set(species_list)))
+
+
+class ReactomeCatalogue(object):
+    """
+    Slow-changing Reactome metadata (species, metabolic pathways, compound ids) loaded once per
+    Reactome version. The catalogue is saved to a local file shared by all the worker processes,
+    and refreshed in a background thread, started on first use, when the Reactome version changes.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = None
+        self.species_list = None
+        self.pathways = {}
+        self.compound_ids = None
+        self.refresh_thread = None
+
+    def get_species_list(self):
+        self.start_refresh()
+        if self.species_list is None:
+            self._load_or_query()
+        return self.species_list
+
+    def get_species_dict(self):
+        species_dict = {}
+        for idx, s in enumerate(self.get_species_list()):
+            species_dict[str(idx)] = s
+        return species_dict
+
+    def get_all_pathways(self, species_list):
+        self.start_refresh()
+        key = pathways_key(species_list)
+        if key not in self.pathways:
+            if self.species_list is None:
+                self._load_or_query()
+            if key not in self.pathways:
+                from linker.reactome import get_all_pathways
+                with self.lock:
+                    self.pathways[key] = get_all_pathways(species_list)
+                    self.save()
+        return self.pathways[key]
+
+    def get_all_compound_ids(self):
+        self.start_refresh()
+        if self.compound_ids is None:
+            if self.species_list is None:
+                self._load_or_query()
+            if self.compound_ids is None:
+                from linker.reactome import get_all_compound_ids
+                with self.lock:
+                    self.compound_ids = get_all_compound_ids()
+                    self.save()
+        return self.compound_ids
+
+    def _load_or_query(self):
+        with self.lock:
+            if self.species_list is not None:
+                return
+            if not self.load():
+                self.refresh()
+
+    def load(self):
+        """
+        Load the catalogue from the local file
+        :return: True if it was loaded, False otherwise
+        """
+        filename = get_catalogue_path()
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning('Failed to load Reactome catalogue %s: %s' % (filename, str(e)))
+            return False
+
+        with self.lock:
+            self.version = data['version']
+            self.species_list = data['species_list']
+            self.pathways = {key: [tuple(item) for item in items] for key, items in data['pathways'].items()}
+            self.compound_ids = data['compound_ids']
+        logger.info('Loaded Reactome catalogue (version %s) from %s' % (self.version, filename))
+        return True
+
+    def save(self):
+        filename = get_catalogue_path()
+        data = {
+            'version': self.version,
+            'species_list': self.species_list,
+            'pathways': self.pathways,
+            'compound_ids': self.compound_ids
+        }
+        try:
+            out_dir = os.path.dirname(filename)
+            if len(out_dir) > 0:
+                os.makedirs(out_dir, exist_ok=True)
+            tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+            with open(tmp_filename, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_filename, filename)
+        except Exception as e:
+            logger.warning('Failed to save Reactome catalogue %s: %s' % (filename, str(e)))
+
+    def refresh(self, version=None):
+        """
+        Query the catalogue again from Neo4j, for the species and pathways already in the catalogue
+        """
+        from linker.reactome import get_reactome_version, get_species_list, get_all_pathways, get_all_compound_ids
+
+        if version is None:
+            version = get_reactome_version()
+        logger.info('Refreshing Reactome catalogue (version %s)' % version)
+        species_list = get_species_list()
+        pathway_keys = list(self.pathways.keys())
+        pathways = {key: get_all_pathways(key.split('|')) for key in pathway_keys}
+        compound_ids = get_all_compound_ids() if self.compound_ids is not None else None
+        with self.lock:
+            self.version = version
+            self.species_list = species_list
+            self.pathways = pathways
+            self.compound_ids = compound_ids
+            self.save()
+
+    def check_version(self):
+        # the cached version is only checked in Neo4j once every few minutes, and not retried while it's down
+        version = get_cached_version()
+        if version is not None and version != str(self.version):
+            self.refresh(version=version)
+
+    def start_refresh(self, interval=REFRESH_INTERVAL):
+        """
+        Start a daemon thread that periodically checks the Reactome version and refreshes the catalogue
+        when it has changed. The first check is done after one interval, the catalogue has just been loaded or
+        queried by the caller.
+        """
+        if self.refresh_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_version()
+                except Exception as e:
+                    logger.warning('Failed to refresh Reactome catalogue: %s' % str(e))
+
+        with self.lock:
+            if self.refresh_thread is None:
+                self.refresh_thread = threading.Thread(target=run, name='reactome-catalogue', daemon=True)
+                self.refresh_thread.start()
+
+
+catalogue = ReactomeCatalogue()
+
+
+def warm_catalogue():
+    # only read the local file, Neo4j is queried when the catalogue is first used
+    catalogue.load()
+
+
+def get_species_list():
+    return catalogue.get_species_list()
+
+
+def get_species_dict():
+    return catalogue.get_species_dict()
+
+
+def get_all_pathways(species_list):
+    return catalogue.get_all_pathways(species_list)
+
+
+def get_all_compound_ids():
+    return catalogue.get_all_compound_ids()
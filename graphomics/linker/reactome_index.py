@@ -0,0 +1,660 @@
+import json
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+
+from loguru import logger
+
+from linker.constants import EXTERNAL_REACTOME_INDEX
+from linker.neo4j_connection import run_query
+from linker.reactome_cache import get_cached_version
+
+# maximum number of host parameters in a single SQLite statement
+SQLITE_MAX_PARAMS = 900
+
+# the kinds of tables that can be built in the index, tracked per species in the index_status table
+INDEX_CLOSURE = 'closure'
+INDEX_FORMULA = 'formula'
+INDEX_PATHWAY = 'pathway'
+
+# the rows stored from Neo4j queries (reaction participants, pathway members and descriptions), tracked with the
+# species left empty
+INDEX_QUERIES = 'queries'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS index_status (
+    name TEXT NOT NULL,
+    species TEXT NOT NULL,
+    reactome_version TEXT,
+    PRIMARY KEY (name, species)
+);
+
+-- every entity reachable from a reaction through the participant relationships
+CREATE TABLE IF NOT EXISTS reaction_entity (
+    species TEXT NOT NULL,
+    reaction_id TEXT NOT NULL,
+    entity_id TEXT,
+    schema_class TEXT,
+    display_name TEXT,
+    types TEXT
+);
+CREATE INDEX IF NOT EXISTS reaction_entity_reaction ON reaction_entity (reaction_id);
+
+-- the reference identifiers (UniProt, KEGG COMPOUND, ChEBI) of the reachable physical entities
+CREATE TABLE IF NOT EXISTS reaction_reference (
+    species TEXT NOT NULL,
+    reaction_id TEXT NOT NULL,
+    reaction_name TEXT,
+    identifier TEXT NOT NULL,
+    database_name TEXT NOT NULL,
+    display_name TEXT
+);
+CREATE INDEX IF NOT EXISTS reaction_reference_identifier ON reaction_reference (identifier, species);
+CREATE INDEX IF NOT EXISTS reaction_reference_reaction ON reaction_reference (reaction_id, species);
+
+-- the formulae of the compounds in the leaf pathways under Metabolism
+CREATE TABLE IF NOT EXISTS pathway_formula (
+    species TEXT NOT NULL,
+    pathway_id TEXT NOT NULL,
+    pathway_name TEXT,
+    formula TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pathway_formula_species ON pathway_formula (species);
+
+-- every (pathway, reaction) pair below a top-level pathway, leaf is set when the pathway directly contains the reaction
+CREATE TABLE IF NOT EXISTS pathway_reaction (
+    species TEXT NOT NULL,
+    reaction_id TEXT NOT NULL,
+    reaction_name TEXT,
+    reaction_species TEXT,
+    pathway_id TEXT NOT NULL,
+    pathway_name TEXT,
+    top_level_id TEXT NOT NULL,
+    top_level_name TEXT,
+    metabolic INTEGER NOT NULL,
+    leaf INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pathway_reaction_reaction ON pathway_reaction (reaction_id, species);
+CREATE INDEX IF NOT EXISTS pathway_reaction_pathway ON pathway_reaction (pathway_id);
+CREATE INDEX IF NOT EXISTS pathway_reaction_species ON pathway_reaction (species, metabolic, leaf);
+
+-- reactions of pathways that were queried from Neo4j because they're not in pathway_reaction
+CREATE TABLE IF NOT EXISTS pathway_member (
+    pathway_id TEXT NOT NULL,
+    pathway_name TEXT,
+    reaction_id TEXT NOT NULL,
+    reaction_name TEXT
+);
+CREATE INDEX IF NOT EXISTS pathway_member_pathway ON pathway_member (pathway_id);
+
+-- summations and literature references of reactions and pathways, or of the entities they're inferred from
+CREATE TABLE IF NOT EXISTS reactome_description (
+    query_id TEXT NOT NULL,
+    from_parent INTEGER NOT NULL,
+    reactome_id TEXT,
+    species TEXT,
+    inferred INTEGER,
+    display_name TEXT,
+    summary_text TEXT,
+    summary_type TEXT,
+    summary TEXT
+);
+CREATE INDEX IF NOT EXISTS reactome_description_query ON reactome_description (query_id, from_parent);
+
+-- compound formulae missing from Reactome, retrieved from KEGG, the formula is NULL if KEGG has none
+CREATE TABLE IF NOT EXISTS compound_formula (
+    compound_name TEXT PRIMARY KEY,
+    formula TEXT
+);
+"""
+
+################################################################################
+### Connection handling                                                      ###
+################################################################################
+
+_local = threading.local()
+
+
+def get_index_path():
+    return os.getenv('REACTOME_INDEX', EXTERNAL_REACTOME_INDEX)
+
+
+def get_index_connection(create=False):
+    """
+    Returns the SQLite connection to the local Reactome index for the current thread
+    :param create: whether to create the index file if it doesn't exist
+    :return: a sqlite3 connection, or None if there's no index
+    """
+    filename = get_index_path()
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(filename)
+    if conn is None:
+        if not create and not os.path.exists(filename):
+            return None
+        out_dir = os.path.dirname(filename)
+        if len(out_dir) > 0:
+            os.makedirs(out_dir, exist_ok=True)
+        conn = sqlite3.connect(filename)
+        conn.executescript(SCHEMA)
+        connections[filename] = conn
+    return conn
+
+
+def chunks(items, n=SQLITE_MAX_PARAMS):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+
+def placeholders(items):
+    return ','.join('?' * len(items))
+
+
+def is_indexed(name, species_list):
+    """
+    Check whether an index table has been built for all the species in species_list from the current Reactome
+    version. Tables built from another version are treated as missing. When the Reactome version can't be
+    determined, e.g. Neo4j is down, the tables are used as they are.
+    """
+    conn = get_index_connection()
+    if conn is None or len(species_list) == 0:
+        return False
+    species_list = list(set(species_list))
+    query = 'SELECT species, reactome_version FROM index_status WHERE name = ? AND species IN (%s)' % \
+            placeholders(species_list)
+    versions = dict(conn.execute(query, [name] + species_list).fetchall())
+    if len(versions) < len(species_list):
+        return False
+    reactome_version = get_cached_version()
+    return not any(is_stale(name, species, version, reactome_version) for species, version in versions.items())
+
+
+def get_indexed_species(name):
+    """
+    Returns the species for which an index table has been built from the current Reactome version, see is_indexed
+    """
+    conn = get_index_connection()
+    if conn is None:
+        return []
+    reactome_version = get_cached_version()
+    rows = conn.execute('SELECT species, reactome_version FROM index_status WHERE name = ?', (name,)).fetchall()
+    return [species for species, version in rows if not is_stale(name, species, version, reactome_version)]
+
+
+_stale_warnings = set()
+
+
+def is_stale(name, species, index_version, reactome_version):
+    if reactome_version is None or index_version == reactome_version:
+        return False
+    if (name, species, index_version, reactome_version) not in _stale_warnings:
+        _stale_warnings.add((name, species, index_version, reactome_version))
+        logger.warning('Ignoring the %s index for %s (version %s), the database is at version %s. '
+                       'Please rebuild it.' % (name, species, index_version, reactome_version))
+    return True
+
+
+def is_built(name):
+    conn = get_index_connection()
+    if conn is None:
+        return False
+    return conn.execute('SELECT 1 FROM index_status WHERE name = ? LIMIT 1', (name,)).fetchone() is not None
+
+
+def clear_stale_rows(reactome_version):
+    """
+    Delete the rows stored from Neo4j queries when they were stored from another Reactome version, except for the
+    reaction participants of the species whose closure index has been built from this version
+    """
+    conn = get_index_connection()
+    if conn is None or reactome_version is None:
+        return
+    row = conn.execute('SELECT reactome_version FROM index_status WHERE name = ? AND species = ?',
+                       (INDEX_QUERIES, '')).fetchone()
+    if row is not None and row[0] == reactome_version:
+        return
+
+    logger.info('Deleting the Reactome rows stored from version %s, the database is at version %s' %
+                (row[0] if row is not None else None, reactome_version))
+    with conn:
+        conn.execute("""
+        DELETE FROM reaction_entity WHERE species NOT IN (
+            SELECT species FROM index_status WHERE name = ? AND reactome_version = ?
+        )""", (INDEX_CLOSURE, reactome_version))
+        conn.execute('DELETE FROM pathway_member')
+        conn.execute('DELETE FROM reactome_description')
+        mark_indexed(conn, INDEX_QUERIES, '', reactome_version)
+
+
+def mark_indexed(conn, name, species, reactome_version):
+    conn.execute('INSERT OR REPLACE INTO index_status (name, species, reactome_version) VALUES (?, ?, ?)',
+                 (name, species, str(reactome_version) if reactome_version is not None else None))
+
+
+################################################################################
+### Reaction participant closure                                             ###
+################################################################################
+
+# the same rows as the query in linker.reactome.get_reaction_entities, which may add reactions to the index
+CLOSURE_ENTITY_QUERY = """
+MATCH (rle:ReactionLikeEvent)-[rr:input|output|catalystActivity
+      |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+      |hasCandidate*]->(dbo:DatabaseObject)
+WHERE
+    rle.speciesName = {species}
+RETURN
+    rle.stId AS reaction_id,
+    dbo.stId AS entity_id,
+    dbo.schemaClass AS schema_class,
+    dbo.displayName as display_name,
+    extract(rel IN rr | type(rel)) AS types
+"""
+
+CLOSURE_PROTEIN_QUERY = """
+MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+      |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+      |hasCandidate*]->
+      (pe:PhysicalEntity)-[:referenceEntity]->
+      (re:ReferenceEntity)-[:referenceDatabase]->
+      (rd:ReferenceDatabase)
+WHERE
+    rd.displayName = 'UniProt' AND
+    rle.speciesName = {species}
+RETURN DISTINCT
+    rle.stId AS reaction_id,
+    rle.displayName AS reaction_name,
+    re.identifier AS identifier,
+    rd.displayName AS database_name,
+    re.displayName AS display_name
+"""
+
+CLOSURE_COMPOUND_QUERY = """
+MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+      |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+      |hasCandidate*]->
+      (pe:PhysicalEntity)-[:crossReference|:referenceEntity]->
+      (do:DatabaseObject)
+WHERE
+    (do.databaseName = 'COMPOUND' OR do.databaseName = 'ChEBI') AND
+    rle.speciesName = {species}
+RETURN DISTINCT
+    rle.stId AS reaction_id,
+    rle.displayName AS reaction_name,
+    do.identifier AS identifier,
+    do.databaseName AS database_name,
+    do.displayName AS display_name
+"""
+
+
+def build_closure_index(species, references=True):
+    """
+    Materialise the transitive reaction -> physical entity -> reference entity closure of a species
+    from Neo4j into the local index, so that mapping queries become keyed lookups
+    :param species: the species name, e.g. 'Homo sapiens'
+    :param references: whether to store the reference identifiers of the entities, only used for mapping when
+    REACTOME_MAPPING_BACKEND is 'index'
+    """
+    from linker.reactome import get_reactome_version
+
+    reactome_version = get_reactome_version()
+    logger.info('Building reaction closure index for %s (version %s)' % (species, reactome_version))
+    conn = get_index_connection(create=True)
+    params = {'species': species}
+    with conn:
+        conn.execute('DELETE FROM reaction_entity WHERE species = ?', (species,))
+        conn.execute('DELETE FROM reaction_reference WHERE species = ?', (species,))
+        conn.execute('DELETE FROM index_status WHERE name = ? AND species = ?', (INDEX_CLOSURE, species))
+
+        records = run_query(CLOSURE_ENTITY_QUERY, params, name='closure_entity')
+        conn.executemany(
+            'INSERT INTO reaction_entity VALUES (?, ?, ?, ?, ?, ?)',
+            ((species, r['reaction_id'], r['entity_id'], r['schema_class'], r['display_name'],
+              ':'.join(r['types'])) for r in records))
+        if not references:
+            return
+
+        for name, query in [('closure_protein', CLOSURE_PROTEIN_QUERY),
+                            ('closure_compound', CLOSURE_COMPOUND_QUERY)]:
+            records = run_query(query, params, name=name)
+            conn.executemany(
+                'INSERT INTO reaction_reference VALUES (?, ?, ?, ?, ?, ?)',
+                ((species, r['reaction_id'], r['reaction_name'], r['identifier'], r['database_name'],
+                  r['display_name']) for r in records))
+
+        mark_indexed(conn, INDEX_CLOSURE, species, reactome_version)
+
+
+def _select_references(key_col, keys, species_list, database_names):
+    conn = get_index_connection()
+    species_list = list(species_list)
+    for chunk in chunks(keys, SQLITE_MAX_PARAMS - len(species_list) - len(database_names)):
+        query = """
+        SELECT DISTINCT reaction_id, reaction_name, identifier, display_name
+        FROM reaction_reference
+        WHERE %s IN (%s) AND species IN (%s) AND database_name IN (%s)
+        """ % (key_col, placeholders(chunk), placeholders(species_list), placeholders(database_names))
+        for row in conn.execute(query, chunk + species_list + database_names):
+            yield row
+
+
+def index_uniprot_to_reaction(uniprot_ids, species_list):
+    results = defaultdict(list)
+    for reaction_id, reaction_name, protein_id, _ in _select_references('identifier', uniprot_ids,
+                                                                       species_list, ['UniProt']):
+        results[protein_id].append({
+            'reaction_id': reaction_id,
+            'reaction_name': reaction_name
+        })
+    return dict(results), {}
+
+
+def index_compound_to_reaction(compound_ids, species_list):
+    id_to_names = {}
+    results = defaultdict(list)
+    for reaction_id, reaction_name, compound_id, display_name in _select_references('identifier', compound_ids,
+                                                                                   species_list,
+                                                                                   ['COMPOUND', 'ChEBI']):
+        results[compound_id].append({
+            'reaction_id': reaction_id,
+            'reaction_name': reaction_name
+        })
+        id_to_names[compound_id] = display_name
+    return dict(results), id_to_names
+
+
+def index_reaction_to_uniprot(reaction_ids, species_list):
+    results = defaultdict(list)
+    for reaction_id, _, protein_id, _ in _select_references('reaction_id', reaction_ids,
+                                                            species_list, ['UniProt']):
+        results[reaction_id].append(protein_id)
+    return dict(results), {}
+
+
+def index_reaction_to_compound(reaction_ids, species_list, use_kegg=False):
+    database_name = 'COMPOUND' if use_kegg else 'ChEBI'
+    id_to_names = {}
+    results = defaultdict(list)
+    for reaction_id, _, compound_id, display_name in _select_references('reaction_id', reaction_ids,
+                                                                        species_list, [database_name]):
+        results[reaction_id].append(compound_id)
+        id_to_names[compound_id] = display_name
+    return dict(results), id_to_names
+
+
+def index_get_reaction_entities(reaction_ids):
+    """
+    Get the participants of reactions from the closure index, or previously queried from Neo4j.
+    Reactions that are not in the index are left out of the results.
+    """
+    get_cached_version()  # the rows of an older Reactome version are deleted when the version is checked
+    conn = get_index_connection()
+    results = defaultdict(list)
+    for chunk in chunks(reaction_ids):
+        query = """
+        SELECT reaction_id, schema_class, entity_id, display_name, types
+        FROM reaction_entity
+        WHERE reaction_id IN (%s)
+        """ % placeholders(chunk)
+        for reaction_id, schema_class, entity_id, display_name, types in conn.execute(query, chunk):
+            item = (schema_class, entity_id, display_name, types.split(':'))
+            results[reaction_id].append(item)
+    return results
+
+
+def index_store_reaction_entities(species_entities):
+    """
+    Store reaction participants queried from Neo4j
+    :param species_entities: a list of (species, reaction_id, (schema_class, entity_id, display_name, types)) tuples
+    """
+    conn = get_index_connection(create=True)
+    with conn:
+        # another request may have stored the same reactions in the meantime
+        reaction_ids = list(set(reaction_id for _, reaction_id, _ in species_entities))
+        for chunk in chunks(reaction_ids):
+            conn.execute('DELETE FROM reaction_entity WHERE reaction_id IN (%s)' % placeholders(chunk), chunk)
+        conn.executemany(
+            'INSERT INTO reaction_entity VALUES (?, ?, ?, ?, ?, ?)',
+            ((species, reaction_id, entity_id, schema_class, display_name, ':'.join(types))
+             for species, reaction_id, (schema_class, entity_id, display_name, types) in species_entities))
+
+
+################################################################################
+### Pathway hierarchy                                                        ###
+################################################################################
+
+PATHWAY_HIERARCHY_QUERY = """
+MATCH (tp:TopLevelPathway)-[:hasEvent*]->
+      (p:Pathway)-[:hasEvent*]->(rle:ReactionLikeEvent)
+WHERE
+    tp.speciesName = {species}
+RETURN DISTINCT
+    rle.stId AS reaction_id,
+    rle.displayName AS reaction_name,
+    rle.speciesName AS reaction_species,
+    p.stId AS pathway_id,
+    p.displayName AS pathway_name,
+    tp.stId AS top_level_id,
+    tp.displayName AS top_level_name,
+    exists((p)-[:hasEvent]->(rle)) AS leaf
+"""
+
+
+def build_pathway_index(species):
+    """
+    Flatten the pathway hierarchy of a species into (pathway, reaction) pairs with their top-level
+    pathway, so that reaction_to_pathway, pathway_to_reactions and get_all_pathways don't have to walk
+    the hierarchy in Neo4j
+    :param species: the species name, e.g. 'Homo sapiens'
+    """
+    from linker.reactome import get_reactome_version
+
+    reactome_version = get_reactome_version()
+    logger.info('Building pathway hierarchy index for %s (version %s)' % (species, reactome_version))
+    conn = get_index_connection(create=True)
+    records = run_query(PATHWAY_HIERARCHY_QUERY, {'species': species}, name='pathway_hierarchy')
+    with conn:
+        conn.execute('DELETE FROM pathway_reaction WHERE species = ?', (species,))
+        conn.executemany(
+            'INSERT INTO pathway_reaction VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((species, r['reaction_id'], r['reaction_name'], r['reaction_species'], r['pathway_id'],
+              r['pathway_name'], r['top_level_id'], r['top_level_name'], int(r['top_level_name'] == 'Metabolism'),
+              int(r['leaf'])) for r in records))
+        mark_indexed(conn, INDEX_PATHWAY, species, reactome_version)
+
+
+def index_reaction_to_pathway(reaction_ids, species_list, metabolic_pathway_only, leaf=True):
+    conn = get_index_connection()
+    species_list = list(species_list)
+    id_to_names = {}
+    results = defaultdict(list)
+    conditions = ''
+    if leaf:
+        conditions += ' AND leaf = 1'
+    if metabolic_pathway_only:
+        conditions += ' AND metabolic = 1'
+    for chunk in chunks(reaction_ids, SQLITE_MAX_PARAMS - len(species_list)):
+        query = """
+        SELECT DISTINCT reaction_id, reaction_name, reaction_species, pathway_id, pathway_name, species
+        FROM pathway_reaction
+        WHERE reaction_id IN (%s) AND species IN (%s) %s
+        """ % (placeholders(chunk), placeholders(species_list), conditions)
+        for reaction_id, reaction_name, reaction_species, pathway_id, pathway_name, pathway_species in \
+                conn.execute(query, chunk + species_list):
+            item = {
+                'pathway_id': pathway_id,
+                'pathway_name': pathway_name
+            }
+            results[reaction_id].append(item)
+            id_to_names[reaction_id] = {'name': reaction_name, 'species': reaction_species}
+            id_to_names[pathway_id] = {'name': pathway_name, 'species': pathway_species}
+    return dict(results), id_to_names
+
+
+def index_pathway_to_reactions(pathway_ids):
+    """
+    Get the reactions directly contained in pathways, from the pathway hierarchy index or previously
+    queried from Neo4j. Pathways that are not in the index are left out of the results, as are the pathways of
+    species whose hierarchy was indexed from another Reactome version.
+    """
+    conn = get_index_connection()
+    species_list = get_indexed_species(INDEX_PATHWAY)
+    id_to_names = {}
+    results = defaultdict(list)
+    for chunk in chunks(pathway_ids, (SQLITE_MAX_PARAMS - len(species_list)) // 2):
+        query = """
+        SELECT reaction_id, reaction_name, pathway_id, pathway_name
+        FROM pathway_reaction
+        WHERE pathway_id IN (%s) AND leaf = 1 AND species IN (%s)
+        UNION
+        SELECT reaction_id, reaction_name, pathway_id, pathway_name
+        FROM pathway_member
+        WHERE pathway_id IN (%s)
+        """ % (placeholders(chunk), placeholders(species_list), placeholders(chunk))
+        for reaction_id, reaction_name, pathway_id, pathway_name in conn.execute(query,
+                                                                                 chunk + species_list + chunk):
+            results[pathway_id].append(reaction_id)
+            id_to_names[reaction_id] = reaction_name
+            id_to_names[pathway_id] = pathway_name
+    return results, id_to_names
+
+
+def index_store_pathway_members(members):
+    """
+    Store pathway reactions queried from Neo4j
+    :param members: a list of (pathway_id, pathway_name, reaction_id, reaction_name) tuples
+    """
+    conn = get_index_connection(create=True)
+    with conn:
+        pathway_ids = list(set(member[0] for member in members))
+        for chunk in chunks(pathway_ids):
+            conn.execute('DELETE FROM pathway_member WHERE pathway_id IN (%s)' % placeholders(chunk), chunk)
+        conn.executemany('INSERT INTO pathway_member VALUES (?, ?, ?, ?)', members)
+
+
+def index_get_all_pathways(species_list):
+    conn = get_index_connection()
+    species_list = list(species_list)
+    query = """
+    SELECT DISTINCT species, pathway_name, pathway_id
+    FROM pathway_reaction
+    WHERE species IN (%s) AND metabolic = 1 AND leaf = 1
+    ORDER BY species, pathway_name
+    """ % placeholders(species_list)
+    return [tuple(row) for row in conn.execute(query, species_list)]
+
+
+################################################################################
+### Descriptions                                                             ###
+################################################################################
+
+
+def index_get_reactome_descriptions(reactome_ids, from_parent):
+    """
+    Get the previously queried descriptions of Reactome entities
+    :return: a dictionary of reactome id to a list of description dictionaries, for the ids found in the index
+    """
+    get_cached_version()  # the rows of an older Reactome version are deleted when the version is checked
+    conn = get_index_connection()
+    results = defaultdict(list)
+    if conn is None:
+        return results
+    summary_key = 'summary' if from_parent else 'summary_props'
+    for chunk in chunks(reactome_ids, SQLITE_MAX_PARAMS - 1):
+        query = """
+        SELECT query_id, reactome_id, species, inferred, display_name, summary_text, summary_type, summary
+        FROM reactome_description
+        WHERE query_id IN (%s) AND from_parent = ?
+        """ % placeholders(chunk)
+        for row in conn.execute(query, chunk + [int(from_parent)]):
+            query_id, reactome_id, species, inferred, display_name, summary_text, summary_type, summary = row
+            results[query_id].append({
+                'reactome_id': reactome_id,
+                'species': species,
+                'inferred': bool(inferred),
+                'display_name': display_name,
+                'summary_text': summary_text,
+                'summary_type': summary_type,
+                summary_key: json.loads(summary) if summary is not None else None
+            })
+    return results
+
+
+def index_store_reactome_descriptions(descriptions, from_parent):
+    """
+    Store descriptions queried from Neo4j
+    :param descriptions: a dictionary of reactome id to a list of description dictionaries
+    :param from_parent: whether these are the descriptions of the entities the ids are inferred from
+    """
+    summary_key = 'summary' if from_parent else 'summary_props'
+    conn = get_index_connection(create=True)
+    with conn:
+        for chunk in chunks(list(descriptions.keys()), SQLITE_MAX_PARAMS - 1):
+            conn.execute('DELETE FROM reactome_description WHERE query_id IN (%s) AND from_parent = ?' %
+                         placeholders(chunk), chunk + [int(from_parent)])
+        conn.executemany(
+            'INSERT INTO reactome_description VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            ((query_id, int(from_parent), d['reactome_id'], d['species'], d['inferred'], d['display_name'],
+              d['summary_text'], d['summary_type'], json.dumps(d.get(summary_key), default=str))
+             for query_id in descriptions for d in descriptions[query_id]))
+
+
+################################################################################
+### Pathway formulae                                                         ###
+################################################################################
+
+
+def build_formula_index(species):
+    """
+    Store the formulae of all the compounds in each metabolic pathway of a species in the local index
+    :param species: the species name, e.g. 'Homo sapiens'
+    """
+    from linker.reactome import get_reactome_version, query_all_pathways_formulae
+
+    reactome_version = get_reactome_version()
+    logger.info('Building pathway formula index for %s (version %s)' % (species, reactome_version))
+    results, pathway_id_to_name = query_all_pathways_formulae(species)
+    conn = get_index_connection(create=True)
+    with conn:
+        conn.execute('DELETE FROM pathway_formula WHERE species = ?', (species,))
+        conn.executemany(
+            'INSERT INTO pathway_formula VALUES (?, ?, ?, ?)',
+            ((species, pathway_id, pathway_id_to_name[pathway_id], formula)
+             for pathway_id in results for formula in results[pathway_id]))
+        mark_indexed(conn, INDEX_FORMULA, species, reactome_version)
+
+
+def index_get_all_pathways_formulae(species):
+    conn = get_index_connection()
+    results = defaultdict(set)
+    pathway_id_to_name = {}
+    query = 'SELECT pathway_id, pathway_name, formula FROM pathway_formula WHERE species = ?'
+    for pathway_id, pathway_name, formula in conn.execute(query, (species,)):
+        results[pathway_id].add(formula)
+        pathway_id_to_name[pathway_id] = pathway_name
+    return dict(results), pathway_id_to_name
+
+
+def index_get_compound_formulae(compound_names):
+    """
+    Get the previously retrieved formulae of compounds
+    :return: a dictionary of compound name to formula, or None if KEGG has none, for the compounds found in the index
+    """
+    conn = get_index_connection()
+    results = {}
+    if conn is None:
+        return results
+    for chunk in chunks(compound_names):
+        query = 'SELECT compound_name, formula FROM compound_formula WHERE compound_name IN (%s)' % \
+                placeholders(chunk)
+        for compound_name, formula in conn.execute(query, chunk):
+            results[compound_name] = formula
+    return results
+
+
+def index_store_compound_formulae(formulae):
+    conn = get_index_connection(create=True)
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO compound_formula VALUES (?, ?)', formulae.items())
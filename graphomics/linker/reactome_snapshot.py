@@ -0,0 +1,486 @@
+import os
+import re
+import threading
+from collections import defaultdict
+
+import numpy as np
+from loguru import logger
+
+from linker.constants import EXTERNAL_REACTOME_SNAPSHOT_DIR
+from linker.reactome_cache import get_cached_version
+
+SNAPSHOT_FORMAT = 1
+
+################################################################################
+### Export queries, run once per Reactome release and species                ###
+################################################################################
+
+GENE_PROTEIN_QUERY = """
+MATCH
+    (rg:ReferenceGeneProduct)-[:referenceGene]->
+    (rs:ReferenceSequence)-[:species]->(s:Species)
+WHERE
+    rs.databaseName = 'ENSEMBL' AND
+    s.displayName = {species}
+RETURN DISTINCT
+    rs.identifier AS gene_id,
+    rg.identifier AS protein_id
+"""
+
+REACTION_PROTEIN_QUERY = """
+MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+      |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+      |hasCandidate*]->
+      (pe:PhysicalEntity)-[:referenceEntity]->
+      (re:ReferenceEntity)-[:referenceDatabase]->
+      (rd:ReferenceDatabase)
+WHERE
+    rd.displayName = 'UniProt' AND
+    rle.speciesName = {species}
+RETURN DISTINCT
+    re.identifier AS protein_id,
+    rle.stId AS reaction_id,
+    rle.displayName AS reaction_name
+"""
+
+REACTION_COMPOUND_QUERY = """
+MATCH (rle:ReactionLikeEvent)-[:input|output|catalystActivity
+      |physicalEntity|regulatedBy|regulator|hasComponent|hasMember
+      |hasCandidate*]->
+      (pe:PhysicalEntity)-[:crossReference|:referenceEntity]->
+      (do:DatabaseObject)
+WHERE
+    (do.databaseName = 'COMPOUND' OR do.databaseName = 'ChEBI') AND
+    rle.speciesName = {species}
+RETURN DISTINCT
+    do.identifier AS compound_id,
+    do.displayName AS display_name,
+    do.databaseName AS compound_db,
+    rle.stId AS reaction_id,
+    rle.displayName AS reaction_name
+"""
+
+# only the leaf pathways, i.e. those with a direct hasEvent to the reaction
+REACTION_PATHWAY_QUERY = """
+MATCH (tp:TopLevelPathway)-[:hasEvent*]->
+      (p:Pathway)-[:hasEvent]->(rle:ReactionLikeEvent)
+WHERE
+    tp.speciesName = {species}
+RETURN DISTINCT
+    rle.stId AS reaction_id,
+    rle.displayName AS reaction_name,
+    p.stId AS pathway_id,
+    p.displayName AS pathway_name,
+    tp.displayName = 'Metabolism' AS metabolic
+"""
+
+
+################################################################################
+### Snapshot storage                                                         ###
+################################################################################
+
+
+def get_snapshot_dir():
+    return os.getenv('REACTOME_SNAPSHOT_DIR', EXTERNAL_REACTOME_SNAPSHOT_DIR)
+
+
+def get_snapshot_path(species, snapshot_dir=None):
+    if snapshot_dir is None:
+        snapshot_dir = get_snapshot_dir()
+    slug = re.sub(r'[^a-z0-9]+', '_', species.lower()).strip('_')
+    return os.path.join(snapshot_dir, '%s.npz' % slug)
+
+
+def to_csr(source_codes, target_codes, num_sources):
+    """
+    Build a compressed sparse row adjacency from parallel arrays of edge codes
+    :param source_codes: integer codes of the edge sources
+    :param target_codes: integer codes of the edge targets
+    :param num_sources: the size of the source vocabulary
+    :return: a tuple of (indptr, indices), duplicate edges removed
+    """
+    source_codes = np.asarray(source_codes, dtype=np.int64)
+    target_codes = np.asarray(target_codes, dtype=np.int64)
+    if len(source_codes) > 0:
+        num_targets = target_codes.max() + 1
+        edges = np.unique(source_codes * num_targets + target_codes)  # sorted by source, then target
+        source_codes = edges // num_targets
+        target_codes = edges % num_targets
+    counts = np.bincount(source_codes, minlength=num_sources)
+    indptr = np.zeros(num_sources + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, target_codes.astype(np.int32)
+
+
+def transpose_csr(indptr, indices, num_targets):
+    source_codes = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    return to_csr(indices, source_codes, num_targets)
+
+
+def encode(labels, vocabulary):
+    """
+    Convert string ids into their integer codes in a sorted vocabulary
+    """
+    labels = np.asarray(labels, dtype=str)
+    if len(labels) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.searchsorted(vocabulary, labels)
+
+
+def make_vocabulary(*label_lists):
+    labels = [label for label_list in label_lists for label in label_list]
+    return np.unique(np.asarray(labels, dtype=str))
+
+
+class ReactomeSnapshot(object):
+    """
+    An in-memory copy of the Reactome subgraph of a single species, used to answer the mapping
+    queries in linker.reactome without going to Neo4j. Entities are integer-coded by their position
+    in sorted id arrays, and each relation is stored as CSR adjacency arrays.
+    """
+
+    def __init__(self, species, version, arrays):
+        self.species = species
+        self.version = version
+
+        self.genes = arrays['genes']
+        self.proteins = arrays['proteins']
+        self.compounds = arrays['compounds']
+        self.compound_names = arrays['compound_names']
+        self.compound_dbs = arrays['compound_dbs']
+        self.reactions = arrays['reactions']
+        self.reaction_names = arrays['reaction_names']
+        self.pathways = arrays['pathways']
+        self.pathway_names = arrays['pathway_names']
+        self.pathway_metabolic = arrays['pathway_metabolic']
+
+        self.gene_index = self._make_index(self.genes)
+        self.protein_index = self._make_index(self.proteins)
+        self.compound_index = self._make_index(self.compounds)
+        self.reaction_index = self._make_index(self.reactions)
+
+        # the forward adjacencies are exported, the reverse ones are derived at load time
+        self.gene_protein = (arrays['gene_protein_indptr'], arrays['gene_protein_indices'])
+        self.reaction_protein = (arrays['reaction_protein_indptr'], arrays['reaction_protein_indices'])
+        self.reaction_compound = (arrays['reaction_compound_indptr'], arrays['reaction_compound_indices'])
+        self.reaction_pathway = (arrays['reaction_pathway_indptr'], arrays['reaction_pathway_indices'])
+        self.protein_gene = transpose_csr(*self.gene_protein, len(self.proteins))
+        self.protein_reaction = transpose_csr(*self.reaction_protein, len(self.proteins))
+        self.compound_reaction = transpose_csr(*self.reaction_compound, len(self.compounds))
+
+    @staticmethod
+    def _make_index(labels):
+        return {label: i for i, label in enumerate(labels.tolist())}
+
+    @staticmethod
+    def _neighbours(csr, code):
+        indptr, indices = csr
+        return indices[indptr[code]:indptr[code + 1]]
+
+    def _lookup(self, ids, index, csr):
+        found = {}
+        for key in ids:
+            code = index.get(key)
+            if code is None:
+                continue
+            neighbours = self._neighbours(csr, code)
+            if len(neighbours) > 0:
+                found[key] = neighbours
+        return found
+
+    def _reaction_item(self, code):
+        return {
+            'reaction_id': str(self.reactions[code]),
+            'reaction_name': str(self.reaction_names[code])
+        }
+
+    ### genes and proteins ###
+
+    def ensembl_to_uniprot(self, ensembl_ids):
+        found = self._lookup(ensembl_ids, self.gene_index, self.gene_protein)
+        results = {key: self.proteins[codes].tolist() for key, codes in found.items()}
+        return results, {}
+
+    def uniprot_to_ensembl(self, uniprot_ids):
+        found = self._lookup(uniprot_ids, self.protein_index, self.protein_gene)
+        results = {key: self.genes[codes].tolist() for key, codes in found.items()}
+        return results, {}
+
+    def uniprot_to_reaction(self, uniprot_ids):
+        found = self._lookup(uniprot_ids, self.protein_index, self.protein_reaction)
+        results = {key: [self._reaction_item(code) for code in codes] for key, codes in found.items()}
+        return results, {}
+
+    ### compounds ###
+
+    def compound_to_reaction(self, compound_ids):
+        found = self._lookup(compound_ids, self.compound_index, self.compound_reaction)
+        results = {key: [self._reaction_item(code) for code in codes] for key, codes in found.items()}
+        id_to_names = {key: str(self.compound_names[self.compound_index[key]]) for key in results}
+        return results, id_to_names
+
+    ### reactions ###
+
+    def reaction_to_uniprot(self, reaction_ids):
+        found = self._lookup(reaction_ids, self.reaction_index, self.reaction_protein)
+        results = {key: self.proteins[codes].tolist() for key, codes in found.items()}
+        return results, {}
+
+    def reaction_to_compound(self, reaction_ids, use_kegg=False):
+        wanted_db = 'COMPOUND' if use_kegg else 'ChEBI'
+        found = self._lookup(reaction_ids, self.reaction_index, self.reaction_compound)
+        results = {}
+        id_to_names = {}
+        for key, codes in found.items():
+            codes = codes[self.compound_dbs[codes] == wanted_db]
+            if len(codes) == 0:
+                continue
+            compound_ids = self.compounds[codes].tolist()
+            results[key] = compound_ids
+            id_to_names.update(zip(compound_ids, self.compound_names[codes].tolist()))
+        return results, id_to_names
+
+    def reaction_to_pathway(self, reaction_ids, metabolic_pathway_only):
+        found = self._lookup(reaction_ids, self.reaction_index, self.reaction_pathway)
+        results = {}
+        id_to_names = {}
+        for key, codes in found.items():
+            if metabolic_pathway_only:
+                codes = codes[self.pathway_metabolic[codes]]
+            if len(codes) == 0:
+                continue
+            pathway_ids = self.pathways[codes].tolist()
+            pathway_names = self.pathway_names[codes].tolist()
+            results[key] = [{'pathway_id': pathway_id, 'pathway_name': pathway_name}
+                            for pathway_id, pathway_name in zip(pathway_ids, pathway_names)]
+            reaction_name = str(self.reaction_names[self.reaction_index[key]])
+            id_to_names[key] = {'name': reaction_name, 'species': self.species}
+            for pathway_id, pathway_name in zip(pathway_ids, pathway_names):
+                id_to_names[pathway_id] = {'name': pathway_name, 'species': self.species}
+        return results, id_to_names
+
+    ### persistence ###
+
+    def save(self, filename):
+        out_dir = os.path.dirname(filename)
+        if len(out_dir) > 0:
+            os.makedirs(out_dir, exist_ok=True)
+        arrays = {
+            'genes': self.genes,
+            'proteins': self.proteins,
+            'compounds': self.compounds,
+            'compound_names': self.compound_names,
+            'compound_dbs': self.compound_dbs,
+            'reactions': self.reactions,
+            'reaction_names': self.reaction_names,
+            'pathways': self.pathways,
+            'pathway_names': self.pathway_names,
+            'pathway_metabolic': self.pathway_metabolic,
+            'gene_protein_indptr': self.gene_protein[0],
+            'gene_protein_indices': self.gene_protein[1],
+            'reaction_protein_indptr': self.reaction_protein[0],
+            'reaction_protein_indices': self.reaction_protein[1],
+            'reaction_compound_indptr': self.reaction_compound[0],
+            'reaction_compound_indices': self.reaction_compound[1],
+            'reaction_pathway_indptr': self.reaction_pathway[0],
+            'reaction_pathway_indices': self.reaction_pathway[1],
+        }
+        np.savez_compressed(filename, format=np.array(SNAPSHOT_FORMAT), species=np.array(self.species),
+                            version=np.array(str(self.version)), **arrays)
+        logger.info('Saved Reactome snapshot for %s (version %s) to %s' % (self.species, self.version, filename))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename, allow_pickle=False) as data:
+            arrays = {key: data[key] for key in data.files}
+        if int(arrays['format']) != SNAPSHOT_FORMAT:
+            logger.warning('Ignoring Reactome snapshot %s with an old format. Please regenerate this file.' %
+                           filename)
+            return None
+        species = str(arrays['species'])
+        version = str(arrays['version'])
+        logger.info('Loaded Reactome snapshot for %s (version %s) from %s' % (species, version, filename))
+        return cls(species, version, arrays)
+
+    @classmethod
+    def from_records(cls, species, version, gene_proteins, reaction_proteins, reaction_compounds,
+                     reaction_pathways):
+        """
+        Build a snapshot from the rows returned by the export queries
+        :param species: the species name
+        :param version: the Reactome database version
+        :param gene_proteins: a list of (gene_id, protein_id)
+        :param reaction_proteins: a list of (reaction_id, reaction_name, protein_id)
+        :param reaction_compounds: a list of (reaction_id, reaction_name, compound_id, compound_name, compound_db)
+        :param reaction_pathways: a list of (reaction_id, reaction_name, pathway_id, pathway_name, metabolic)
+        :return: a ReactomeSnapshot object
+        """
+        gp_genes, gp_proteins = _columns(gene_proteins, 2)
+        rp_reactions, rp_reaction_names, rp_proteins = _columns(reaction_proteins, 3)
+        rc_reactions, rc_reaction_names, rc_compounds, rc_compound_names, rc_compound_dbs = \
+            _columns(reaction_compounds, 5)
+        rw_reactions, rw_reaction_names, rw_pathways, rw_pathway_names, rw_metabolic = \
+            _columns(reaction_pathways, 5)
+
+        genes = make_vocabulary(gp_genes)
+        proteins = make_vocabulary(gp_proteins, rp_proteins)
+        compounds = make_vocabulary(rc_compounds)
+        reactions = make_vocabulary(rp_reactions, rc_reactions, rw_reactions)
+        pathways = make_vocabulary(rw_pathways)
+
+        reaction_name_map = dict(zip(rp_reactions + rc_reactions + rw_reactions,
+                                     rp_reaction_names + rc_reaction_names + rw_reaction_names))
+        compound_name_map = dict(zip(rc_compounds, rc_compound_names))
+        compound_db_map = dict(zip(rc_compounds, rc_compound_dbs))
+        pathway_name_map = dict(zip(rw_pathways, rw_pathway_names))
+        metabolic_pathways = set(p for p, metabolic in zip(rw_pathways, rw_metabolic) if metabolic)
+
+        arrays = {
+            'genes': genes,
+            'proteins': proteins,
+            'compounds': compounds,
+            'compound_names': _aligned(compounds, compound_name_map),
+            'compound_dbs': _aligned(compounds, compound_db_map),
+            'reactions': reactions,
+            'reaction_names': _aligned(reactions, reaction_name_map),
+            'pathways': pathways,
+            'pathway_names': _aligned(pathways, pathway_name_map),
+            'pathway_metabolic': np.array([p in metabolic_pathways for p in pathways.tolist()], dtype=bool),
+        }
+        relations = {
+            'gene_protein': (encode(gp_genes, genes), encode(gp_proteins, proteins), len(genes)),
+            'reaction_protein': (encode(rp_reactions, reactions), encode(rp_proteins, proteins), len(reactions)),
+            'reaction_compound': (encode(rc_reactions, reactions), encode(rc_compounds, compounds),
+                                  len(reactions)),
+            'reaction_pathway': (encode(rw_reactions, reactions), encode(rw_pathways, pathways), len(reactions)),
+        }
+        for name, (source_codes, target_codes, num_sources) in relations.items():
+            indptr, indices = to_csr(source_codes, target_codes, num_sources)
+            arrays['%s_indptr' % name] = indptr
+            arrays['%s_indices' % name] = indices
+        return cls(species, version, arrays)
+
+
+def _columns(rows, n):
+    if len(rows) == 0:
+        return tuple([] for _ in range(n))
+    return tuple(list(col) for col in zip(*rows))
+
+
+def _aligned(vocabulary, mapping):
+    return np.array([mapping.get(key, '') or '' for key in vocabulary.tolist()], dtype=str)
+
+
+################################################################################
+### Loading and querying                                                     ###
+################################################################################
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def load_snapshot(species):
+    """
+    Load the snapshot of a species, keeping it in memory until its file changes, e.g. when it's exported again
+    after a Reactome release
+    :param species: the species name
+    :return: a ReactomeSnapshot, or None if no snapshot has been exported for this species
+    """
+    filename = get_snapshot_path(species)
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        mtime = None
+    with _snapshots_lock:
+        loaded_mtime, snapshot = _snapshots.get(filename, (None, None))
+        if mtime is None:
+            _snapshots.pop(filename, None)
+            return None
+        if loaded_mtime != mtime:
+            if loaded_mtime is not None:
+                logger.info('Reloading Reactome snapshot %s' % filename)
+            snapshot = ReactomeSnapshot.load(filename)
+            _snapshots[filename] = (mtime, snapshot)
+    return snapshot
+
+
+def clear_snapshots():
+    with _snapshots_lock:
+        _snapshots.clear()
+
+
+def get_snapshots(species_list):
+    """
+    Returns the snapshots for all the species in species_list, or None if any one of them is missing or was
+    exported from another Reactome version, in which case the caller should fall back to querying Neo4j.
+    When the Reactome version can't be determined, e.g. Neo4j is down, the snapshots are used as they are.
+    """
+    reactome_version = get_cached_version()
+    snapshots = []
+    for species in species_list:
+        snapshot = load_snapshot(species)
+        if snapshot is None or is_stale(snapshot, reactome_version):
+            return None
+        snapshots.append(snapshot)
+    return snapshots
+
+
+_stale_warnings = set()
+
+
+def is_stale(snapshot, reactome_version):
+    if reactome_version is None or snapshot.version == reactome_version:
+        return False
+    if (snapshot.species, snapshot.version, reactome_version) not in _stale_warnings:
+        _stale_warnings.add((snapshot.species, snapshot.version, reactome_version))
+        logger.warning('Ignoring Reactome snapshot for %s (version %s), the database is at version %s. '
+                       'Please regenerate this file.' % (snapshot.species, snapshot.version, reactome_version))
+    return True
+
+
+def query_snapshots(snapshots, method_name, *args):
+    """
+    Run the same query on the snapshots of several species and combine the results
+    """
+    results = defaultdict(list)
+    id_to_names = {}
+    for snapshot in snapshots:
+        res, names = getattr(snapshot, method_name)(*args)
+        for key, values in res.items():
+            results[key].extend(values)
+        id_to_names.update(names)
+    return dict(results), id_to_names
+
+
+################################################################################
+### Export from Neo4j                                                        ###
+################################################################################
+
+
+def export_snapshot(species, out_dir=None):
+    """
+    Export the Reactome subgraph for a species from Neo4j and save it as a snapshot file
+    :param species: the species name, e.g. 'Homo sapiens'
+    :param out_dir: the output directory, defaults to REACTOME_SNAPSHOT_DIR
+    :return: the saved ReactomeSnapshot
+    """
+    from linker.neo4j_connection import run_query
+    from linker.reactome import get_reactome_version
+
+    def run(query, fields):
+        return [tuple(record[f] for f in fields) for record in run_query(query, {'species': species})]
+
+    version = get_reactome_version()
+    logger.info('Exporting Reactome snapshot for %s (version %s)' % (species, version))
+    gene_proteins = run(GENE_PROTEIN_QUERY, ['gene_id', 'protein_id'])
+    reaction_proteins = run(REACTION_PROTEIN_QUERY, ['reaction_id', 'reaction_name', 'protein_id'])
+    reaction_compounds = run(REACTION_COMPOUND_QUERY,
+                             ['reaction_id', 'reaction_name', 'compound_id', 'display_name', 'compound_db'])
+    reaction_pathways = run(REACTION_PATHWAY_QUERY,
+                            ['reaction_id', 'reaction_name', 'pathway_id', 'pathway_name', 'metabolic'])
+
+    snapshot = ReactomeSnapshot.from_records(species, version, gene_proteins, reaction_proteins,
+                                             reaction_compounds, reaction_pathways)
+    snapshot.save(get_snapshot_path(species, snapshot_dir=out_dir))
+    return snapshot
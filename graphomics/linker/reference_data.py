@@ -0,0 +1,229 @@
+import os
+import pickle
+import sqlite3
+import threading
+
+from loguru import logger
+
+from linker.common import load_obj
+from linker.constants import EXTERNAL_REFERENCE_DATA, EXTERNAL_GENE_NAMES, EXTERNAL_COMPOUND_NAMES, \
+    EXTERNAL_KEGG_TO_CHEBI, EXTERNAL_GO_DATA
+
+# maximum number of host parameters in a single SQLite statement
+SQLITE_MAX_PARAMS = 900
+
+# the kinds of reference data in the store, each is a table of key -> pickled value
+GENE_NAMES = 'gene_names'
+COMPOUND_NAMES = 'compound_names'
+KEGG_TO_CHEBI = 'kegg_to_chebi'
+GO_ONTOLOGIES = 'go_ontologies'
+GO_ASSOCIATIONS = 'go_associations'
+GO_NAME_TO_ID = 'go_name_to_id'
+
+# the pickles used when the store hasn't been built yet
+REFERENCE_FILES = {
+    GENE_NAMES: EXTERNAL_GENE_NAMES,
+    COMPOUND_NAMES: EXTERNAL_COMPOUND_NAMES,
+    KEGG_TO_CHEBI: EXTERNAL_KEGG_TO_CHEBI,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reference_status (
+    name TEXT PRIMARY KEY,
+    num_keys INTEGER
+);
+
+CREATE TABLE IF NOT EXISTS reference (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB,
+    PRIMARY KEY (name, key)
+) WITHOUT ROWID;
+"""
+
+################################################################################
+### Connection handling                                                      ###
+################################################################################
+
+_local = threading.local()
+
+
+def get_reference_path():
+    return os.getenv('REFERENCE_DATA', EXTERNAL_REFERENCE_DATA)
+
+
+def get_mmap_size():
+    return int(os.getenv('REFERENCE_DATA_MMAP_SIZE', 1024 * 1024 * 1024))
+
+
+def get_reference_connection():
+    """
+    Returns a read-only SQLite connection to the reference data store for the current thread.
+    The file is memory-mapped, so all the processes reading it share the same pages in the OS page cache.
+    :return: a sqlite3 connection, or None if the store hasn't been built
+    """
+    filename = get_reference_path()
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(filename)
+    if conn is None:
+        if not os.path.exists(filename):
+            return None
+        uri = 'file:%s?mode=ro' % os.path.abspath(filename)
+        conn = sqlite3.connect(uri, uri=True)
+        conn.execute('PRAGMA mmap_size = %d' % get_mmap_size())
+        connections[filename] = conn
+    return conn
+
+
+def chunks(items, n=SQLITE_MAX_PARAMS):
+    items = list(items)
+    for i in range(0, len(items), n):
+        yield items[i:i + n]
+
+
+def is_built(name):
+    conn = get_reference_connection()
+    if conn is None:
+        return False
+    try:
+        return conn.execute('SELECT 1 FROM reference_status WHERE name = ?', (name,)).fetchone() is not None
+    except sqlite3.OperationalError:  # an empty file
+        return False
+
+
+################################################################################
+### Lookups                                                                  ###
+################################################################################
+
+
+def get(name, key, default=None):
+    """
+    Look up a single key of the reference data called name
+    :return: the value, or default if the key is not found
+    """
+    conn = get_reference_connection()
+    row = conn.execute('SELECT value FROM reference WHERE name = ? AND key = ?', (name, key)).fetchone()
+    if row is None:
+        return default
+    return pickle.loads(row[0])
+
+
+def get_many(name, keys):
+    """
+    Look up many keys of the reference data called name in batches
+    :param keys: the keys to look up
+    :return: a dictionary of the keys that are found to their values
+    """
+    conn = get_reference_connection()
+    results = {}
+    for chunk in chunks(set(keys)):
+        query = 'SELECT key, value FROM reference WHERE name = ? AND key IN (%s)' % ','.join('?' * len(chunk))
+        for key, value in conn.execute(query, [name] + chunk):
+            results[key] = pickle.loads(value)
+    return results
+
+
+def lookup(name, keys):
+    """
+    Look up the keys in the reference data called name, falling back to the pickle in REFERENCE_FILES
+    if the store hasn't been built
+    :return: a dictionary that contains (at least) the keys that are found to their values
+    """
+    if is_built(name):
+        return get_many(name, keys)
+    logger.warning('Reference data %s is not in %s, loading %s' % (name, get_reference_path(), REFERENCE_FILES[name]))
+    data = load_obj(REFERENCE_FILES[name])
+    return data if data is not None else {}
+
+
+_go_ontologies = None
+_go_lock = threading.Lock()
+
+
+def get_go_data(species, namespace):
+    """
+    Returns the gene ontologies, the gene associations of species in namespace, and the mapping of gene names to
+    ids of species. The ontologies are loaded once per process.
+    :raises KeyError: if there's no GO data for species or namespace
+    """
+    global _go_ontologies
+    if not is_built(GO_ONTOLOGIES):
+        logger.warning('GO data is not in %s, loading %s' % (get_reference_path(), EXTERNAL_GO_DATA))
+        go_data = load_obj(EXTERNAL_GO_DATA)
+        return go_data['ontologies'], go_data['species_associations'][species][namespace], \
+               go_data['gaf_name_to_id'][species]
+
+    with _go_lock:
+        if _go_ontologies is None:
+            _go_ontologies = get(GO_ONTOLOGIES, GO_ONTOLOGIES)
+
+    associations = get(GO_ASSOCIATIONS, get_association_key(species, namespace))
+    names_to_id = get(GO_NAME_TO_ID, species)
+    if associations is None or names_to_id is None:
+        raise KeyError(species)
+    return _go_ontologies, associations, names_to_id
+
+
+def get_association_key(species, namespace):
+    return '%s/%s' % (species, namespace)
+
+
+################################################################################
+### Building the store                                                       ###
+################################################################################
+
+
+def build_reference_data(name, data):
+    """
+    Replace the reference data called name in the store
+    :param name: the name of the reference data, e.g. GENE_NAMES
+    :param data: a dictionary of keys to values, the values are pickled
+    """
+    filename = get_reference_path()
+    out_dir = os.path.dirname(filename)
+    if len(out_dir) > 0:
+        os.makedirs(out_dir, exist_ok=True)
+
+    logger.info('Storing %d keys of %s in %s' % (len(data), name, filename))
+    conn = sqlite3.connect(filename)
+    try:
+        conn.executescript(SCHEMA)
+        with conn:
+            conn.execute('DELETE FROM reference WHERE name = ?', (name,))
+            conn.executemany('INSERT INTO reference (name, key, value) VALUES (?, ?, ?)',
+                             ((name, str(key), pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+                              for key, value in data.items()))
+            conn.execute('INSERT OR REPLACE INTO reference_status (name, num_keys) VALUES (?, ?)',
+                         (name, len(data)))
+    finally:
+        conn.close()
+
+
+def build_go_data(go_data):
+    """
+    Store the GO data created by load_initial_data.download_go(), split by species and namespace so that a lookup
+    only unpickles the associations it needs
+    """
+    associations = {}
+    for species, namespaces in go_data['species_associations'].items():
+        for namespace, species_associations in namespaces.items():
+            associations[get_association_key(species, namespace)] = species_associations
+    build_reference_data(GO_ASSOCIATIONS, associations)
+    build_reference_data(GO_NAME_TO_ID, go_data['gaf_name_to_id'])
+    # ontologies are always needed as a whole, and marked as built last
+    build_reference_data(GO_ONTOLOGIES, {GO_ONTOLOGIES: go_data['ontologies']})
+
+
+def import_pickles():
+    """
+    Build the store from the existing pickles in static/data
+    """
+    for name, filename in REFERENCE_FILES.items():
+        data = load_obj(filename)
+        if data is not None:
+            build_reference_data(name, data)
+    go_data = load_obj(EXTERNAL_GO_DATA)
+    if go_data is not None:
+        build_go_data(go_data)
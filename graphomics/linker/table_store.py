@@ -0,0 +1,142 @@
+import json
+import os
+import uuid
+
+import pandas as pd
+from django.core.files.base import ContentFile
+from loguru import logger
+
+from linker.constants import MAPPING
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # tables are kept in AnalysisData.json_data
+    pa = None
+    pq = None
+
+# the schema metadata that lists the columns stored as JSON strings
+JSON_COLUMNS_KEY = b'graphomics.json_columns'
+
+
+def use_table_store():
+    return pq is not None and os.getenv('TABLE_STORE', 'true').lower() not in ['false', '0', 'no']
+
+
+def has_table_file(analysis_data):
+    """
+    The rows of an analysis data are in its table file once it has been saved with the table store enabled.
+    A json_data that is not None takes precedence: it's either from before the table store, or new rows that
+    haven't been saved yet.
+    """
+    return analysis_data.json_data is None and bool(analysis_data.table_file)
+
+
+################################################################################
+### Writing tables                                                           ###
+################################################################################
+
+
+def store_table(analysis_data):
+    """
+    Move the rows in analysis_data.json_data to a new Parquet file in the analysis media folder, called before
+    analysis_data is saved
+    :return: the name of the previous table file, to be deleted once analysis_data is saved, or None
+    """
+    if analysis_data.json_data is None or not use_table_store():
+        return None
+
+    table = to_arrow(pd.DataFrame(analysis_data.json_data))
+    buffer = pa.BufferOutputStream()
+    pq.write_table(table, buffer)
+    previous = analysis_data.table_file.name if analysis_data.table_file else None
+    filename = '%s_%s.parquet' % (MAPPING[analysis_data.data_type], uuid.uuid4().hex)
+    analysis_data.table_file.save(filename, ContentFile(buffer.getvalue().to_pybytes()), save=False)
+    analysis_data.json_data = None
+    logger.debug('Stored %d rows of %s in %s' % (table.num_rows, analysis_data, analysis_data.table_file.name))
+    return previous
+
+
+def to_arrow(df):
+    """
+    Convert a table to Arrow, column by column. Columns with mixed types, e.g. the observed status with the 'NA' of
+    the dummy row, are stored as JSON strings so that their values are read back unchanged.
+    """
+    arrays = []
+    json_columns = []
+    for col in df.columns:
+        try:
+            arrays.append(pa.array(df[col], from_pandas=True))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            arrays.append(pa.array([json.dumps(value, default=to_json_value) for value in df[col]], type=pa.string()))
+            json_columns.append(col)
+    table = pa.Table.from_arrays(arrays, names=list(df.columns))
+    return table.replace_schema_metadata({JSON_COLUMNS_KEY: json.dumps(json_columns)})
+
+
+def to_json_value(value):
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def delete_table_file(storage, name):
+    if name and storage.exists(name):
+        storage.delete(name)
+
+
+################################################################################
+### Reading tables                                                           ###
+################################################################################
+
+
+def get_table(analysis_data, columns=None):
+    """
+    Returns the rows of analysis_data as a dataframe
+    :param columns: the columns to read, all of them if None. Only these columns are read from the table file,
+    columns that don't exist are filled with NaN.
+    """
+    if not has_table_file(analysis_data):
+        df = pd.DataFrame(analysis_data.json_data if analysis_data.json_data is not None else [])
+        return df if columns is None else df.reindex(columns=columns)
+
+    path = analysis_data.table_file.path
+    if columns is not None:
+        names = set(pq.read_schema(path).names)
+        table = pq.read_table(path, columns=[col for col in columns if col in names])
+    else:
+        table = pq.read_table(path)
+    df = table.to_pandas()
+    metadata = table.schema.metadata or {}
+    for col in json.loads(metadata.get(JSON_COLUMNS_KEY, b'[]')):
+        if col in df.columns:
+            df[col] = df[col].map(json.loads)
+    return df if columns is None else df.reindex(columns=columns)
+
+
+def get_records(analysis_data):
+    """
+    Returns the rows of analysis_data as a list of dictionaries, like the json_data it was created with.
+    Missing values are None.
+    """
+    if not has_table_file(analysis_data):
+        return analysis_data.json_data if analysis_data.json_data is not None else []
+    return to_records(get_table(analysis_data))
+
+
+def to_records(df):
+    """
+    Returns the rows of a table as a list of dictionaries to store in json_data, with None for the missing values
+    as NaN is not valid JSON
+    """
+    return df.astype(object).where(df.notnull(), None).to_dict('records')
+
+
+def get_columns(analysis_data):
+    if not has_table_file(analysis_data):
+        return list(get_table(analysis_data).columns)
+    return pq.read_schema(analysis_data.table_file.path).names
+
+
+def get_num_rows(analysis_data):
+    if not has_table_file(analysis_data):
+        return len(analysis_data.json_data) if analysis_data.json_data is not None else 0
+    return pq.read_metadata(analysis_data.table_file.path).num_rows
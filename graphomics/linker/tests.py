@@ -1,3 +1,411 @@
+import collections
+import copy
+import json
+import random
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from django.contrib.auth.models import User
 from django.test import TestCase
 
-# Create your tests here.
+from linker.constants import *
+from linker.table_store import get_table, to_records
+from linker.views import functions
+from linker.views.functions import pk_to_dataframe, merge_table, reactome_mapping, csv_to_dataframe, \
+    save_analysis, extend_analysis_data, get_last_analysis_data
+from linker.views.merge import ResultColumns, comparison_to_key
+from linker.views.relation import Relation
+
+
+class PkToDataframeTest(TestCase):
+
+    def test_missing_species_is_null(self):
+        metadata_map = {
+            'R-HSA-1': {'display_name': 'first reaction', 'species': 'Homo sapiens'},
+            'R-HSA-2': {'display_name': 'second reaction'},  # a reaction with no pathway has no species
+        }
+        observed_df = pd.DataFrame({IDENTIFIER_COL: ['R-HSA-1'], 's1': [1.5]})
+        table_df = pk_to_dataframe(REACTION_PK, 'reaction_id', ['R-HSA-1', 'R-HSA-2'], metadata_map, observed_df,
+                                   has_species=True, observed_ids=['R-HSA-1'])
+        records = json.loads(json.dumps(table_df.to_dict('records'), allow_nan=False))
+        self.assertEqual(records[1]['species'], None)
+        self.assertEqual(records[1]['s1'], None)
+        self.assertEqual(records[0]['species'], 'Homo sapiens')
+        self.assertEqual(records[-1]['species'], NA)
+
+
+class ToRecordsTest(TestCase):
+
+    def test_missing_values_are_none(self):
+        df = pd.DataFrame({'pk': ['a', 'b'], 'species': ['Homo sapiens', np.nan], 's1': [1.0, np.nan]})
+        records = to_records(df)
+        self.assertEqual(records, [{'pk': 'a', 'species': 'Homo sapiens', 's1': 1.0},
+                                   {'pk': 'b', 'species': None, 's1': None}])
+
+    def test_merge_table(self):
+        table_df = pd.DataFrame([{'obs': True, 'pk': 'a', 'label': 'A', 's1': 1.0},
+                                 {'obs': NA, 'pk': NA, 'label': NA, 's1': 0}])
+        new_df = pd.DataFrame([{'obs': False, 'pk': 'b', 'label': 'B', 's1': np.nan},
+                               {'obs': NA, 'pk': NA, 'label': NA, 's1': 0}])
+        records = merge_table(table_df, new_df, 'pk', 'label', ['b'])
+        json.dumps(records, allow_nan=False)
+        self.assertEqual([row['pk'] for row in records], ['a', 'b', NA])
+        self.assertIsNone(records[1]['s1'])
+
+
+class FakeReactome(object):
+    """
+    The mapping functions of linker.reactome on a small fixed graph, see ExtendAnalysisTest
+    """
+    GENE_2_PROTEINS = {'G1': ['P1'], 'G2': ['P2'], 'G3': ['P3']}
+    PROTEIN_2_GENES = {'P1': ['G1'], 'P2': ['G2']}  # P3 can only be reached from its gene
+    PROTEIN_2_REACTIONS = {'P1': ['R1'], 'P2': ['R2'], 'P3': ['R3']}
+    COMPOUND_2_REACTIONS = {'C1': ['R1'], 'C2': ['R2']}
+    REACTION_2_PATHWAYS = {'R1': ['W1'], 'R2': ['W2']}
+
+    def __init__(self):
+        self.queried = []
+
+    @staticmethod
+    def reverse(mapping):
+        reversed_mapping = {}
+        for key, values in mapping.items():
+            for value in values:
+                reversed_mapping.setdefault(value, []).append(key)
+        return reversed_mapping
+
+    def select(self, name, mapping, ids):
+        self.queried.extend((name, x) for x in ids)
+        return {x: mapping[x] for x in ids if x in mapping}
+
+    def ensembl_to_uniprot(self, ids, species_list):
+        return self.select('genes', self.GENE_2_PROTEINS, ids), {}
+
+    def uniprot_to_ensembl(self, ids, species_list):
+        return self.select('protein_genes', self.PROTEIN_2_GENES, ids), {}
+
+    def uniprot_to_reaction(self, ids, species_list):
+        results = self.select('proteins', self.PROTEIN_2_REACTIONS, ids)
+        return {k: [{'reaction_id': x, 'reaction_name': x} for x in v] for k, v in results.items()}, {}
+
+    def compound_to_reaction(self, ids, species_list):
+        results = self.select('compounds', self.COMPOUND_2_REACTIONS, ids)
+        return {k: [{'reaction_id': x, 'reaction_name': x} for x in v] for k, v in results.items()}, {}
+
+    def reaction_to_uniprot(self, ids, species_list):
+        return self.select('reaction_proteins', self.reverse(self.PROTEIN_2_REACTIONS), ids), {}
+
+    def reaction_to_compound(self, ids, species_list, use_kegg=False):
+        return self.select('reaction_compounds', self.reverse(self.COMPOUND_2_REACTIONS), ids), {}
+
+    def reaction_to_pathway(self, ids, species_list, metabolic_pathway_only):
+        results = self.select('reactions', self.REACTION_2_PATHWAYS, ids)
+        id_to_names = {x: {'name': x, 'species': 'Homo sapiens'} for x in ids}
+        id_to_names.update({w: {'name': w, 'species': 'Homo sapiens'} for v in results.values() for w in v})
+        return {k: [{'pathway_id': x, 'pathway_name': x} for x in v] for k, v in results.items()}, id_to_names
+
+    def patch(self):
+        names = ['ensembl_to_uniprot', 'uniprot_to_ensembl', 'uniprot_to_reaction', 'compound_to_reaction',
+                 'reaction_to_uniprot', 'reaction_to_compound', 'reaction_to_pathway']
+        patches = {name: getattr(self, name) for name in names}
+        return mock.patch.multiple(functions, lookup=lambda name, keys: {}, start_prefetch=lambda *args: None,
+                                   cluster_analysis_data=lambda data: None, **patches)
+
+
+class ExtendAnalysisTest(TestCase):
+
+    def setUp(self):
+        self.reactome = FakeReactome()
+        patcher = self.reactome.patch()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        genes_str = 'identifier,s1,s2\nG1,1.0,2.0'
+        proteins_str = 'identifier,s1,s2\nP3,5.0,6.0'  # P3 has no genes until G3 is uploaded
+        compounds_str = 'identifier,s1,s2\nC1,7.0,8.0'
+        gene_df, _ = csv_to_dataframe(genes_str)
+        protein_df, _ = csv_to_dataframe(proteins_str)
+        compound_df, _ = csv_to_dataframe(compounds_str)
+        species_list = ['Homo sapiens']
+        results = reactome_mapping(gene_df, protein_df, compound_df, COMPOUND_DATABASE_KEGG, species_list, False)
+        results['group_gene_df'] = results['group_protein_df'] = results['group_compound_df'] = None
+        user = User.objects.create(username='test')
+        self.analysis = save_analysis('test', '', genes_str, proteins_str, compounds_str, COMPOUND_DATABASE_KEGG,
+                                      results, species_list, user, False, '', '', cluster=False)
+        self.reactome.queried = []
+
+    def get_rows(self, data_type):
+        return get_table(get_last_analysis_data(self.analysis, data_type)).set_index(PKS[data_type])
+
+    def get_links(self, data_type, source_pk, target_pk):
+        links = get_table(get_last_analysis_data(self.analysis, data_type))
+        return set(zip(links[source_pk], links[target_pk]))
+
+    def test_extend(self):
+        self.assertIn((NA, 'P3'), self.get_links(GENES_TO_PROTEINS, GENE_PK, PROTEIN_PK))
+        extend_analysis_data(self.analysis, 'identifier,s1,s2\nG1,10.0,20.0\nG2,3.0,4.0\nG3,5.0,5.0', '',
+                             'identifier,s1,s2\nC2,1.0,1.0')
+
+        # only the new ids are mapped, G1 and R1 were mapped when the analysis was created
+        self.assertEqual(sorted(x for name, x in self.reactome.queried if name == 'genes'), ['G2', 'G3'])
+        self.assertNotIn(('reactions', 'R1'), self.reactome.queried)
+        self.assertIn(('reactions', 'R2'), self.reactome.queried)
+        genes = self.get_rows(GENOMICS)
+        self.assertEqual(sorted(genes.index), sorted(['G1', 'G2', 'G3', NA]))
+        self.assertIn('P2', self.get_rows(PROTEOMICS).index)
+        self.assertIn('R2', self.get_rows(REACTIONS).index)
+        self.assertIn('W2', self.get_rows(PATHWAYS).index)
+        self.assertIn(('C2', 'R2'), self.get_links(COMPOUNDS_TO_REACTIONS, COMPOUND_PK, REACTION_PK))
+
+        # the uploaded rows replace the stored rows of the same ids
+        self.assertEqual(genes.loc['G1', 's1'], 10.0)
+        self.assertEqual(genes.loc['G1', 's2'], 20.0)
+
+        # P3 was an orphan linked to NA, and is now linked to its new gene
+        links = self.get_links(GENES_TO_PROTEINS, GENE_PK, PROTEIN_PK)
+        self.assertIn(('G3', 'P3'), links)
+        self.assertNotIn((NA, 'P3'), links)
+        self.assertIn(('G2', 'P2'), links)
+
+        # the uploaded data strings record all the data
+        self.analysis.refresh_from_db()
+        genes_df, _ = csv_to_dataframe(self.analysis.metadata['genes_str'])
+        self.assertEqual(sorted(genes_df[IDENTIFIER_COL]), ['G1', 'G2', 'G3'])
+
+
+# the relations as they were before linker.views.relation, to check that Relation gives the same links
+OldRelation = collections.namedtuple('OldRelation', 'keys values mapping_list')
+
+
+def old_make_relations(mapping, source_pk, target_pk):
+    mapping_list = [{source_pk: key, target_pk: value} for key in mapping for value in mapping[key]]
+    return OldRelation(keys=list(set(mapping.keys())), values=list(set(x[target_pk] for x in mapping_list)),
+                       mapping_list=mapping_list)
+
+
+def old_merge_relation(r1, r2):
+    mapping_list = r1.mapping_list + r2.mapping_list
+    mapping_list = list(map(dict, set(map(lambda x: frozenset(x.items()), mapping_list))))
+    return OldRelation(keys=list(set(r1.keys + r2.keys)), values=list(set(r1.values + r2.values)),
+                       mapping_list=mapping_list)
+
+
+def old_reverse_relation(rel):
+    return OldRelation(keys=rel.values, values=rel.keys, mapping_list=rel.mapping_list)
+
+
+def old_add_links(relation, source_pk, target_pk, source_pk_list, target_pk_list):
+    mapping_list = list(relation.mapping_list)
+    keys = list(relation.keys)
+    values = list(relation.values)
+    for s1 in source_pk_list:
+        if s1 not in keys:
+            keys.append(s1)
+        for s2 in target_pk_list:
+            mapping_list.append({source_pk: s1, target_pk: s2})
+            if s2 not in values:
+                values.append(s2)
+    return OldRelation(keys=keys, values=values, mapping_list=mapping_list)
+
+
+def old_link_orphans(relation, source_pk, target_pk, source_ids=None, target_ids=None):
+    relation = old_add_links(relation, source_pk, target_pk, [NA], [NA])
+    if source_ids is not None:
+        orphans = [x for x in source_ids if x not in relation.keys]
+        relation = old_add_links(relation, source_pk, target_pk, orphans, [NA])
+    if target_ids is not None:
+        orphans = [x for x in target_ids if x not in relation.values]
+        relation = old_add_links(relation, source_pk, target_pk, [NA], orphans)
+    return relation
+
+
+def old_expand_relation(rel, mapping, pk_col):
+    mapping_list = []
+    for row in rel.mapping_list:
+        expanded = [dict(row, **{pk_col: rep}) for rep in mapping.get(row[pk_col], [])]
+        mapping_list.extend(expanded if len(expanded) > 0 else [row])
+    return OldRelation(keys=rel.keys, values=rel.values, mapping_list=mapping_list)
+
+
+class RelationTest(TestCase):
+
+    def random_mapping(self, rng, sources, targets):
+        return {s: rng.sample(targets, rng.randint(1, 3)) for s in rng.sample(sources, rng.randint(0, len(sources)))}
+
+    def assertSameLinks(self, relation, old, source_pk, target_pk):
+        links = set(map(lambda x: (x[source_pk], x[target_pk]), relation.mapping_list))
+        self.assertEqual(links, set(map(lambda x: (x[source_pk], x[target_pk]), old.mapping_list)))
+        self.assertEqual(len(links), len(relation))  # no duplicate links
+        self.assertEqual(set(relation.keys), set(x[source_pk] for x in old.mapping_list))
+        self.assertEqual(set(relation.values), set(x[target_pk] for x in old.mapping_list))
+
+    def test_same_as_old_relations(self):
+        rng = random.Random(0)
+        genes = ['G%d' % i for i in range(12)]
+        proteins = ['P%d' % i for i in range(10)]
+        for trial in range(20):
+            m1 = self.random_mapping(rng, genes, proteins)
+            m2 = self.random_mapping(rng, genes, proteins)
+            r1 = Relation.from_mapping(m1, GENE_PK, PROTEIN_PK)
+            r2 = Relation.from_mapping(m2, GENE_PK, PROTEIN_PK)
+            o1 = old_make_relations(m1, GENE_PK, PROTEIN_PK)
+            o2 = old_make_relations(m2, GENE_PK, PROTEIN_PK)
+            self.assertSameLinks(r1, o1, GENE_PK, PROTEIN_PK)
+
+            merged = r1.merge(r2)
+            old_merged = old_merge_relation(o1, o2)
+            self.assertSameLinks(merged, old_merged, GENE_PK, PROTEIN_PK)
+            self.assertSameLinks(merged.reverse(), old_reverse_relation(old_merged), PROTEIN_PK, GENE_PK)
+
+            source_ids = rng.sample(genes, 6)
+            target_ids = rng.sample(proteins, 6)
+            self.assertSameLinks(merged.link_orphans(NA, source_ids=source_ids, target_ids=target_ids),
+                                 old_link_orphans(old_merged, GENE_PK, PROTEIN_PK, source_ids, target_ids),
+                                 GENE_PK, PROTEIN_PK)
+            self.assertSameLinks(merged.link_orphans(NA, source_ids=source_ids),
+                                 old_link_orphans(old_merged, GENE_PK, PROTEIN_PK, source_ids),
+                                 GENE_PK, PROTEIN_PK)
+
+            # PiMP peaks, some ids have no peaks and one maps to an empty list
+            peaks = {x: ['%s_%d' % (x, i) for i in range(rng.randint(1, 3))] for x in rng.sample(genes, 5)}
+            peaks[genes[0]] = []
+            self.assertSameLinks(merged.expand(peaks, GENE_PK), old_expand_relation(old_merged, peaks, GENE_PK),
+                                 GENE_PK, PROTEIN_PK)
+            peaks = {x: ['%s_%d' % (x, i) for i in range(rng.randint(1, 3))] for x in rng.sample(proteins, 5)}
+            self.assertSameLinks(merged.expand(peaks, PROTEIN_PK),
+                                 old_expand_relation(old_merged, peaks, PROTEIN_PK), GENE_PK, PROTEIN_PK)
+
+    def test_empty(self):
+        relation = Relation.from_mapping({}, GENE_PK, PROTEIN_PK)
+        self.assertEqual(len(relation), 0)
+        self.assertEqual(relation.mapping_list, [])
+        self.assertEqual(relation.link_orphans(NA).mapping_list, [{GENE_PK: NA, PROTEIN_PK: NA}])
+        self.assertEqual(len(relation.expand({'G1': ['G1_1']}, GENE_PK)), 0)
+
+    def test_from_dicts(self):
+        mapping = {'P1': [{'reaction_id': 'R1'}, {'reaction_id': 'R2'}, {'reaction_id': 'R1'}]}
+        relation = Relation.from_mapping(mapping, PROTEIN_PK, REACTION_PK, value_key='reaction_id')
+        self.assertEqual(sorted(relation.values), ['R1', 'R2'])
+        self.assertEqual(len(relation), 2)
+
+
+# the merge functions as they were before ResultColumns, each merging the results of one history into a copy of the rows
+def old_merge_json_data(json_data, data_type, case, control, result_df):
+    new_json_data = copy.deepcopy(json_data)
+    res = result_df.to_dict()
+    label = '%s_vs_%s' % (case, control)
+    padj_label = 'padj_%s' % label
+    fc_label = 'FC_%s' % label
+    for item in new_json_data:
+        item.pop(padj_label, None)
+        item.pop(fc_label, None)
+    for item in new_json_data:
+        key = item[PKS[data_type]]
+        try:
+            padj = res['padj'][key]
+            if np.isnan(padj):
+                padj = None
+        except KeyError:
+            padj = None
+        try:
+            lfc = res['log2FoldChange'][key]
+            if np.isnan(lfc) or np.isinf(lfc):
+                lfc = None
+        except KeyError:
+            lfc = None
+        item[padj_label] = padj
+        item[fc_label] = lfc
+    return new_json_data
+
+
+def old_update_pathway_analysis_data(json_data, pathway_df):
+    new_json_data = copy.deepcopy(json_data)
+    result_cols = list(filter(lambda x: x.endswith('comb_p'), pathway_df.columns))
+    pals_df = pathway_df[result_cols]
+    pals_df = pals_df.rename(columns={col: '_'.join(col.split(' ')[0:-1]).strip() for col in pals_df.columns})
+    pals_dict = pals_df.to_dict()
+    for pathway_dict in new_json_data:
+        for comparison in pals_dict:
+            pathway_dict.pop(comparison_to_key(comparison), None)
+    for pathway_dict in new_json_data:
+        for comparison in pals_dict:
+            key = comparison_to_key(comparison)
+            try:
+                pathway_dict[key] = pals_dict[comparison][pathway_dict[PATHWAY_PK]]
+            except KeyError:
+                pathway_dict[key] = NA
+    return new_json_data
+
+
+def old_merge_json_data_mofa(json_data, data_type, history_id, view, factor, result_df):
+    new_json_data = copy.deepcopy(json_data)
+    res = result_df.to_dict()
+    d = {0: 'genes', 2: 'proteins', 3: 'compounds'}
+    weight_label = 'weight_%s_factor%s_%s' % (str(d[view]), str(factor), str(history_id))
+    for item in new_json_data:
+        item.pop(weight_label, None)
+    for item in new_json_data:
+        try:
+            weight = res[weight_label][item[PKS[data_type]]]
+            if np.isnan(weight):
+                weight = None
+        except KeyError:
+            weight = None
+        item[weight_label] = weight
+    return new_json_data
+
+
+class ResultColumnsTest(TestCase):
+
+    def comparison(self, seed):
+        rng = np.random.RandomState(seed)
+        df = pd.DataFrame({'padj': rng.rand(4), 'log2FoldChange': rng.randn(4)}, index=['G0', 'G1', 'G2', 'G9'])
+        df.iloc[1, 0] = np.nan
+        df.iloc[2, 1] = np.inf
+        return df
+
+    def assertSameRows(self, rows, old_rows):
+        # the same values, and the same key order
+        self.assertEqual([list(row.items()) for row in rows], [list(row.items()) for row in old_rows])
+
+    def test_same_as_sequential_merges(self):
+        rows = [{'obs': True, GENE_PK: 'G%d' % i, 'gene_id': 'g%d' % i, 's1': float(i)} for i in range(5)] + \
+               [{'obs': NA, GENE_PK: NA, 'gene_id': NA, 's1': 0}]
+        mofa = pd.DataFrame({'weight_genes_factor1_7': [0.5, np.nan]}, index=['G3', 'G4'])
+        histories = [
+            ('comparison', 'a', 'b', self.comparison(0)),
+            ('comparison', 'c', 'd', self.comparison(1)),
+            ('mofa', 7, 0, 1, mofa),
+            ('comparison', 'a', 'b', self.comparison(2)),  # the same label again, replaces the first one
+        ]
+
+        columns = ResultColumns()
+        old_rows = rows
+        for history in histories:
+            if history[0] == 'comparison':
+                _, case, control, result_df = history
+                columns.add_comparison(case, control, result_df)
+                old_rows = old_merge_json_data(old_rows, GENOMICS, case, control, result_df)
+            else:
+                _, history_id, view, factor, result_df = history
+                columns.add_mofa(history_id, view, factor, result_df)
+                old_rows = old_merge_json_data_mofa(old_rows, GENOMICS, history_id, view, factor, result_df)
+        merged = columns.merge(rows, GENE_PK)
+        self.assertSameRows(merged, old_rows)
+        self.assertEqual(list(merged[0].keys())[-2:], ['padj_a_vs_b', 'FC_a_vs_b'])
+        self.assertEqual(rows[0], {'obs': True, GENE_PK: 'G0', 'gene_id': 'g0', 's1': 0.0})  # not modified
+
+    def test_pathway_analysis(self):
+        rows = [{'obs': None, PATHWAY_PK: 'R-%d' % i, 'pw_name': 'p%d' % i} for i in range(4)] + \
+               [{'obs': NA, PATHWAY_PK: NA, 'pw_name': NA}]
+        first = pd.DataFrame({'a/b comb_p': [0.1, 0.2], 'c/d comb_p': [0.3, 0.4], 'pw_name': ['x', 'y']},
+                             index=['R-0', 'R-2'])
+        second = pd.DataFrame({'a/b comb_p': [0.5], 'pw_name': ['z']}, index=['R-1'])
+
+        columns = ResultColumns()
+        old_rows = rows
+        for pathway_df in [first, second]:
+            columns.add_pathway_analysis(pathway_df)
+            old_rows = old_update_pathway_analysis_data(old_rows, pathway_df)
+        self.assertSameRows(columns.merge(rows, PATHWAY_PK), old_rows)
@@ -9,6 +9,13 @@ urlpatterns = [
     path('upload_analysis', views.UploadAnalysisView.as_view(), name='upload_analysis'),
     path('delete_analysis/<int:pk>', views.DeleteAnalysisView.as_view(), name='delete_analysis'),
 
+    # analysis creation jobs
+    path('analysis_job/<int:job_id>', views.analysis_job, name='analysis_job'),
+    path('analysis_job/status/<int:job_id>', views.analysis_job_status, name='analysis_job_status'),
+    path('analysis_job/cancel/<int:job_id>', views.cancel_analysis_job, name='cancel_analysis_job'),
+    path('analysis_timings/<int:analysis_id>', views.analysis_timings, name='analysis_timings'),
+    path('analysis_timings/', views.recent_analysis_timings, name='recent_analysis_timings'),
+
     # explore data views
     path('explore_data/<int:analysis_id>', views.explore_data, name='explore_data'),
     path('get_firdi_data/<int:analysis_id>', views.get_firdi_data, name='get_firdi_data'),
@@ -61,6 +68,7 @@ urlpatterns = [
     path('settings/add_share/<int:analysis_id>', views.add_share, name='add_share'),
     path('settings/delete_share/<int:analysis_id>/<int:share_id>', views.delete_share, name='delete_share'),
     path('settings/make_public/<int:analysis_id>', views.make_public, name='make_public'),
+    path('settings/extend_analysis/<int:analysis_id>', views.extend_analysis, name='extend_analysis'),
 
     # TODO: to be removed
     path('clustergrammer_demo/', views.clustergrammer_demo, name='clustergrammer_demo'),
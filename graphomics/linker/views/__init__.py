@@ -4,4 +4,5 @@ from linker.views.explore_data_group import *
 from linker.views.inference_view import *
 from linker.views.summary_view import *
 from linker.views.settings_view import *
-from linker.views.mofa_view import *
\ No newline at end of file
+from linker.views.mofa_view import *
+from linker.views.job_view import *
@@ -1,72 +1,47 @@
+import traceback
+
 import pandas as pd
 from django.contrib import messages
-from django.shortcuts import render
+from django.core.files.storage import default_storage
+from django.shortcuts import redirect
 from django.urls import reverse_lazy
 from django.views.generic.edit import FormView, DeleteView
+from loguru import logger
 
 from linker.constants import *
 from linker.forms import CreateAnalysisForm, UploadAnalysisForm
-from linker.models import Analysis
-from linker.reactome import get_species_dict
-from linker.views.functions import reactome_mapping, save_analysis, change_column_order, get_context, csv_to_dataframe
+from linker.instrumentation import collect_timings, save_timings
+from linker.jobs import submit_job, run_pending_job, job_stage, use_jobs
+from linker.mapping_store import reuse_mapping, get_reference_version, get_mapping_key, load_mapping_result, \
+    save_mapping_result
+from linker.models import Analysis, AnalysisUpload
+from linker.reactome_catalogue import get_species_dict
+from linker.views.functions import reactome_mapping, save_analysis, change_column_order, cluster_analysis, \
+    csv_to_dataframe, get_ids_from_dataframe, clean_dataframe, get_group_dataframe
 
 
 class CreateAnalysisView(FormView):
     template_name = 'linker/create_analysis.html'
     form_class = CreateAnalysisForm
-    success_url = 'linker/explore_data.html'
 
     def form_valid(self, form):
-        analysis_name = form.cleaned_data['analysis_name']
-        analysis_desc = form.cleaned_data['analysis_description']
-        publication = form.cleaned_data['publication']
-        publication_link = form.cleaned_data['publication_link']
-        genes_str = form.cleaned_data['genes']
-        proteins_str = form.cleaned_data['proteins']
-        compounds_str = form.cleaned_data['compounds']
-        compound_database_str = form.cleaned_data['compound_database']
-        metabolic_pathway_only = form.cleaned_data['metabolic_pathway_only']
-        species_dict = get_species_dict()
-        species_list = [species_dict[x] for x in form.cleaned_data['species']]
-        current_user = self.request.user
-
-        analysis = get_data(analysis_desc, analysis_name, compounds_str,
-                            compound_database_str, current_user, genes_str, proteins_str,
-                            species_list, metabolic_pathway_only, publication, publication_link)
-        context = get_context(analysis, current_user)
-        return render(self.request, self.success_url, context)
+        parameters = get_job_parameters(form.cleaned_data)
+        parameters['genes_str'] = form.cleaned_data['genes']
+        parameters['proteins_str'] = form.cleaned_data['proteins']
+        parameters['compounds_str'] = form.cleaned_data['compounds']
+        job = submit_job(self.request.user, parameters)
+        return start_job(job)
 
 
 class UploadAnalysisView(FormView):
     template_name = 'linker/upload_analysis.html'
     form_class = UploadAnalysisForm
-    success_url = 'linker/explore_data.html'
 
     def form_valid(self, form):
-        analysis_name = form.cleaned_data['analysis_name']
-        analysis_desc = form.cleaned_data['analysis_description']
-        publication = form.cleaned_data['publication']
-        publication_link = form.cleaned_data['publication_link']
-        genes_str = get_uploaded_data(form.cleaned_data, 'gene_data', 'gene_design')
-        proteins_str = get_uploaded_data(form.cleaned_data, 'protein_data', 'protein_design')
-        compounds_str = get_uploaded_data(form.cleaned_data, 'compound_data', 'compound_design')
-        compound_database_str = form.cleaned_data['compound_database']
-        metabolic_pathway_only = form.cleaned_data['metabolic_pathway_only']
-        species_dict = get_species_dict()
-        species_list = [species_dict[x] for x in form.cleaned_data['species']]
-        current_user = self.request.user
-
-        analysis = get_data(analysis_desc, analysis_name, compounds_str,
-                            compound_database_str, current_user, genes_str, proteins_str,
-                            species_list, metabolic_pathway_only, publication, publication_link)
-
-        # save the original uploaded data too
-        analysis_upload = form.save(commit=False)
-        analysis_upload.analysis = analysis
-        analysis_upload.save()
-
-        context = get_context(analysis, current_user)
-        return render(self.request, self.success_url, context)
+        parameters = get_job_parameters(form.cleaned_data)
+        files = {key: form.cleaned_data.get(key) for key in UPLOAD_FIELDS}
+        job = submit_job(self.request.user, parameters, files=files)
+        return start_job(job)
 
 
 class DeleteAnalysisView(DeleteView):
@@ -81,32 +56,127 @@ class DeleteAnalysisView(DeleteView):
         return super(DeleteAnalysisView, self).delete(request, *args, **kwargs)
 
 
-def get_data(analysis_desc, analysis_name, compounds_str, compound_database_str,
-             current_user, genes_str, proteins_str, species_list, metabolic_pathway_only,
-             publication, publication_link):
+# the file fields of UploadAnalysisForm, saved into the AnalysisUpload of the new analysis
+UPLOAD_FIELDS = ['gene_data', 'gene_design', 'protein_data', 'protein_design', 'compound_data', 'compound_design',
+                 'mofa_data', 'metadata']
+
+
+def get_job_parameters(cleaned_data):
+    species_dict = get_species_dict()
+    metabolic_pathway_only = cleaned_data['metabolic_pathway_only']
     try:
         metabolic_pathway_only = metabolic_pathway_only.lower() in ("yes", "true", "t", "1")  # convert string to bool
     except AttributeError:
         pass
+    return {
+        'analysis_name': cleaned_data['analysis_name'],
+        'analysis_description': cleaned_data['analysis_description'],
+        'publication': cleaned_data['publication'],
+        'publication_link': cleaned_data['publication_link'],
+        'compound_database': cleaned_data['compound_database'],
+        'metabolic_pathway_only': metabolic_pathway_only,
+        'species_list': [species_dict[x] for x in cleaned_data['species']]
+    }
+
+
+def start_job(job):
+    # without background workers, the job is run in this request
+    if not use_jobs():
+        run_pending_job(job, run_analysis_job)
+    return redirect('analysis_job', job_id=job.pk)
+
+
+def run_analysis_job(job):
+    """
+    Create an analysis from the parameters of a job: parse the data, map it to Reactome, save the analysis and
+    cluster its measurements
+    """
+    parameters = job.parameters
+    compound_database_str = parameters['compound_database']
+    species_list = parameters['species_list']
+    metabolic_pathway_only = parameters['metabolic_pathway_only']
+    files = parameters.get('files')
+
+    with collect_timings() as timings:
+        with job_stage(job, JOB_STAGE_PARSE) as record:
+            if files is not None:
+                uploaded = {key: default_storage.open(files[key]) if key in files else None for key in UPLOAD_FIELDS}
+                try:
+                    genes_str, gene_dfs = get_uploaded_data(uploaded, 'gene_data', 'gene_design')
+                    proteins_str, protein_dfs = get_uploaded_data(uploaded, 'protein_data', 'protein_design')
+                    compounds_str, compound_dfs = get_uploaded_data(uploaded, 'compound_data', 'compound_design')
+                finally:
+                    for f in uploaded.values():
+                        if f is not None:
+                            f.close()
+            else:
+                genes_str = parameters['genes_str']
+                proteins_str = parameters['proteins_str']
+                compounds_str = parameters['compounds_str']
+                gene_dfs = csv_to_dataframe(genes_str)
+                protein_dfs = csv_to_dataframe(proteins_str)
+                compound_dfs = csv_to_dataframe(compounds_str)
+            record['rows'] = sum(len(dfs[0]) for dfs in (gene_dfs, protein_dfs, compound_dfs) if dfs[0] is not None)
+
+        with job_stage(job, JOB_STAGE_MAP):
+            observed_dfs = {GENOMICS: gene_dfs, PROTEOMICS: protein_dfs, METABOLOMICS: compound_dfs}
+            results = get_mapping_results(observed_dfs, compound_database_str, species_list, metabolic_pathway_only)
+
+        with job_stage(job, JOB_STAGE_PERSIST):
+            analysis = save_analysis(parameters['analysis_name'], parameters['analysis_description'],
+                                     genes_str, proteins_str, compounds_str, compound_database_str,
+                                     results, species_list, job.user, metabolic_pathway_only,
+                                     parameters['publication'], parameters['publication_link'], cluster=False)
+            job.analysis = analysis
+            job.save(update_fields=['analysis'])
+
+            # save the original uploaded data too
+            if files is not None:
+                AnalysisUpload.objects.create(analysis=analysis, **files)
+
+        with job_stage(job, JOB_STAGE_CLUSTER):
+            cluster_analysis(analysis)
+
+    save_timings(analysis, timings)
 
-    observed_gene_df, group_gene_df = csv_to_dataframe(genes_str)
-    observed_protein_df, group_protein_df = csv_to_dataframe(proteins_str)
-    observed_compound_df, group_compound_df = csv_to_dataframe(compounds_str)
+
+def get_mapping_results(observed_dfs, compound_database_str, species_list, metabolic_pathway_only):
+    """
+    Map the data of a new analysis to Reactome
+    :param observed_dfs: the parsed (data, grouping) dataframes of each data type
+    :return: the results of reactome_mapping, with the grouping dataframes
+    """
+    observed_gene_df, group_gene_df = observed_dfs[GENOMICS]
+    observed_protein_df, group_protein_df = observed_dfs[PROTEOMICS]
+    observed_compound_df, group_compound_df = observed_dfs[METABOLOMICS]
+
+    # reuse the mapping result of a previous analysis of the same ids, if there's one
+    mapping_key = None
+    mapping_result = None
+    reference_version = get_reference_version() if reuse_mapping() else None
+    if reference_version is not None:
+        mapping_key = get_mapping_key(get_ids_from_dataframe(observed_gene_df),
+                                      get_ids_from_dataframe(observed_protein_df),
+                                      get_ids_from_dataframe(observed_compound_df),
+                                      compound_database_str, species_list, metabolic_pathway_only, reference_version)
+        mapping_result = load_mapping_result(mapping_key)
 
     results = reactome_mapping(observed_gene_df, observed_protein_df, observed_compound_df,
-                               compound_database_str, species_list, metabolic_pathway_only)
+                               compound_database_str, species_list, metabolic_pathway_only,
+                               mapping_result=mapping_result)
+    if mapping_key is not None and mapping_result is None:
+        save_mapping_result(mapping_key, reference_version, results['mapping_result'])
     results['group_gene_df'] = group_gene_df
     results['group_protein_df'] = group_protein_df
     results['group_compound_df'] = group_compound_df
-
-    analysis = save_analysis(analysis_name, analysis_desc,
-                             genes_str, proteins_str, compounds_str, compound_database_str,
-                             results, species_list, current_user, metabolic_pathway_only,
-                             publication, publication_link)
-    return analysis
+    return results
 
 
 def get_uploaded_data(form_dict, data_key, design_key):
+    """
+    Read an uploaded data file and its design file once
+    :return: a tuple of the data in the csv format stored in the analysis, and the (data, grouping) dataframes
+    """
     try:
         data = pd.read_csv(form_dict[data_key])
     except ValueError:
@@ -116,13 +186,24 @@ def get_uploaded_data(form_dict, data_key, design_key):
     except ValueError:
         design = None
 
-    output_str = ''
-    if data is not None:
-        output_str = get_uploaded_str(data, design)
-    return output_str
+    if data is None:
+        return '', (None, None)
+
+    data = get_uploaded_df(data)
+    group_data = get_group_data(data.columns, design)
+    output_str = get_uploaded_str(data, group_data)
+
+    # the same dataframes as csv_to_dataframe(output_str), without parsing it again
+    try:
+        data_df = clean_dataframe(data)
+    except ValueError:
+        logger.error(traceback.format_exc())
+        return output_str, (None, None)
+    group_df = get_group_dataframe(data_df.columns.values, group_data)
+    return output_str, (data_df, group_df)
 
 
-def get_uploaded_str(data_df, design_df):
+def get_uploaded_df(data_df):
     # check if it's a PiMP peak-table export format
     if PIMP_PEAK_ID_COL in data_df.columns:
         # remove unwanted columns
@@ -131,38 +212,44 @@ def get_uploaded_str(data_df, design_df):
         to_drop = [col for col in drop_check if col in data_df.columns]
         data_df = data_df.drop(to_drop, axis=1)
         # format dataframe: each kegg compound is a row by itself
-        data_list = []
-        for i, row in data_df.iterrows():
-            compound_ids = row[PIMP_KEGG_ID_COL]
-            try:
-                for compound_id in compound_ids.split(','):
-                    if compound_id.strip().startswith('C'):
-                        row_dict = row.drop(PIMP_KEGG_ID_COL).to_dict()
-                        row_dict[IDENTIFIER_COL] = compound_id
-                        data_list.append(row_dict)
-            except TypeError:
-                continue
-            except AttributeError:
-                continue
-        data_df = pd.DataFrame(data_list)
+        data_df = explode_compound_ids(data_df)
         data_df = change_column_order(data_df, IDENTIFIER_COL, 0)  # assume it's the first column always
+    return data_df
+
+
+def get_group_data(columns, design_df):
+    """
+    Get the group of each column of an uploaded table from its design file
+    :return: the groups, starting with GROUP_COL for the id column, or None if there's no design file
+    """
+    if design_df is None:
+        return None
+    design_df.columns = design_df.columns.str.lower()
+    sample_2_group = design_df.set_index(SAMPLE_COL).to_dict()[GROUP_COL]
+    return [GROUP_COL] + [str(sample_2_group[x]) if x in sample_2_group else DEFAULT_GROUP_NAME for x in columns[1:]]
+
+
+def get_uploaded_str(data_df, group_data):
+    # convert to csv since that's what is stored in the analysis, adding the second grouping line if necessary
+    lines = data_df.to_csv(index=False).splitlines()
+    if group_data is not None:
+        lines.insert(1, ','.join(group_data))
+    return '\n'.join(lines)
+
+
+def explode_compound_ids(data_df):
+    """
+    Split the comma-separated KEGG ids of a PiMP peak table, so that each KEGG compound of a peak is a row by itself
+    in the identifier column. Peaks without KEGG compound ids are dropped.
+    """
+    compound_ids = data_df[PIMP_KEGG_ID_COL]
+    is_str = compound_ids.map(lambda x: isinstance(x, str)).astype(bool)
+    exploded = compound_ids[is_str].astype(object).str.split(',').explode()
+    exploded = exploded[exploded.str.strip().str.startswith('C')]
 
-    # convert to csv since that's what subsequent methods want, adding the second grouping line if necessary
-    data_list = data_df.to_csv(index=False).splitlines()
-    first_line = data_list[0].split(',')
-    new_data_list = []
-    new_data_list.append(','.join(first_line))
-
-    if design_df is not None:
-        design_df.columns = design_df.columns.str.lower()
-        sample_2_group = design_df.set_index(SAMPLE_COL).to_dict()[GROUP_COL]
-        second_line = [GROUP_COL] + [sample_2_group[x] if x in sample_2_group else DEFAULT_GROUP_NAME for x in
-                                     first_line[1:]]
-        new_data_list.append(','.join(second_line))
-
-    new_data_list.extend(data_list[1:])
-    data_str = '\n'.join(new_data_list)
-    return data_str
+    data_df = data_df.drop(PIMP_KEGG_ID_COL, axis=1).loc[exploded.index]
+    data_df[IDENTIFIER_COL] = exploded.values
+    return data_df.reset_index(drop=True)
 
 
 def get_unique_items(mapping):
@@ -1,9 +1,10 @@
 import collections
+import json
 
 import pandas as pd
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.exceptions import PermissionDenied
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
@@ -12,13 +13,14 @@ from loguru import logger
 from linker.constants import *
 from linker.metadata import get_single_ensembl_metadata_online, get_single_uniprot_metadata_online, \
     get_single_compound_metadata_online
-from linker.models import Analysis, AnalysisAnnotation, AnalysisHistory
+from linker.models import Analysis, AnalysisAnnotation, AnalysisHistory, AnalysisData, AnalysisPayload
 from linker.reactome import get_reactome_description, get_reaction_entities, pathway_to_reactions
+from linker.table_store import get_table, get_columns
 from linker.views.functions import change_column_order, recur_dictify, get_context, \
     get_last_data, get_last_analysis_data
 from .mofa_view import build_mofa_init_context
 from .harmonizomeapi import Harmonizome, Entity
-from .merge import merge_json_data, update_pathway_analysis_data, merge_json_data_mofa
+from .firdi_payload import get_payload
 from ..common import access_allowed
 
 
@@ -59,61 +61,42 @@ def clustergrammer_demo(request):
 def get_firdi_data(request, analysis_id):
     if request.is_ajax():
         analysis = get_object_or_404(Analysis, pk=analysis_id)
+
+        # the latest analysis data of each type by timestamp, the rows are only loaded if a payload must be built
+        analysis_data_list = {}
+        for analysis_data in AnalysisData.objects.filter(analysis=analysis).defer('json_data').order_by('-timestamp'):
+            analysis_data_list.setdefault(analysis_data.data_type, analysis_data)
+        payloads = {payload.analysis_data_id: payload for payload in
+                    AnalysisPayload.objects.filter(analysis_data__analysis=analysis)}
+        history_ids = collections.defaultdict(list)
+        for analysis_data_id, history_id in AnalysisHistory.objects.filter(analysis_data__analysis=analysis).order_by(
+                'timestamp', 'pk').values_list('analysis_data_id', 'pk'):  # ascending
+            history_ids[analysis_data_id].append(history_id)
+
         table_data = {}
         data_fields = {}
-        a = None
         for k, v in DataRelationType:
+            if k not in analysis_data_list:
+                continue
+            analysis_data = analysis_data_list[k]
             try:
-                # get the latest analysis data by timestamp
-                analysis_data = get_last_data(analysis, k)
-                json_data = analysis_data.json_data
-                data_type = analysis_data.data_type
-
-                # merge analysis histories, if any
-                analysis_histories = AnalysisHistory.objects.filter(analysis_data=analysis_data).order_by(
-                    'timestamp')  # ascending
-                for history in analysis_histories:
-                    inference_type = history.inference_type
-                    inference_data = history.inference_data
-                    if inference_type in [INFERENCE_LOADED, INFERENCE_T_TEST, INFERENCE_DESEQ, INFERENCE_LIMMA]:
-                        logger.debug('Merging %s' % history)
-                        case = inference_data['case']
-                        control = inference_data['control']
-                        result_df = pd.read_json(inference_data['result_df'])
-                        json_data = merge_json_data(json_data, data_type, case, control, result_df)
-                    elif inference_type in [INFERENCE_PALS, INFERENCE_ORA, INFERENCE_GSEA, INFERENCE_REACTOME]:
-                        logger.debug('Merging %s' % history)
-                        result_df = pd.read_json(inference_data['result_df'])
-                        json_data = update_pathway_analysis_data(json_data, result_df)
-                    elif inference_type == INFERENCE_MOFA:
-                        logger.debug('Merging %s' % history)
-                        try:
-                            view = inference_data['view']
-                            factor = inference_data['factor']
-                            history_id = inference_data['history_id']
-                            result_df = pd.read_json(inference_data['result_df'])
-                        except:
-                            continue
-                        json_data = merge_json_data_mofa(json_data, data_type, history_id, view, factor, result_df)
-
+                # the rows merged with the analysis histories, if any
                 label = MAPPING[k]
-                table_data[label] = json_data
+                table_data[label] = get_payload(analysis_data, history_ids[analysis_data.pk],
+                                                payloads.get(analysis_data.pk))
 
                 # also load json design, if any
                 if analysis_data.json_design:
                     data_fields[TABLE_IDS[k]] = list(set(pd.DataFrame(analysis_data.json_design)[SAMPLE_COL]))
 
-            except IndexError:
-                continue
             except KeyError:
                 continue
 
-        data = {
-            'tableData': table_data,
-            'tableFields': data_fields,
-        }
-
-        return JsonResponse(data)
+        # the payloads are already JSON
+        content = '{"tableData": {%s}, "tableFields": %s}' % (
+            ', '.join('%s: %s' % (json.dumps(label), payload) for label, payload in table_data.items()),
+            json.dumps(data_fields))
+        return HttpResponse(content, content_type='application/json')
 
 
 def get_heatmap_data(request, analysis_id):
@@ -644,31 +627,36 @@ def get_grouped_measurements(analysis_id, database_id, data_type, peak_id=None):
     if analysis_data.json_design is None:
         return None
 
+    if peak_id:
+        search = '%s_%s' % (database_id, peak_id)
+    else:
+        search = database_id
+
+    # find the row by its ids first, then read only its measurement columns
+    columns = get_columns(analysis_data)
+    key_cols = [key for key in columns if '_id' in key or '_pk' in key]
+    found = get_table(analysis_data, columns=key_cols).eq(search).any(axis=1).values
+    if not found.any():
+        return None
+
     exclude_colnames = ['obs', '_pk', '_id', 'significant_', 'padj_', 'FC_']
-    for row in analysis_data.json_data:
-        for key in row.keys():
-            if '_id' in key or '_pk' in key:
-                if peak_id:
-                    search = '%s_%s' % (database_id, peak_id)
-                else:
-                    search = database_id
-                if row[key] == search:  # if found
-                    # filter this row to remove exclude_colnames
-                    filtered_data = filter_dict(row, exclude_colnames)
-                    # check if there's some measurements (not all entries are None)
-                    if not all(v is None for v in list(filtered_data.values())):
-                        # then merge with the design matrix
-                        filtered_df = pd.DataFrame([filtered_data]).astype(float)
-                        design_df = pd.DataFrame(analysis_data.json_design)
-                        merged_df = pd.merge(filtered_df.transpose(), design_df, left_index=True, right_on=SAMPLE_COL)
-                        # put the columns in the right order, then return as dictionary
-                        merged_df = change_column_order(merged_df, GROUP_COL, 0)
-                        merged_df = change_column_order(merged_df, SAMPLE_COL, 1)
-                        merged_dict = recur_dictify(merged_df)
-                        return merged_dict
-                    else:
-                        return None
-    return None
+    measurement_cols = [key for key in columns if all(substring not in key for substring in exclude_colnames)]
+    row = get_table(analysis_data, columns=measurement_cols)[found].iloc[0].astype(object)
+    filtered_data = row.where(row.notnull(), None).to_dict()
+
+    # check if there's some measurements (not all entries are None)
+    if all(v is None for v in list(filtered_data.values())):
+        return None
+
+    # then merge with the design matrix
+    filtered_df = pd.DataFrame([filtered_data]).astype(float)
+    design_df = pd.DataFrame(analysis_data.json_design)
+    merged_df = pd.merge(filtered_df.transpose(), design_df, left_index=True, right_on=SAMPLE_COL)
+    # put the columns in the right order, then return as dictionary
+    merged_df = change_column_order(merged_df, GROUP_COL, 0)
+    merged_df = change_column_order(merged_df, SAMPLE_COL, 1)
+    merged_dict = recur_dictify(merged_df)
+    return merged_dict
 
 
 def filter_dict(my_dict, exclude_keys):
@@ -0,0 +1,108 @@
+import json
+import uuid
+
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from loguru import logger
+
+from linker.constants import *
+from linker.inference_store import load_dataframe
+from linker.models import AnalysisHistory, AnalysisPayload
+from linker.table_store import get_records, delete_table_file
+from linker.views.merge import ResultColumns
+
+
+def get_payload(analysis_data, history_ids, payload=None):
+    """
+    Returns the rows of analysis_data merged with the results of its analysis histories, as a JSON string.
+    The stored payload is used as it is when no histories have been added or deleted since it was stored. When
+    histories have only been added, just the new ones are merged into it. Otherwise it's rebuilt from all of them.
+    :param history_ids: the ids of the analysis histories of analysis_data, ordered by timestamp
+    :param payload: the AnalysisPayload stored for analysis_data, or None
+    """
+    content = read_payload(payload) if payload is not None else None
+    if content is not None and payload.history_ids == history_ids:
+        return content
+
+    if content is not None and payload.history_ids == history_ids[:len(payload.history_ids)]:
+        logger.debug('Updating the payload of %s' % analysis_data)
+        json_data = json.loads(content)
+        new_ids = history_ids[len(payload.history_ids):]
+    else:
+        logger.debug('Building the payload of %s' % analysis_data)
+        json_data = get_records(analysis_data)
+        new_ids = history_ids
+
+    # collect the results of all the new histories, then merge them into the rows at once
+    histories = AnalysisHistory.objects.in_bulk(new_ids)
+    columns = ResultColumns()
+    for history_id in new_ids:
+        if history_id in histories:  # unless it has just been deleted
+            add_history_columns(columns, histories[history_id])
+    if len(columns.columns) > 0:
+        json_data = columns.merge(json_data, PKS[analysis_data.data_type])
+
+    content = json.dumps(json_data, cls=DjangoJSONEncoder)
+    store_payload(analysis_data, history_ids, content, payload)
+    return content
+
+
+def read_payload(payload):
+    """
+    Returns the JSON string in the payload file, or None if there is none, e.g. when it has been deleted
+    """
+    if not payload.payload_file:
+        return None
+    try:
+        with payload.payload_file.open('rb') as f:
+            return f.read().decode('utf-8')
+    except OSError as e:
+        logger.warning('Failed to read the payload of %s: %s' % (payload.analysis_data_id, e))
+        return None
+
+
+def store_payload(analysis_data, history_ids, content, payload=None):
+    """
+    Write the JSON string to a new payload file next to the table file of analysis_data, then delete the previous one
+    :param payload: the AnalysisPayload stored for analysis_data, or None
+    """
+    if payload is None:
+        payload = AnalysisPayload(analysis_data=analysis_data)
+    previous = payload.payload_file.name if payload.payload_file else None
+    filename = '%s_payload_%s.json' % (MAPPING[analysis_data.data_type], uuid.uuid4().hex)
+    payload.payload_file.save(filename, ContentFile(content.encode('utf-8')), save=False)
+    payload.history_ids = history_ids
+    payload.timestamp = timezone.localtime()
+    payload.save()
+    if previous is not None and previous != payload.payload_file.name:
+        delete_table_file(payload.payload_file.storage, previous)
+
+
+def add_history_columns(columns, history):
+    """
+    Add the results of an analysis history to the columns to merge into the rows of its analysis data
+    :param columns: a ResultColumns
+    """
+    inference_type = history.inference_type
+    inference_data = history.inference_data
+    if inference_type in [INFERENCE_LOADED, INFERENCE_T_TEST, INFERENCE_DESEQ, INFERENCE_LIMMA]:
+        logger.debug('Merging %s' % history)
+        case = inference_data['case']
+        control = inference_data['control']
+        result_df = load_dataframe(inference_data, 'result_df')
+        columns.add_comparison(case, control, result_df)
+    elif inference_type in [INFERENCE_PALS, INFERENCE_ORA, INFERENCE_GSEA, INFERENCE_REACTOME]:
+        logger.debug('Merging %s' % history)
+        result_df = load_dataframe(inference_data, 'result_df')
+        columns.add_pathway_analysis(result_df)
+    elif inference_type == INFERENCE_MOFA:
+        logger.debug('Merging %s' % history)
+        try:
+            view = inference_data['view']
+            factor = inference_data['factor']
+            history_id = inference_data['history_id']
+            result_df = load_dataframe(inference_data, 'result_df')
+        except:
+            return
+        columns.add_mofa(history_id, view, factor, result_df)
@@ -1,4 +1,3 @@
-import collections
 import json
 import re
 import traceback
@@ -9,34 +8,191 @@ import numpy as np
 import pandas as pd
 import plotly.offline as opy
 from clustergrammer import Network
-from django.conf import settings
+from django.db import transaction
 from django.urls import reverse
 from django.utils import timezone
 from loguru import logger
 
 
-from linker.common import load_obj
 from linker.constants import *
+from linker.dependency_graph import Stage, run_stages
+from linker.inference_store import store_artifacts
+from linker.instrumentation import timed
 from linker.metadata import get_gene_names, get_compound_metadata, clean_label
 from linker.models import Analysis, AnalysisData, Share, AnalysisHistory
 from linker.reactome import ensembl_to_uniprot, uniprot_to_reaction, compound_to_reaction, \
     reaction_to_pathway, reaction_to_uniprot, reaction_to_compound, uniprot_to_ensembl
-from linker.reactome import get_reaction_df
+from linker.reactome import get_reaction_df, start_prefetch
+from linker.reference_data import lookup, GENE_NAMES, COMPOUND_NAMES, KEGG_TO_CHEBI
+from linker.table_store import get_table, get_num_rows, to_records, delete_table_file
 from linker.views.pipelines import GraphOmicsInference
+from linker.views.relation import Relation
 
-Relation = collections.namedtuple('Relation', 'keys values mapping_list')
+# the relations in a mapping result: (name, source_pk, target_pk)
+MAPPING_RELATIONS = [
+    ('gene_2_proteins', GENE_PK, PROTEIN_PK),
+    ('protein_2_reactions', PROTEIN_PK, REACTION_PK),
+    ('compound_2_reactions', COMPOUND_PK, REACTION_PK),
+    ('reaction_2_pathways', REACTION_PK, PATHWAY_PK),
+]
 
 
 def reactome_mapping(observed_gene_df, observed_protein_df, observed_compound_df,
-                     compound_database_str, species_list, metabolic_pathway_only):
+                     compound_database_str, species_list, metabolic_pathway_only, mapping_result=None):
+    """
+    Map the uploaded data to Reactome and build the tables and relations of a new analysis
+    :param mapping_result: the stored mapping result of the same ids, if any, so Reactome isn't queried
+    :return: a dictionary of data type to its table or relation, and the mapping result under 'mapping_result'
+    """
     ### all the ids that we have from the user ###
     observed_gene_ids = get_ids_from_dataframe(observed_gene_df)
     observed_protein_ids = get_ids_from_dataframe(observed_protein_df)
+    observed_compound_ids = convert_compound_ids(observed_compound_df, compound_database_str)
+
+    if mapping_result is None:
+        with timed('map_reactome_ids') as record:
+            mapping_result = map_reactome_ids(observed_gene_ids, observed_protein_ids, observed_compound_ids,
+                                              compound_database_str, species_list, metabolic_pathway_only)
+            record['rows'] = sum(len(relation[0]) for relation in mapping_result['relations'].values())
+    ids = mapping_result['ids']
+    relations = {name: Relation(source_pk, target_pk, *mapping_result['relations'][name])
+                 for name, source_pk, target_pk in MAPPING_RELATIONS}
+
+    with timed('build_tables') as record:
+        metadata_map = mapping_result['metadata']['genes']
+        genes_df = pk_to_dataframe(GENE_PK, 'gene_id', ids['genes'], metadata_map, observed_gene_df,
+                                   observed_ids=observed_gene_ids)
+
+        # metadata_map = get_uniprot_metadata_online(uniprot_ids)
+        proteins_df = pk_to_dataframe('protein_pk', 'protein_id', ids['proteins'], metadata_map, observed_protein_df,
+                                      observed_ids=observed_protein_ids)
+
+        # TODO: this feels like a very bad way to implement this
+        # We need to deal with uploaded peak data from PiMP, which contains a lot of duplicate identifications per peak
+        metadata_map = mapping_result['metadata']['compounds']
+        try:
+            mapping = get_mapping(observed_compound_df)
+        except KeyError:
+            mapping = None
+        except AttributeError:
+            mapping = None
+        compounds_df = pk_to_dataframe('compound_pk', 'compound_id', ids['compounds'], metadata_map,
+                                       observed_compound_df, observed_ids=observed_compound_ids, mapping=mapping)
+        compound_2_reactions = relations['compound_2_reactions']
+        if mapping:
+            compound_2_reactions = expand_relation(compound_2_reactions, mapping, 'compound_pk')
+
+        metadata_map = mapping_result['metadata']['reactome']
+
+        reaction_count_df = None
+        pathway_count_df = None
+
+        reaction_ids = ids['reactions']
+        pathway_ids = ids['pathways']
+        reactions_df = pk_to_dataframe('reaction_pk', 'reaction_id', reaction_ids, metadata_map, reaction_count_df,
+                                       has_species=True)
+        pathways_df = pk_to_dataframe('pathway_pk', 'pathway_id', pathway_ids, metadata_map, pathway_count_df,
+                                      has_species=True)
+        record['rows'] = len(genes_df) + len(proteins_df) + len(compounds_df) + len(reactions_df) + len(pathways_df)
+
+    # warm the local index for the reaction and pathway info panels while the analysis is being saved
+    start_prefetch([x for x in reaction_ids if x != NA], [x for x in pathway_ids if x != NA])
+
+    # the entity tables are dataframes and the relations are lists of links, both are saved as they are
+    results = {
+        GENOMICS: genes_df,
+        PROTEOMICS: proteins_df,
+        METABOLOMICS: compounds_df,
+        REACTIONS: reactions_df,
+        PATHWAYS: pathways_df,
+        GENES_TO_PROTEINS: relations['gene_2_proteins'].mapping_list,
+        PROTEINS_TO_REACTIONS: relations['protein_2_reactions'].mapping_list,
+        COMPOUNDS_TO_REACTIONS: compound_2_reactions.mapping_list,
+        REACTIONS_TO_PATHWAYS: relations['reaction_2_pathways'].mapping_list,
+        'mapping_result': mapping_result
+    }
+    return results
+
+
+def map_reactome_ids(observed_gene_ids, observed_protein_ids, observed_compound_ids,
+                     compound_database_str, species_list, metabolic_pathway_only):
+    """
+    Query Reactome for the relations of the observed ids. The results only depend on the ids, not on the
+    measurements, so they can be stored and reused by other analyses of the same ids.
+    :return: a mapping result, a JSON-serialisable dictionary of the relations (as lists of sources and targets),
+    the ids and the metadata of each entity type
+    """
+    if compound_database_str == COMPOUND_DATABASE_KEGG:
+        use_kegg = True
+    else:
+        use_kegg = False
+
+    stage_results = query_reactome(observed_gene_ids, observed_protein_ids, observed_compound_ids,
+                                   species_list, metabolic_pathway_only, use_kegg)
+    reaction_ids = stage_results['reaction_ids']
+    reaction_2_pathways, reaction_2_pathways_id_to_names = stage_results['reaction_2_pathways']
+    reaction_2_compounds, reaction_to_compound_id_to_names = stage_results['reaction_2_compounds']
+
+    protein_2_reactions = merge_relation(stage_results['protein_2_reactions'],
+                                         reverse_relation(stage_results['reaction_2_proteins']))
+    all_protein_ids = protein_2_reactions.keys
+
+    compound_2_reactions = merge_relation(stage_results['compound_2_reactions'], reverse_relation(reaction_2_compounds))
+    all_compound_ids = compound_2_reactions.keys
+
+    gene_2_proteins = merge_relation(stage_results['gene_2_proteins'],
+                                     reverse_relation(stage_results['protein_2_genes']))
+    all_gene_ids = gene_2_proteins.keys
+
+    ### add links ###
+
+    # map NA to NA, and map the entities that have no links on the other side of each relation to NA,
+    # e.g. genes that have no proteins and proteins that have no genes
+    gene_2_proteins = gene_2_proteins.link_orphans(NA, source_ids=all_gene_ids, target_ids=all_protein_ids)
+    protein_2_reactions = protein_2_reactions.link_orphans(NA, source_ids=all_protein_ids, target_ids=reaction_ids)
+    compound_2_reactions = compound_2_reactions.link_orphans(NA, source_ids=all_compound_ids, target_ids=reaction_ids)
+    reaction_2_pathways = reaction_2_pathways.link_orphans(NA, source_ids=reaction_ids)
+
+    GTF_DICT = lookup(GENE_NAMES, all_gene_ids)
+    KEGG_ID_2_DISPLAY_NAMES = lookup(COMPOUND_NAMES, all_compound_ids)
+    mapping_result = {
+        'relations': {
+            'gene_2_proteins': relation_to_lists(gene_2_proteins),
+            'protein_2_reactions': relation_to_lists(protein_2_reactions),
+            'compound_2_reactions': relation_to_lists(compound_2_reactions),
+            'reaction_2_pathways': relation_to_lists(reaction_2_pathways),
+        },
+        'ids': {
+            'genes': all_gene_ids,
+            'proteins': all_protein_ids,
+            'compounds': all_compound_ids,
+            'reactions': reaction_ids,
+            'pathways': reaction_2_pathways.values,
+        },
+        'metadata': {
+            'genes': get_gene_names(all_gene_ids, GTF_DICT),
+            'compounds': get_compound_metadata(all_compound_ids, KEGG_ID_2_DISPLAY_NAMES,
+                                               reaction_to_compound_id_to_names),
+            'reactome': get_reactome_metadata(reaction_2_pathways_id_to_names),
+        }
+    }
+    return mapping_result
 
+
+def relation_to_lists(relation):
+    return [relation.sources.tolist(), relation.targets.tolist()]
+
+
+def convert_compound_ids(observed_compound_df, compound_database_str):
+    """
+    Convert the kegg ids in the first column of observed_compound_df to chebi ids (in place) when
+    compounds are queried by chebi ids
+    :return: the observed compound ids
+    """
     # try to convert all kegg ids to chebi ids, if possible
     logger.info('Converting kegg ids -> chebi ids')
     observed_compound_ids = get_ids_from_dataframe(observed_compound_df)
-    KEGG_2_CHEBI = load_obj(settings.EXTERNAL_KEGG_TO_CHEBI)
+    KEGG_2_CHEBI = lookup(KEGG_TO_CHEBI, observed_compound_ids)
     for cid in observed_compound_ids:
         if cid not in KEGG_2_CHEBI:
             logger.warning('Not found: %s' % cid)
@@ -47,170 +203,109 @@ def reactome_mapping(observed_gene_df, observed_protein_df, observed_compound_df
             observed_compound_df.iloc[:, 0] = observed_compound_df.iloc[:, 0].map(
                 KEGG_2_CHEBI)  # assume 1st column is id
         observed_compound_ids = get_ids_from_dataframe(observed_compound_df)
-
-    ### map genes -> proteins ###
-    logger.info('Mapping genes -> proteins')
-    gene_2_proteins_mapping, _ = ensembl_to_uniprot(observed_gene_ids, species_list)
-    gene_2_proteins = make_relations(gene_2_proteins_mapping, GENE_PK, PROTEIN_PK, value_key=None)
-
-    ### maps proteins -> reactions ###
-    logger.info('Mapping proteins -> reactions')
-    protein_ids_from_genes = gene_2_proteins.values
-    known_protein_ids = list(set(observed_protein_ids + protein_ids_from_genes))
-    protein_2_reactions_mapping, _ = uniprot_to_reaction(known_protein_ids, species_list)
-    protein_2_reactions = make_relations(protein_2_reactions_mapping, PROTEIN_PK, REACTION_PK,
-                                         value_key='reaction_id')
-
-    ### maps compounds -> reactions ###
-    logger.info('Mapping compounds -> reactions')
-    compound_2_reactions_mapping, _ = compound_to_reaction(observed_compound_ids, species_list)
-    compound_2_reactions = make_relations(compound_2_reactions_mapping, COMPOUND_PK, REACTION_PK,
-                                          value_key='reaction_id')
-
-    ### maps reactions -> metabolite pathways ###
-    logger.info('Mapping reactions -> metabolite pathways')
-    reaction_ids_from_proteins = protein_2_reactions.values
-    reaction_ids_from_compounds = compound_2_reactions.values
-    reaction_ids = list(set(reaction_ids_from_proteins + reaction_ids_from_compounds))
-    reaction_2_pathways_mapping, reaction_2_pathways_id_to_names = reaction_to_pathway(reaction_ids,
-                                                                                       species_list,
-                                                                                       metabolic_pathway_only)
-    reaction_2_pathways = make_relations(reaction_2_pathways_mapping, REACTION_PK, PATHWAY_PK,
-                                         value_key='pathway_id')
-
-    ### maps reactions -> proteins ###
-    logger.info('Mapping reactions -> proteins')
-    mapping, _ = reaction_to_uniprot(reaction_ids, species_list)
-    reaction_2_proteins = make_relations(mapping, REACTION_PK, PROTEIN_PK, value_key=None)
-    protein_2_reactions = merge_relation(protein_2_reactions, reverse_relation(reaction_2_proteins))
-    all_protein_ids = protein_2_reactions.keys
-
-    ### maps reactions -> compounds ###
-    logger.info('Mapping reactions -> compounds')
-    if compound_database_str == COMPOUND_DATABASE_KEGG:
-        use_kegg = True
-    else:
-        use_kegg = False
-    reaction_2_compounds_mapping, reaction_to_compound_id_to_names = reaction_to_compound(reaction_ids, species_list,
-                                                                                          use_kegg)
-    reaction_2_compounds = make_relations(reaction_2_compounds_mapping, REACTION_PK, COMPOUND_PK, value_key=None)
-    compound_2_reactions = merge_relation(compound_2_reactions, reverse_relation(reaction_2_compounds))
-    all_compound_ids = compound_2_reactions.keys
-
-    ### map proteins -> genes ###
-    logger.info('Mapping proteins -> genes')
-    mapping, _ = uniprot_to_ensembl(all_protein_ids, species_list)
-    protein_2_genes = make_relations(mapping, PROTEIN_PK, GENE_PK, value_key=None)
-    gene_2_proteins = merge_relation(gene_2_proteins, reverse_relation(protein_2_genes))
-    all_gene_ids = gene_2_proteins.keys
-
-    ### add links ###
-
-    # map NA to NA
-    gene_2_proteins = add_links(gene_2_proteins, GENE_PK, PROTEIN_PK, [NA], [NA])
-    protein_2_reactions = add_links(protein_2_reactions, PROTEIN_PK, REACTION_PK, [NA], [NA])
-    compound_2_reactions = add_links(compound_2_reactions, COMPOUND_PK, REACTION_PK, [NA], [NA])
-    reaction_2_pathways = add_links(reaction_2_pathways, REACTION_PK, PATHWAY_PK, [NA], [NA])
-
-    # map genes that have no proteins to NA
-    gene_pk_list = [x for x in all_gene_ids if x not in gene_2_proteins.keys]
-    gene_2_proteins = add_links(gene_2_proteins, GENE_PK, PROTEIN_PK, gene_pk_list, [NA])
-
-    # map proteins that have no genes to NA
-    protein_pk_list = [x for x in all_protein_ids if x not in gene_2_proteins.values]
-    gene_2_proteins = add_links(gene_2_proteins, GENE_PK, PROTEIN_PK, [NA], protein_pk_list)
-
-    # map proteins that have no reactions to NA
-    protein_pk_list = [x for x in all_protein_ids if x not in protein_2_reactions.keys]
-    protein_2_reactions = add_links(protein_2_reactions, PROTEIN_PK, REACTION_PK, protein_pk_list, [NA])
-
-    # map reactions that have no proteins to NA
-    reaction_pk_list = [x for x in reaction_ids if x not in protein_2_reactions.values]
-    protein_2_reactions = add_links(protein_2_reactions, PROTEIN_PK, REACTION_PK, [NA], reaction_pk_list)
-
-    # map compounds that have no reactions to NA
-    compound_pk_list = [x for x in all_compound_ids if x not in compound_2_reactions.keys]
-    compound_2_reactions = add_links(compound_2_reactions, COMPOUND_PK, REACTION_PK, compound_pk_list, [NA])
-
-    # map reactions that have no compounds to NA
-    reaction_pk_list = [x for x in reaction_ids if x not in compound_2_reactions.values]
-    compound_2_reactions = add_links(compound_2_reactions, COMPOUND_PK, REACTION_PK, [NA], reaction_pk_list)
-
-    # map reactions that have no pathways to NA
-    reaction_pk_list = [x for x in reaction_ids if x not in reaction_2_pathways.keys]
-    reaction_2_pathways = add_links(reaction_2_pathways, REACTION_PK, PATHWAY_PK, reaction_pk_list, [NA])
-
-    GTF_DICT = load_obj(settings.EXTERNAL_GENE_NAMES)
-    metadata_map = get_gene_names(all_gene_ids, GTF_DICT)
-    genes_json = pk_to_json(GENE_PK, 'gene_id', all_gene_ids, metadata_map, observed_gene_df,
-                            observed_ids=observed_gene_ids)
-    gene_2_proteins_json = json.dumps(gene_2_proteins.mapping_list)
-
-    # metadata_map = get_uniprot_metadata_online(uniprot_ids)
-    proteins_json = pk_to_json('protein_pk', 'protein_id', all_protein_ids, metadata_map, observed_protein_df,
-                               observed_ids=observed_protein_ids)
-    protein_2_reactions_json = json.dumps(protein_2_reactions.mapping_list)
-
-    # TODO: this feels like a very bad way to implement this
-    # We need to deal with uploaded peak data from PiMP, which contains a lot of duplicate identifications per peak
-    KEGG_ID_2_DISPLAY_NAMES = load_obj(settings.EXTERNAL_COMPOUND_NAMES)
-    metadata_map = get_compound_metadata(all_compound_ids, KEGG_ID_2_DISPLAY_NAMES, reaction_to_compound_id_to_names)
-    try:
-        mapping = get_mapping(observed_compound_df)
-    except KeyError:
-        mapping = None
-    except AttributeError:
-        mapping = None
-    compounds_json = pk_to_json('compound_pk', 'compound_id', all_compound_ids, metadata_map, observed_compound_df,
-                                observed_ids=observed_compound_ids, mapping=mapping)
-    if mapping:
-        compound_2_reactions = expand_relation(compound_2_reactions, mapping, 'compound_pk')
-    compound_2_reactions_json = json.dumps(compound_2_reactions.mapping_list)
-
+    return observed_compound_ids
+
+
+def query_reactome(observed_gene_ids, observed_protein_ids, observed_compound_ids,
+                   species_list, metabolic_pathway_only, use_kegg, mapped=None):
+    """
+    Query Reactome for the relations of the observed ids, running the stages that don't depend on each other
+    concurrently
+    :param mapped: when extending an analysis, the ids that have been queried before: a dictionary with the sets of
+    'proteins' mapped to reactions, 'reactions' mapped to pathways, proteins and compounds, and 'protein_genes' mapped
+    to genes. These are not queried again, so only the relations of the new ids are returned.
+    :return: a dictionary of stage name to its results
+    """
+    if mapped is None:
+        mapped = {'proteins': set(), 'reactions': set(), 'protein_genes': set()}
+
+    def map_genes_to_proteins():
+        logger.info('Mapping genes -> proteins')
+        mapping, _ = ensembl_to_uniprot(observed_gene_ids, species_list)
+        return make_relations(mapping, GENE_PK, PROTEIN_PK, value_key=None)
+
+    def map_proteins_to_reactions(gene_2_proteins):
+        logger.info('Mapping proteins -> reactions')
+        protein_ids_from_genes = gene_2_proteins.values
+        known_protein_ids = list(set(observed_protein_ids + protein_ids_from_genes) - mapped['proteins'])
+        mapping, _ = uniprot_to_reaction(known_protein_ids, species_list)
+        return make_relations(mapping, PROTEIN_PK, REACTION_PK, value_key='reaction_id')
+
+    def map_compounds_to_reactions():
+        logger.info('Mapping compounds -> reactions')
+        mapping, _ = compound_to_reaction(observed_compound_ids, species_list)
+        return make_relations(mapping, COMPOUND_PK, REACTION_PK, value_key='reaction_id')
+
+    def collect_reaction_ids(protein_2_reactions, compound_2_reactions):
+        reaction_ids_from_proteins = protein_2_reactions.values
+        reaction_ids_from_compounds = compound_2_reactions.values
+        return list(set(reaction_ids_from_proteins + reaction_ids_from_compounds) - mapped['reactions'])
+
+    def map_reactions_to_pathways(reaction_ids):
+        logger.info('Mapping reactions -> metabolite pathways')
+        mapping, id_to_names = reaction_to_pathway(reaction_ids, species_list, metabolic_pathway_only)
+        return make_relations(mapping, REACTION_PK, PATHWAY_PK, value_key='pathway_id'), id_to_names
+
+    def map_reactions_to_proteins(reaction_ids):
+        logger.info('Mapping reactions -> proteins')
+        mapping, _ = reaction_to_uniprot(reaction_ids, species_list)
+        return make_relations(mapping, REACTION_PK, PROTEIN_PK, value_key=None)
+
+    def map_reactions_to_compounds(reaction_ids):
+        logger.info('Mapping reactions -> compounds')
+        mapping, id_to_names = reaction_to_compound(reaction_ids, species_list, use_kegg)
+        return make_relations(mapping, REACTION_PK, COMPOUND_PK, value_key=None), id_to_names
+
+    def map_proteins_to_genes(protein_2_reactions, reaction_2_proteins):
+        logger.info('Mapping proteins -> genes')
+        protein_2_reactions = merge_relation(protein_2_reactions, reverse_relation(reaction_2_proteins))
+        all_protein_ids = list(set(protein_2_reactions.keys) - mapped['protein_genes'])
+        mapping, _ = uniprot_to_ensembl(all_protein_ids, species_list)
+        return make_relations(mapping, PROTEIN_PK, GENE_PK, value_key=None)
+
+    stage_results = run_stages([
+        Stage('gene_2_proteins', map_genes_to_proteins),
+        Stage('compound_2_reactions', map_compounds_to_reactions),
+        Stage('protein_2_reactions', map_proteins_to_reactions, depends_on=['gene_2_proteins']),
+        Stage('reaction_ids', collect_reaction_ids, depends_on=['protein_2_reactions', 'compound_2_reactions']),
+        Stage('reaction_2_pathways', map_reactions_to_pathways, depends_on=['reaction_ids']),
+        Stage('reaction_2_proteins', map_reactions_to_proteins, depends_on=['reaction_ids']),
+        Stage('reaction_2_compounds', map_reactions_to_compounds, depends_on=['reaction_ids']),
+        Stage('protein_2_genes', map_proteins_to_genes, depends_on=['protein_2_reactions', 'reaction_2_proteins']),
+    ])
+    return stage_results
+
+
+def get_reactome_metadata(id_to_names):
     metadata_map = {}
-    for name in reaction_2_pathways_id_to_names:
-        tok = reaction_2_pathways_id_to_names[name]['name']
+    for name in id_to_names:
+        tok = id_to_names[name]['name']
         filtered = clean_label(tok)
-        species = reaction_2_pathways_id_to_names[name]['species']
+        species = id_to_names[name]['species']
         metadata_map[name] = {'display_name': filtered, 'species': species}
-
-    reaction_count_df = None
-    pathway_count_df = None
-
-    pathway_ids = reaction_2_pathways.values
-    reactions_json = pk_to_json('reaction_pk', 'reaction_id', reaction_ids, metadata_map, reaction_count_df,
-                                has_species=True)
-    pathways_json = pk_to_json('pathway_pk', 'pathway_id', pathway_ids, metadata_map, pathway_count_df,
-                               has_species=True)
-    reaction_2_pathways_json = json.dumps(reaction_2_pathways.mapping_list)
-
-    results = {
-        GENOMICS: genes_json,
-        PROTEOMICS: proteins_json,
-        METABOLOMICS: compounds_json,
-        REACTIONS: reactions_json,
-        PATHWAYS: pathways_json,
-        GENES_TO_PROTEINS: gene_2_proteins_json,
-        PROTEINS_TO_REACTIONS: protein_2_reactions_json,
-        COMPOUNDS_TO_REACTIONS: compound_2_reactions_json,
-        REACTIONS_TO_PATHWAYS: reaction_2_pathways_json,
-    }
-    return results
+    return metadata_map
 
 
 def get_mapping(observed_compound_df):
+    """
+    Map each compound identifier in a PiMP peak table to the list of its peaks, labelled identifier_peak id
+    """
+    identifiers = observed_compound_df.loc[:, IDENTIFIER_COL]
+    peak_labels = identifiers.astype(str) + '_' + observed_compound_df.loc[:, PIMP_PEAK_ID_COL].astype(str)
     mapping = defaultdict(list)
-    for idx, row in observed_compound_df.iterrows():
-        identifier = row[IDENTIFIER_COL]
-        peak_id = row[PIMP_PEAK_ID_COL]
-        mapping[identifier].append('%s_%s' % (identifier, peak_id))
+    for identifier, peak_label in zip(identifiers.tolist(), peak_labels.tolist()):
+        mapping[identifier].append(peak_label)
     return dict(mapping)
 
 
 def save_analysis(analysis_name, analysis_desc,
                   genes_str, proteins_str, compounds_str, compound_database_str,
                   results, species_list, current_user, metabolic_pathway_only,
-                  publication, publication_link):
+                  publication, publication_link, cluster=True):
+    """
+    Save a new analysis and its tables
+    :param cluster: whether to also compute the clustergrammer data, otherwise call cluster_analysis later
+    """
     metadata = {
         'genes_str': genes_str,
         'proteins_str': proteins_str,
@@ -227,115 +322,397 @@ def save_analysis(analysis_name, analysis_desc,
     share = Share(user=current_user, analysis=analysis, read_only=False, owner=True)
     share.save()
     logger.info('Saved analysis %d (%s)' % (analysis.pk, species_list))
-    datatype_json = {
-        GENOMICS: (results[GENOMICS], 'genes_json', results['group_gene_df']),
-        PROTEOMICS: (results[PROTEOMICS], 'proteins_json', results['group_protein_df']),
-        METABOLOMICS: (results[METABOLOMICS], 'compounds_json', results['group_compound_df']),
-        REACTIONS: (results[REACTIONS], 'reactions_json', None),
-        PATHWAYS: (results[PATHWAYS], 'pathways_json', None),
-        GENES_TO_PROTEINS: (results[GENES_TO_PROTEINS], 'gene_proteins_json', None),
-        PROTEINS_TO_REACTIONS: (results[PROTEINS_TO_REACTIONS], 'protein_reactions_json', None),
-        COMPOUNDS_TO_REACTIONS: (results[COMPOUNDS_TO_REACTIONS], 'compound_reactions_json', None),
-        REACTIONS_TO_PATHWAYS: (results[REACTIONS_TO_PATHWAYS], 'reaction_pathways_json', None),
+    datatype_results = {
+        GENOMICS: (results[GENOMICS], results['group_gene_df']),
+        PROTEOMICS: (results[PROTEOMICS], results['group_protein_df']),
+        METABOLOMICS: (results[METABOLOMICS], results['group_compound_df']),
+        REACTIONS: (results[REACTIONS], None),
+        PATHWAYS: (results[PATHWAYS], None),
+        GENES_TO_PROTEINS: (results[GENES_TO_PROTEINS], None),
+        PROTEINS_TO_REACTIONS: (results[PROTEINS_TO_REACTIONS], None),
+        COMPOUNDS_TO_REACTIONS: (results[COMPOUNDS_TO_REACTIONS], None),
+        REACTIONS_TO_PATHWAYS: (results[REACTIONS_TO_PATHWAYS], None),
     }
-    data = {}
-    for data_type, data_value in datatype_json.items():
-
-        # data_value is a tuple defined in the datatype_json dictionary above
-        json_str, ui_label, group_info = data_value
-        data[ui_label] = json_str
-
-        json_data = json.loads(json_str)
-        json_design = json.loads(group_info.to_json()) if group_info is not None else None
-
-        # key: comparison_name, value: a list of comparison results (p-values and FCs), if any
-        comparison_data = defaultdict(list)
-
-        # if it's a measurement data
-        if data_type in PKS:
-
-            # check the first row in json_data to see if there are any comparison results (p-values and FCs)
-            comparison_names = []
-            first_row = json_data[0]
-            for col_name, col_value in first_row.items():
-                if col_name.startswith(
-                        PADJ_COL_PREFIX):  # assume if we have the p-value column, there's also the FC column
-                    comparison_name = col_name.replace(PADJ_COL_PREFIX, '', 1)
-                    comparison_names.append(comparison_name)
-
-            # collect all measurement and comparison data
-            pk_col = PKS[data_type]
-            measurement_data = []
-            for row in json_data:
-
-                # separate the measurement data and the comparison data
-                new_measurement_row = {}
-                new_comparison_rows = defaultdict(
-                    dict)  # key: comparison_name, value: a comparison row (a dict of key: value pair)
-                for col_name, col_value in row.items():
-
-                    # insert id columns into both comparison and measurement rows
-                    if col_name == pk_col:
-                        new_measurement_row[col_name] = col_value
-                        for comparison_name in comparison_names:
-                            new_comparison_rows[comparison_name].update({col_name: col_value})
-
-                    # insert p-value column into comparison row
-                    elif col_name.startswith(PADJ_COL_PREFIX):
-                        comparison_name = col_name.replace(PADJ_COL_PREFIX, '', 1)
-                        new_comparison_rows[comparison_name].update({'padj': col_value})
-
-                    # insert FC column into comparison row
-                    elif col_name.startswith(FC_COL_PREFIX):
-                        comparison_name = col_name.replace(FC_COL_PREFIX, '', 1)
-                        new_comparison_rows[comparison_name].update({'log2FoldChange': col_value})
-
-                    # insert everything else into measuremnet rows
-                    else:
-                        new_measurement_row[col_name] = col_value
-
-                measurement_data.append(new_measurement_row)
-                for comparison_name in new_comparison_rows:
-                    new_comparison_row = new_comparison_rows[comparison_name]
-                    comparison_data[comparison_name].append(new_comparison_row)
-
-        else:  # if it's other linking data, just store it directly
-            measurement_data = json_data
-
-        # create a new analysis data and save it
-        analysis_data = AnalysisData(analysis=analysis,
-                                     json_data=measurement_data,
-                                     json_design=json_design,
-                                     data_type=data_type)
-
-        # make clustergrammer if we have data
-        if data_type in [GENOMICS, PROTEOMICS, METABOLOMICS]:
-            cluster_json = get_clusters(analysis_data, data_type)
-            analysis_data.metadata = {
-                'clustergrammer': cluster_json
-            }
-        analysis_data.save()
-        logger.info('Saved analysis data %d for analysis %d' % (analysis_data.pk, analysis.pk))
-
-        # save each comparison separately into an AnalysisHistory
-        for comparison_name in comparison_data:
-            comparisons = comparison_data[comparison_name]
-            result_df = pd.DataFrame(comparisons)
-            pk_col = [col for col in result_df.columns if col in PKS.values()][0]
-            result_df.set_index(pk_col, inplace=True)
-
-            tokens = comparison_name.split('_vs_')
-            case = tokens[0]
-            control = tokens[1]
-            display_name = 'Loaded: %s_vs_%s' % (case, control)
-            inference_data = get_inference_data(data_type, case, control, result_df)
-            save_analysis_history(analysis_data, inference_data, display_name, INFERENCE_LOADED)
+    for data_type, data_value in datatype_results.items():
+        with timed('save_%s' % MAPPING[data_type]) as record:
+            # data_value is a tuple defined in the datatype_results dictionary above
+            table_data, group_info = data_value
+            json_design = json.loads(group_info.to_json()) if group_info is not None else None
+
+            # key: comparison_name, value: a dataframe of comparison results (p-values and FCs), if any
+            comparison_data = {}
+
+            # if it's a measurement data
+            if data_type in PKS:
+                measurement_df, comparison_data = split_comparisons(table_data, PKS[data_type])
+                measurement_data = to_records(measurement_df)
+
+            else:  # if it's other linking data, just store it directly
+                measurement_data = table_data
+
+            # create a new analysis data and save it
+            analysis_data = AnalysisData(analysis=analysis,
+                                         json_data=measurement_data,
+                                         json_design=json_design,
+                                         data_type=data_type)
+
+            # make clustergrammer if we have data
+            if cluster and data_type in [GENOMICS, PROTEOMICS, METABOLOMICS]:
+                cluster_json = get_clusters(analysis_data, data_type)
+                analysis_data.metadata = {
+                    'clustergrammer': cluster_json
+                }
+            analysis_data.save()
+            record['rows'] = len(measurement_data)
+            logger.info('Saved analysis data %d for analysis %d' % (analysis_data.pk, analysis.pk))
+
+            # save each comparison separately into an AnalysisHistory
+            for comparison_name in comparison_data:
+                result_df = comparison_data[comparison_name]
+
+                tokens = comparison_name.split('_vs_')
+                case = tokens[0]
+                control = tokens[1]
+                display_name = 'Loaded: %s_vs_%s' % (case, control)
+                inference_data = get_inference_data(data_type, case, control, result_df)
+                save_analysis_history(analysis_data, inference_data, display_name, INFERENCE_LOADED)
 
         # if settings.DEBUG:
         #     save_json_string(v[0], 'static/data/debugging/' + v[1] + '.json')
     return analysis
 
 
+def extend_analysis_data(analysis, genes_str, proteins_str, compounds_str, stage=timed):
+    """
+    Add new data to an existing analysis. Only the ids that haven't been queried before are mapped to Reactome,
+    and the relations and table rows of the new ids are merged into the stored analysis data.
+    Uploaded rows replace the stored rows with the same ids.
+    :param genes_str: the new gene data in csv format, may be empty
+    :param proteins_str: the new protein data in csv format, may be empty
+    :param compounds_str: the new compound data in csv format, may be empty
+    :param stage: the context manager wrapping each stage, called with the stage name, e.g. job_stage for a job
+    :return: a dictionary of data type to the number of rows added or updated
+    """
+    metadata = analysis.metadata
+    species_list = metadata['species_list']
+    metabolic_pathway_only = metadata['metabolic_pathway_only']
+    compound_database_str = metadata['compound_database_str']
+    use_kegg = compound_database_str == COMPOUND_DATABASE_KEGG
+
+    with stage(JOB_STAGE_PARSE) as record:
+        analysis_data = {data_type: get_last_analysis_data(analysis, data_type) for data_type in MAPPING}
+        tables = {data_type: get_table(analysis_data[data_type]) for data_type in PKS}
+        stored_ids = {data_type: get_items(tables[data_type][pk_col]) for data_type, pk_col in PKS.items()}
+
+        ### combine the stored and the new data of each omics layer ###
+
+        layers = [
+            (GENOMICS, 'genes_str', genes_str),
+            (PROTEOMICS, 'proteins_str', proteins_str),
+            (METABOLOMICS, 'compounds_str', compounds_str)
+        ]
+        observed_dfs = {}
+        group_dfs = {}
+        new_dfs = {}
+        rebuild_all = set()
+        for data_type, metadata_key, csv_str in layers:
+            observed_df, group_df = csv_to_dataframe(metadata[metadata_key])
+            new_df, new_group_df = csv_to_dataframe(csv_str)
+            if new_df is not None:
+                if observed_df is not None and set(observed_df.columns) != set(new_df.columns):
+                    rebuild_all.add(data_type)  # the stored rows need the new columns too
+                observed_df = combine_dataframes(observed_df, new_df, IDENTIFIER_COL)
+                group_df = combine_dataframes(group_df, new_group_df, SAMPLE_COL)
+                metadata[metadata_key] = dataframe_to_csv(observed_df, group_df)
+                new_dfs[data_type] = new_df
+            observed_dfs[data_type] = observed_df
+            group_dfs[data_type] = group_df
+
+        observed_ids = {
+            GENOMICS: get_ids_from_dataframe(observed_dfs[GENOMICS]),
+            PROTEOMICS: get_ids_from_dataframe(observed_dfs[PROTEOMICS]),
+            METABOLOMICS: convert_compound_ids(observed_dfs[METABOLOMICS], compound_database_str)
+        }
+        new_ids = {
+            GENOMICS: get_ids_from_dataframe(new_dfs.get(GENOMICS)),
+            PROTEOMICS: get_ids_from_dataframe(new_dfs.get(PROTEOMICS)),
+            METABOLOMICS: convert_compound_ids(new_dfs.get(METABOLOMICS), compound_database_str)
+        }
+        record['rows'] = sum(len(new_df) for new_df in new_dfs.values())
+
+    ### query Reactome for the ids that haven't been mapped before ###
+
+    with stage(JOB_STAGE_MAP):
+        # observed ids in the stored tables have been mapped to the next entity type, reactions have been mapped to
+        # pathways, proteins and compounds, and all proteins have been mapped to genes
+        queried = {}
+        for data_type, pk_col in PKS.items():
+            table_df = tables[data_type]
+            queried[data_type] = get_items(table_df.loc[table_df['obs'] == True, pk_col])
+        mapped = {
+            'proteins': queried[PROTEOMICS],
+            'reactions': stored_ids[REACTIONS],
+            'protein_genes': stored_ids[PROTEOMICS]
+        }
+        delta_ids = {data_type: [x for x in new_ids[data_type] if x not in queried[data_type]]
+                     for data_type in new_ids}
+        logger.info('Extending analysis %d with %d genes, %d proteins and %d compounds' % (
+            analysis.pk, len(delta_ids[GENOMICS]), len(delta_ids[PROTEOMICS]), len(delta_ids[METABOLOMICS])))
+        stage_results = query_reactome(delta_ids[GENOMICS], delta_ids[PROTEOMICS], delta_ids[METABOLOMICS],
+                                       species_list, metabolic_pathway_only, use_kegg, mapped=mapped)
+        new_reaction_ids = stage_results['reaction_ids']
+        new_reaction_2_pathways, reaction_2_pathways_id_to_names = stage_results['reaction_2_pathways']
+        new_reaction_2_compounds, reaction_to_compound_id_to_names = stage_results['reaction_2_compounds']
+
+    ### merge the new relations into the stored ones ###
+
+    with stage(JOB_STAGE_PERSIST):
+        def load_stored_relation(data_type, source_pk, target_pk):
+            # the links to NA are added again below, as some of the stored orphans may now have links
+            links = get_table(analysis_data[data_type], columns=[source_pk, target_pk])
+            links = links[(links[source_pk] != NA) & (links[target_pk] != NA)]
+            return Relation(source_pk, target_pk, links[source_pk].tolist(), links[target_pk].tolist())
+
+        reaction_ids = list(stored_ids[REACTIONS] | set(new_reaction_ids))
+
+        protein_2_reactions = merge_relation(stage_results['protein_2_reactions'],
+                                             reverse_relation(stage_results['reaction_2_proteins']))
+        protein_2_reactions = merge_relation(load_stored_relation(PROTEINS_TO_REACTIONS, PROTEIN_PK, REACTION_PK),
+                                             protein_2_reactions)
+        all_protein_ids = protein_2_reactions.keys
+
+        new_compound_2_reactions = merge_relation(stage_results['compound_2_reactions'],
+                                                  reverse_relation(new_reaction_2_compounds))
+        compound_2_reactions = merge_relation(
+            load_stored_relation(COMPOUNDS_TO_REACTIONS, COMPOUND_PK, REACTION_PK), new_compound_2_reactions)
+        all_compound_ids = compound_2_reactions.keys
+
+        gene_2_proteins = merge_relation(stage_results['gene_2_proteins'],
+                                         reverse_relation(stage_results['protein_2_genes']))
+        gene_2_proteins = merge_relation(load_stored_relation(GENES_TO_PROTEINS, GENE_PK, PROTEIN_PK),
+                                         gene_2_proteins)
+        all_gene_ids = gene_2_proteins.keys
+
+        reaction_2_pathways = merge_relation(load_stored_relation(REACTIONS_TO_PATHWAYS, REACTION_PK, PATHWAY_PK),
+                                             new_reaction_2_pathways)
+
+        gene_2_proteins = gene_2_proteins.link_orphans(NA, source_ids=all_gene_ids, target_ids=all_protein_ids)
+        protein_2_reactions = protein_2_reactions.link_orphans(NA, source_ids=all_protein_ids,
+                                                               target_ids=reaction_ids)
+        compound_2_reactions = compound_2_reactions.link_orphans(NA, source_ids=all_compound_ids,
+                                                                 target_ids=reaction_ids)
+        reaction_2_pathways = reaction_2_pathways.link_orphans(NA, source_ids=reaction_ids)
+
+        try:
+            mapping = get_mapping(observed_dfs[METABOLOMICS])
+        except KeyError:
+            mapping = None
+        except AttributeError:
+            mapping = None
+        if mapping:
+            compound_2_reactions = expand_relation(compound_2_reactions, mapping, 'compound_pk')
+
+        ### build the rows of the new ids, and of the ids that have new data ###
+
+        def get_rebuild_ids(data_type, table_ids):
+            table_ids = get_items(table_ids)
+            rebuild_ids = table_ids - stored_ids[data_type]
+            if data_type in rebuild_all:
+                rebuild_ids.update(table_ids & set(observed_ids[data_type]))
+            else:
+                rebuild_ids.update(table_ids & set(new_ids[data_type]))
+            return list(rebuild_ids)
+
+        gene_ids = get_rebuild_ids(GENOMICS, all_gene_ids)
+        GTF_DICT = lookup(GENE_NAMES, gene_ids)
+        metadata_map = get_gene_names(gene_ids, GTF_DICT)
+        genes_df = pk_to_dataframe(GENE_PK, 'gene_id', gene_ids, metadata_map, observed_dfs[GENOMICS],
+                                   observed_ids=observed_ids[GENOMICS])
+
+        protein_ids = get_rebuild_ids(PROTEOMICS, all_protein_ids)
+        proteins_df = pk_to_dataframe('protein_pk', 'protein_id', protein_ids, {}, observed_dfs[PROTEOMICS],
+                                      observed_ids=observed_ids[PROTEOMICS])
+
+        compound_ids = get_rebuild_ids(METABOLOMICS, all_compound_ids)
+        KEGG_ID_2_DISPLAY_NAMES = lookup(COMPOUND_NAMES, compound_ids)
+        metadata_map = get_compound_metadata(compound_ids, KEGG_ID_2_DISPLAY_NAMES, reaction_to_compound_id_to_names)
+        compounds_df = pk_to_dataframe('compound_pk', 'compound_id', compound_ids, metadata_map,
+                                       observed_dfs[METABOLOMICS], observed_ids=observed_ids[METABOLOMICS],
+                                       mapping=mapping)
+
+        pathway_ids = list(get_items(new_reaction_2_pathways.values) - stored_ids[PATHWAYS])
+        metadata_map = get_reactome_metadata(reaction_2_pathways_id_to_names)
+        reactions_df = pk_to_dataframe('reaction_pk', 'reaction_id', new_reaction_ids, metadata_map, None,
+                                       has_species=True)
+        pathways_df = pk_to_dataframe('pathway_pk', 'pathway_id', pathway_ids, metadata_map, None,
+                                      has_species=True)
+        start_prefetch(new_reaction_ids, pathway_ids)
+
+        ### save the merged data ###
+        # the tables, relations and metadata are saved together, so that a failure doesn't leave them out of step
+
+        new_rows = {
+            GENOMICS: (genes_df, gene_ids),
+            PROTEOMICS: (proteins_df, protein_ids),
+            METABOLOMICS: (compounds_df, compound_ids),
+            REACTIONS: (reactions_df, new_reaction_ids),
+            PATHWAYS: (pathways_df, pathway_ids),
+        }
+        counts = {}
+        clustered = []
+        new_files = []
+
+        def save_data(data):
+            previous = data.table_file.name if data.table_file else None
+            data.save()
+            if data.table_file and data.table_file.name != previous:
+                new_files.append((data.table_file.storage, data.table_file.name))
+
+        try:
+            with transaction.atomic():
+                for data_type, (new_df, ids) in new_rows.items():
+                    counts[data_type] = len(ids)
+                    if len(ids) == 0 and data_type not in new_dfs:
+                        continue
+
+                    pk_col = PKS[data_type]
+                    new_df, comparison_data = split_comparisons(new_df, pk_col)
+                    data = analysis_data[data_type]
+                    data.json_data = merge_table(tables[data_type], new_df, pk_col, IDS[data_type], ids)
+                    if data_type in new_dfs:
+                        group_df = group_dfs[data_type]
+                        data.json_design = json.loads(group_df.to_json()) if group_df is not None else None
+                    save_data(data)
+                    logger.info('Updated analysis data %d for analysis %d' % (data.pk, analysis.pk))
+                    if data_type in [GENOMICS, PROTEOMICS, METABOLOMICS]:
+                        clustered.append(data)
+
+                    if data_type in new_dfs:
+                        for comparison_name, result_df in comparison_data.items():
+                            tokens = comparison_name.split('_vs_')
+                            case = tokens[0]
+                            control = tokens[1]
+                            display_name = 'Loaded: %s_vs_%s' % (case, control)
+                            inference_data = get_inference_data(data_type, case, control, result_df)
+                            save_analysis_history(data, inference_data, display_name, INFERENCE_LOADED)
+
+                relations = {
+                    GENES_TO_PROTEINS: gene_2_proteins,
+                    PROTEINS_TO_REACTIONS: protein_2_reactions,
+                    COMPOUNDS_TO_REACTIONS: compound_2_reactions,
+                    REACTIONS_TO_PATHWAYS: reaction_2_pathways,
+                }
+                for data_type, relation in relations.items():
+                    data = analysis_data[data_type]
+                    data.json_data = relation.mapping_list
+                    save_data(data)
+
+                analysis.metadata = metadata
+                analysis.save()
+        except Exception:
+            # the rolled back rows still refer to the previous table files, so the new ones are not needed
+            for storage, name in new_files:
+                delete_table_file(storage, name)
+            raise
+
+    ### cluster the measurements of the updated omics layers ###
+
+    with stage(JOB_STAGE_CLUSTER):
+        for data in clustered:
+            cluster_analysis_data(data)
+    return counts
+
+
+def get_items(pks):
+    """
+    Get the ids of the primary keys in an entity table, without the PiMP peak ids
+    """
+    return set([x.split('_')[0] for x in pks if x != NA])
+
+
+def combine_dataframes(stored_df, new_df, key_col):
+    """
+    Combine the rows of two dataframes, where the rows of new_df replace the rows of stored_df with the same key
+    """
+    if stored_df is None:
+        return new_df
+    if new_df is None:
+        return stored_df
+    stored_df = stored_df[~stored_df[key_col].isin(new_df[key_col])]
+    return pd.concat([stored_df, new_df], ignore_index=True, sort=False)
+
+
+def dataframe_to_csv(data_df, group_df):
+    """
+    Convert a dataframe and its grouping information back to the csv format read by csv_to_dataframe
+    """
+    lines = data_df.to_csv(index=False).splitlines()
+    if group_df is not None:
+        sample_2_group = dict(zip(group_df[SAMPLE_COL], group_df[GROUP_COL]))
+        first_line = lines[0].split(',')
+        second_line = [GROUP_COL] + [sample_2_group[x] if x in sample_2_group else DEFAULT_GROUP_NAME for x in
+                                     first_line[1:]]
+        lines.insert(1, ','.join(second_line))
+    return '\n'.join(lines)
+
+
+def merge_table(table_df, new_df, pk_col, display_col, ids):
+    """
+    Merge new rows into a stored entity table
+    :param table_df: the stored table
+    :param new_df: the new rows, from pk_to_dataframe
+    :param ids: the ids of the new rows, the stored rows of these ids are replaced
+    :return: the merged table as a list of rows, sorted by the primary key and with the dummy NA row last
+    """
+    new_df = new_df[new_df[pk_col] != NA].copy()
+
+    # keep the labels of the stored rows
+    labels = table_df.set_index(pk_col)[display_col]
+    known = new_df[pk_col].isin(labels.index)
+    new_df.loc[known, display_col] = new_df.loc[known, pk_col].map(labels)
+
+    table_items = table_df[pk_col].map(lambda x: x.split('_')[0])
+    table_df = table_df[(table_df[pk_col] != NA) & ~table_items.isin(ids)]
+    merged_df = pd.concat([table_df, new_df], ignore_index=True, sort=False).sort_values(pk_col, kind='stable')
+
+    # add dummy entry
+    row = {col: 0 for col in merged_df.columns}
+    row.update({'obs': NA, pk_col: NA, display_col: NA})
+    if 'species' in merged_df.columns:
+        row['species'] = NA
+    merged_df = pd.concat([merged_df, pd.DataFrame([row], columns=merged_df.columns)], ignore_index=True)
+
+    return to_records(merged_df)
+
+
+def split_comparisons(table_df, pk_col):
+    """
+    Split the comparison results (p-values and FCs) uploaded with the measurements from an entity table
+    :param table_df: the entity table, from pk_to_dataframe
+    :param pk_col: the primary key column of the table
+    :return: a tuple of (the table without the comparison columns, a dictionary of comparison name to
+    a dataframe of its 'padj' and 'log2FoldChange' columns indexed by pk_col)
+    """
+    comparison_cols = [col for col in table_df.columns if
+                       col.startswith(PADJ_COL_PREFIX) or col.startswith(FC_COL_PREFIX)]
+    measurement_df = table_df.drop(columns=comparison_cols)
+
+    # assume if we have the p-value column, there's also the FC column
+    comparison_data = {}
+    for col in comparison_cols:
+        if not col.startswith(PADJ_COL_PREFIX):
+            continue
+        comparison_name = col.replace(PADJ_COL_PREFIX, '', 1)
+        rename = {
+            col: 'padj',
+            FC_COL_PREFIX + comparison_name: 'log2FoldChange'
+        }
+        selected = [pk_col] + [c for c in comparison_cols if c in rename]
+        result_df = table_df[selected].rename(columns=rename).set_index(pk_col)
+        comparison_data[comparison_name] = result_df.infer_objects()
+    return measurement_df, comparison_data
+
+
 def get_clusters(analysis_data, data_type):
     axis = 1
     X_std, data_df, design_df = get_standardized_df(analysis_data, axis, pk_cols=IDS)
@@ -347,6 +724,24 @@ def get_clusters(analysis_data, data_type):
     return json_data
 
 
+def cluster_analysis(analysis):
+    """
+    Compute the clustergrammer data of the measurement tables of an analysis saved with cluster=False
+    """
+    for analysis_data in AnalysisData.objects.filter(analysis=analysis,
+                                                     data_type__in=[GENOMICS, PROTEOMICS, METABOLOMICS]):
+        cluster_analysis_data(analysis_data)
+
+
+def cluster_analysis_data(analysis_data):
+    with timed('cluster_%s' % MAPPING[analysis_data.data_type]) as record:
+        data_metadata = analysis_data.metadata if analysis_data.metadata is not None else {}
+        data_metadata['clustergrammer'] = get_clusters(analysis_data, analysis_data.data_type)
+        analysis_data.metadata = data_metadata
+        analysis_data.save()
+        record['rows'] = get_num_rows(analysis_data)
+
+
 def get_standardized_df(analysis_data, axis, pk_cols=PKS):
     data_type = analysis_data.data_type
     data_df, design_df = get_dataframes(analysis_data, pk_cols)
@@ -498,33 +893,18 @@ def save_json_string(data, outfile):
 
 def csv_to_dataframe(csv_str):
     # extract group, if any
-    filtered_str = ''
     group_str = None
+    lines = []
     for line in csv_str.splitlines():  # go through all lines and remove the line containing the grouping info
         if re.match(GROUP_COL, line, re.I):
             group_str = line
         else:
-            filtered_str += line + '\n'
+            lines.append(line)
 
     # extract id values
-    data = StringIO(filtered_str)
     try:
-        data_df = pd.read_csv(data)
-        if not all([np.issubdtype(d, np.floating) for d in data_df.dtypes[1:] ]):
-            raise ValueError('Non-numeric data detected')
-        data_df.columns = data_df.columns.str.replace('.',
-                                                      '_')  # replace period with underscore to prevent alasql breaking
-        data_df.columns = data_df.columns.str.replace('-',
-                                                      '_')  # replace dash with underscore to prevent alasql breaking
-        data_df.columns = data_df.columns.str.replace('#', '')  # remove funny characters
-        rename = {data_df.columns.values[0]: IDENTIFIER_COL}
-        for i in range(len(data_df.columns.values[1:])):  # sql doesn't like column names starting with a number
-            col_name = data_df.columns.values[i]
-            if col_name[0].isdigit():
-                new_col_name = '_' + col_name  # append an underscore in front of the column name
-                rename[col_name] = new_col_name
-        data_df = data_df.rename(columns=rename)
-        data_df.iloc[:, 0] = data_df.iloc[:, 0].astype(str)  # assume id is in the first column and is a string
+        data_df = pd.read_csv(StringIO('\n'.join(lines)))
+        data_df = clean_dataframe(data_df)
     except pd.errors.EmptyDataError:
         data_df = None
     except ValueError as e:
@@ -534,35 +914,67 @@ def csv_to_dataframe(csv_str):
     # create grouping dataframe
     group_df = None
     if data_df is not None:
-        sample_data = data_df.columns.values
-        if group_str is not None:
-            group_data = group_str.split(',')
-        else:
-            num_samples = len(sample_data)
-            group_data = [DEFAULT_GROUP_NAME for x in
-                          range(num_samples)]  # assigns a default group if nothing specified
-
-        # skip non-measurement columns
-        filtered_sample_data = []
-        filtered_group_data = []
-        for i in range(len(sample_data)):
-            sample_name = sample_data[i]
-            if sample_name == IDENTIFIER_COL or \
-                    sample_name == PIMP_PEAK_ID_COL or \
-                    sample_name.startswith(PADJ_COL_PREFIX) or \
-                    sample_name.startswith(FC_COL_PREFIX):
-                continue
-            filtered_sample_data.append(sample_data[i])
-            filtered_group_data.append(group_data[i])
-
-        # convert to dataframe
-        if len(filtered_group_data) > 0:
-            group_df = pd.DataFrame(list(zip(filtered_sample_data, filtered_group_data)),
-                                    columns=[SAMPLE_COL, GROUP_COL])
-
+        group_data = group_str.split(',') if group_str is not None else None
+        group_df = get_group_dataframe(data_df.columns.values, group_data)
     return data_df, group_df
 
 
+def clean_dataframe(data_df):
+    """
+    Check that the measurements of an uploaded table are numeric, and rename its columns so they can be used in
+    alasql queries, with the ids in the first column renamed to IDENTIFIER_COL
+    :raises ValueError: if there's non-numeric data
+    """
+    if not all([np.issubdtype(d, np.floating) for d in data_df.dtypes[1:] ]):
+        raise ValueError('Non-numeric data detected')
+    data_df.columns = data_df.columns.str.replace('.',
+                                                  '_')  # replace period with underscore to prevent alasql breaking
+    data_df.columns = data_df.columns.str.replace('-',
+                                                  '_')  # replace dash with underscore to prevent alasql breaking
+    data_df.columns = data_df.columns.str.replace('#', '')  # remove funny characters
+    rename = {data_df.columns.values[0]: IDENTIFIER_COL}
+    for i in range(len(data_df.columns.values[1:])):  # sql doesn't like column names starting with a number
+        col_name = data_df.columns.values[i]
+        if col_name[0].isdigit():
+            new_col_name = '_' + col_name  # append an underscore in front of the column name
+            rename[col_name] = new_col_name
+    data_df = data_df.rename(columns=rename)
+    data_df.iloc[:, 0] = data_df.iloc[:, 0].astype(str)  # assume id is in the first column and is a string
+    return data_df
+
+
+def get_group_dataframe(sample_data, group_data=None):
+    """
+    Create the grouping dataframe of the measurement columns of a table
+    :param sample_data: the column names of the table
+    :param group_data: the group of each column, including the first id column, or None for the default group
+    :return: a dataframe of samples and groups, or None if there are no measurement columns
+    """
+    if group_data is None:
+        num_samples = len(sample_data)
+        group_data = [DEFAULT_GROUP_NAME for x in range(num_samples)]  # assigns a default group if nothing specified
+
+    # skip non-measurement columns
+    filtered_sample_data = []
+    filtered_group_data = []
+    for i in range(len(sample_data)):
+        sample_name = sample_data[i]
+        if sample_name == IDENTIFIER_COL or \
+                sample_name == PIMP_PEAK_ID_COL or \
+                sample_name.startswith(PADJ_COL_PREFIX) or \
+                sample_name.startswith(FC_COL_PREFIX):
+            continue
+        filtered_sample_data.append(sample_data[i])
+        filtered_group_data.append(group_data[i])
+
+    # convert to dataframe
+    group_df = None
+    if len(filtered_group_data) > 0:
+        group_df = pd.DataFrame(list(zip(filtered_sample_data, filtered_group_data)),
+                                columns=[SAMPLE_COL, GROUP_COL])
+    return group_df
+
+
 def get_ids_from_dataframe(df):
     if df is None:
         return []
@@ -571,61 +983,30 @@ def get_ids_from_dataframe(df):
 
 
 def merge_relation(r1, r2):
-    unique_keys = list(set(r1.keys + r2.keys))
-    unique_values = list(set(r1.values + r2.values))
-    mapping_list = r1.mapping_list + r2.mapping_list
-    mapping_list = list(map(dict, set(map(lambda x: frozenset(x.items()), mapping_list))))  # removes duplicates, if any
-    return Relation(keys=list(unique_keys), values=list(unique_values),
-                    mapping_list=mapping_list)
+    return r1.merge(r2)
 
 
 def reverse_relation(rel):
-    return Relation(keys=rel.values, values=rel.keys, mapping_list=rel.mapping_list)
+    return rel.reverse()
 
 
 def expand_relation(rel, mapping, pk_col):
-    expanded_keys = substitute(rel.keys, mapping)
-    expanded_values = substitute(rel.values, mapping)
-    expanded_mapping_list = []
-    for row in rel.mapping_list:
-        expanded = expand_each(row, mapping, pk_col)
-        if len(expanded) == 0:
-            expanded = [row]
-        expanded_mapping_list.extend(expanded)
-    return Relation(keys=expanded_keys, values=expanded_values, mapping_list=expanded_mapping_list)
-
-
-def substitute(my_list, mapping):
-    new_list = []
-    for x in my_list:
-        if x in mapping:
-            new_list.extend(mapping[x])
-        else:
-            new_list.append(x)
-    return new_list
-
-
-def expand_each(row, mapping, pk_col):
-    results = []
-    pk = row[pk_col]
-    try:
-        replacements = mapping[pk]
-        for rep in replacements:
-            new_row = without_keys(row, [pk_col])
-            new_row[pk_col] = rep
-            results.append(new_row)
-    except KeyError:
-        pass
-    return results
-
-
-# https://stackoverflow.com/questions/31433989/return-copy-of-dictionary-excluding-specified-keys
-def without_keys(d, keys):
-    return {x: d[x] for x in d if x not in keys}
-
-
-def pk_to_json(pk_label, display_label, data, metadata_map, observed_df, has_species=False,
-               observed_ids=None, mapping=None):
+    return rel.expand(mapping, pk_col)
+
+
+def pk_to_dataframe(pk_label, display_label, data, metadata_map, observed_df, has_species=False,
+                    observed_ids=None, mapping=None):
+    """
+    Build the table of an entity type, with one row for each unique id in data (sorted) followed by a dummy NA row.
+    Each row contains the observed status, the primary key, the display label, the observed measurements
+    and optionally the species of the id.
+    :param data: a list of ids, PiMP peak ids are in the form of <id>_<peak_id>
+    :param metadata_map: a dictionary of id to {'display_name': ..., 'species': ...}
+    :param observed_df: the uploaded measurements, or None
+    :param observed_ids: the uploaded ids, or None if nothing was uploaded for this entity type
+    :param mapping: a dictionary of id to its PiMP peak ids, used to expand the ids in data
+    :return: a dataframe of the table rows
+    """
     if observed_df is not None:
         if PIMP_PEAK_ID_COL in observed_df.columns:  # if peak id is present, rename the identifier column to include it
             observed_df[IDENTIFIER_COL] = observed_df[IDENTIFIER_COL] + '_' + observed_df[PIMP_PEAK_ID_COL].astype(str)
@@ -634,91 +1015,63 @@ def pk_to_json(pk_label, display_label, data, metadata_map, observed_df, has_spe
         observed_df = observed_df.set_index(IDENTIFIER_COL)  # set identifier as index
         observed_df = observed_df[~observed_df.index.duplicated(keep='first')]  # remove row with duplicate indices
         observed_df = observed_df.fillna(value=0)  # replace all NaNs with 0s
+        observed_df = observed_df.drop(columns=PIMP_PEAK_ID_COL, errors='ignore')  # remove pimp peakid column
 
-    output = []
-    for item in sorted(data):
+    # rows are fully determined by their ids, so de-duplicating the ids de-duplicates the rows
+    ids = pd.Series(sorted(set(data) - {NA}), dtype=object)
 
-        if item == NA:
-            continue  # handled below after this loop
+    # split PiMP peak ids into the item and the peak
+    tokens = ids.str.split('_')
+    assert (tokens.str.len() <= 2).all()
+    items = tokens.str[0].astype(object)
+    peak_ids = tokens.str[1].astype(object).fillna('')
+    has_peak = (peak_ids != '').values
+    keys = np.where(has_peak, ids.values, items.values)
 
-        if '_' in item:
-            tokens = item.split('_')
-            assert len(tokens) == 2
-            item = tokens[0]
-            peak_id = tokens[1]
-        else:
-            peak_id = None
+    columns = {}
 
-        # add observed status and the primary key label to row data
-        row = {}
-        if observed_ids is not None:
-            if item in observed_ids:
-                row['obs'] = True
-            else:
-                row['obs'] = False
-        else:
-            row['obs'] = None
+    # add observed status and the primary key label
+    if observed_ids is not None:
+        columns['obs'] = items.isin(set(observed_ids)).values.astype(object)
+    else:
+        columns['obs'] = np.full(len(ids), None, dtype=object)
+    columns[pk_label] = keys
 
-        if peak_id:
-            key = '%s_%s' % (item, peak_id)
-            row[pk_label] = key
-        else:
-            row[pk_label] = item
+    # add display label, otherwise use the item id as the label
+    metadata_map = {k: v for k, v in metadata_map.items() if v is not None}
+    display_names = {k: v['display_name'].capitalize() for k, v in metadata_map.items()}
+    labels = items.map(display_names).astype(object)
+    labels = labels.where(~has_peak, labels + ' (' + peak_ids + ')')
+    columns[display_label] = labels.where(labels.notnull(), items).values.astype(object)
 
-        # add display label to row_data
-        species = None
-        if len(metadata_map) > 0 and item in metadata_map and metadata_map[item] is not None:
-            if peak_id:
-                label = '%s (%s)' % (metadata_map[item]['display_name'].capitalize(), peak_id)
-            else:
-                label = metadata_map[item]['display_name'].capitalize()
-            # get the species if it's there too
-            if has_species and 'species' in metadata_map[item]:
-                species = metadata_map[item]['species']
-        else:
-            label = item  # otherwise use the item id as the label
-        row[display_label] = label
-
-        # add the remaining data columns to row
-        if observed_df is not None:
-            try:
-                if peak_id:
-                    observed_values = observed_df.loc[key].to_dict()
-                else:
-                    observed_values = observed_df.loc[item].to_dict()
-            except KeyError:  # missing data
-                observed_values = {}
-                for col in observed_df.columns:
-                    observed_values.update({col: None})
-            observed_values.pop(PIMP_PEAK_ID_COL, None)  # remove pimp peakid column
-            # convert numpy bool to python bool, else json serialisation will break
-            for k, v in observed_values.items():
-                if type(v) == np.bool_:
-                    observed_values[k] = bool(v)
-            row.update(observed_values)
-
-        if has_species:
-            row['species'] = species
-
-        if row not in output:
-            output.append(row)
+    # add the observed measurements of each row, looked up by their primary keys
+    if observed_df is not None:
+        found = pd.Index(keys, dtype=object).isin(observed_df.index)
+        observed_values = observed_df.reindex(keys)
+        for col in observed_values.columns:
+            values = observed_values[col].to_numpy(dtype=object)
+            values[~found] = None  # missing data
+            columns[col] = values
+
+    if has_species:
+        species = {k: v['species'] for k, v in metadata_map.items() if 'species' in v}
+        species = items.map(species).astype(object)
+        columns['species'] = species.where(species.notnull(), None).values.astype(object)
+
+    # object columns keep the missing values as None, other dtypes (e.g. str on pandas 3) turn them into NaN
+    table_df = pd.DataFrame(columns, columns=list(columns.keys()), dtype=object)
 
     # add dummy entry
     row = {'obs': NA, pk_label: NA, display_label: NA}
     if has_species:
         row['species'] = NA
-
     if observed_df is not None:  # also add the remaining columns
         for col in observed_df.columns:
-            if col == PIMP_PEAK_ID_COL:
-                continue
             row.update({col: 0})
+    dummy_df = pd.DataFrame([row], columns=table_df.columns, dtype=object)
 
-    if row not in output:
-        output.append(row)
-
-    output_json = json.dumps(output)
-    return output_json
+    table_df = pd.concat([table_df, dummy_df], ignore_index=True)
+    return table_df
 
 
 def expand_data(data, mapping):
@@ -733,40 +1086,11 @@ def expand_data(data, mapping):
 
 
 def make_relations(mapping, source_pk, target_pk, value_key=None):
-    id_values = []
-    mapping_list = []
-
-    for key in mapping:
-        value_list = mapping[key]
-
-        # value_list can be either a list of strings or dictionaries
-        # check if the first element is a dict, else assume it's a string
-        assert len(value_list) > 0
-        is_string = True
-        first = value_list[0]
-        if isinstance(first, dict):
-            is_string = False
-
-        # process each element in value_list
-        for value in value_list:
-            if is_string:  # value_list is a list of string
-                actual_value = value
-            else:  # value_list is a list of dicts
-                assert value_key is not None, 'value_key is missing'
-                actual_value = value[value_key]
-            id_values.append(actual_value)
-            row = {source_pk: key, target_pk: actual_value}
-            mapping_list.append(row)
-
-    unique_keys = set(mapping.keys())
-    unique_values = set(id_values)
-
-    return Relation(keys=list(unique_keys), values=list(unique_values),
-                    mapping_list=mapping_list)
+    return Relation.from_mapping(mapping, source_pk, target_pk, value_key=value_key)
 
 
 def add_dummy(relation, source_ids, target_ids, source_pk_label, target_pk_label):
-    to_add = [x for x in source_ids if x not in relation.keys]
+    to_add = [x for x in source_ids if x not in relation.key_set]
     relation = add_links(relation, source_pk_label, target_pk_label, to_add, [NA])
 
     # to_add = [x for x in target_ids if x not in relation.values]
@@ -777,17 +1101,8 @@ def add_dummy(relation, source_ids, target_ids, source_pk_label, target_pk_label
 
 
 def add_links(relation, source_pk_label, target_pk_label, source_pk_list, target_pk_list):
-    rel_mapping_list = list(relation.mapping_list)
-    rel_keys = relation.keys
-    rel_values = relation.values
-
-    for s1 in source_pk_list:
-        if s1 not in rel_keys: rel_keys.append(s1)
-        for s2 in target_pk_list:
-            rel_mapping_list.append({source_pk_label: s1, target_pk_label: s2})
-            if s2 not in rel_keys: rel_values.append(s2)
-
-    return Relation(keys=rel_keys, values=rel_values, mapping_list=rel_mapping_list)
+    assert (source_pk_label, target_pk_label) == (relation.source_pk, relation.target_pk)
+    return relation.add_links(source_pk_list, target_pk_list)
 
 
 def change_column_order(df, col_name, index):
@@ -814,7 +1129,7 @@ def get_last_analysis_data(analysis, data_type):
 
 def get_dataframes(analysis_data, pk_cols):
     pk_col = pk_cols[analysis_data.data_type]
-    data_df = pd.DataFrame(analysis_data.json_data).set_index(pk_col)
+    data_df = get_table(analysis_data).set_index(pk_col)
     design_df = None
     if analysis_data.json_design:
         design_df = pd.DataFrame(analysis_data.json_design).set_index(SAMPLE_COL)
@@ -854,13 +1169,15 @@ def get_inference_data(data_type, case, control, result_df, metadata=None):
     if control is not None:
         inference_data.update({'control': control})
     if result_df is not None:
-        inference_data.update({'result_df': result_df.to_json()})
+        inference_data.update({'result_df': result_df})
     if metadata is not None:
         inference_data.update(metadata)
     return inference_data
 
 
 def save_analysis_history(analysis_data, inference_data, new_display_name, inference_type):
+    # dataframes and arrays in inference_data are stored as artifacts
+    inference_data = store_artifacts(analysis_data.analysis, inference_data)
     ts = timezone.localtime()
     analysis_history = AnalysisHistory(analysis=analysis_data.analysis, analysis_data=analysis_data,
                                        display_name=new_display_name, inference_type=inference_type, timestamp=ts,
@@ -2,9 +2,8 @@ import pandas as pd
 
 from goatools.go_enrichment import GOEnrichmentStudy
 
-from django.conf import settings
 from linker.gene_ontologies_utils import to_id
-from linker.common import load_obj
+from linker.reference_data import get_go_data
 
 class GOAnalysis(object):
     def __init__(self, species, namespace, background_names, significant=0.05):
@@ -13,10 +12,7 @@ class GOAnalysis(object):
         self.background_gene_names = background_names
         self.significant = significant
 
-        GO_DATA = load_obj(settings.EXTERNAL_GO_DATA)
-        self.ontologies = GO_DATA['ontologies']
-        self.associations = GO_DATA['species_associations'][self.species][self.namespace]
-        self.names_to_id_dict = GO_DATA['gaf_name_to_id'][self.species]
+        self.ontologies, self.associations, self.names_to_id_dict = get_go_data(self.species, self.namespace)
 
         # convert background gene names to gene ids used in the associations
         self.background_gene_ids = to_id(self.background_gene_names, self.names_to_id_dict)
@@ -18,6 +18,7 @@ from sklearn.decomposition import PCA as skPCA
 from linker.common import access_allowed
 from linker.constants import *
 from linker.forms import BaseInferenceForm
+from linker.inference_store import load_array
 from linker.models import Analysis, AnalysisData, AnalysisHistory
 from linker.views.functions import get_last_analysis_data, get_groups, get_dataframes, get_standardized_df, \
     get_group_members, fig_to_div, get_inference_data, save_analysis_history
@@ -303,8 +304,8 @@ def inference_deseq(request, analysis_id):
             # create a new analysis data
             display_name = 'DESeq2: %s_vs_%s' % (case, control)
             metadata = {
-                'rld_df': rld_df.to_json(),
-                'res_ordered': jsonpickle.encode(res_ordered)
+                'rld_df': rld_df,
+                'res_ordered': pd_df
             }
             inference_data = get_inference_data(data_type, case, control, result_df, metadata=metadata)
             save_analysis_history(analysis_data, inference_data, display_name, INFERENCE_DESEQ)
@@ -374,9 +375,9 @@ def inference_pca(request, analysis_id):
                 # store pca results to the metadata field of this AnalysisData
                 metadata = {
                     'pca_n_components': jsonpickle.dumps(n_components),
-                    'pca_X_std_index': jsonpickle.dumps(X_std.index.values),
-                    'pca_X_proj': jsonpickle.dumps(X_proj),
-                    'pca_var_exp': jsonpickle.dumps(var_exp)
+                    'pca_X_std_index': X_std.index.values,
+                    'pca_X_proj': X_proj,
+                    'pca_var_exp': var_exp
                 }
                 display_name = 'PCA: %s components' % n_components
                 inference_data = get_inference_data(data_type, None, None, None, metadata)
@@ -420,9 +421,9 @@ class PCAResult(TemplateView):
         inference_data = analysis_history.inference_data
 
         n_components = jsonpickle.loads(inference_data['pca_n_components'])
-        X_std_index = jsonpickle.loads(inference_data['pca_X_std_index'])
-        X_proj = jsonpickle.loads(inference_data['pca_X_proj'])
-        var_exp = jsonpickle.loads(inference_data['pca_var_exp'])
+        X_std_index = load_array(inference_data, 'pca_X_std_index')
+        X_proj = load_array(inference_data, 'pca_X_proj')
+        var_exp = load_array(inference_data, 'pca_var_exp')
 
         # make pca plot
         fig = self.get_pca_plot(analysis_data, X_std_index, X_proj)
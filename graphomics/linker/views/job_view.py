@@ -0,0 +1,70 @@
+import json
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import PermissionDenied
+from django.http import JsonResponse
+from django.shortcuts import render, get_object_or_404, redirect
+
+from linker.common import access_allowed
+from linker.jobs import get_job_status, cancel_job
+from linker.models import AnalysisJob, Analysis
+
+
+def get_job(request, job_id):
+    job = get_object_or_404(AnalysisJob, pk=job_id)
+    if job.user != request.user:
+        raise PermissionDenied()
+    return job
+
+
+def analysis_job(request, job_id):
+    job = get_job(request, job_id)
+    job_status = get_job_status(job)
+    context = {
+        'job': job,
+        'job_status': job_status,
+        'job_status_json': json.dumps(job_status)
+    }
+    return render(request, 'linker/analysis_job.html', context)
+
+
+def analysis_job_status(request, job_id):
+    job = get_job(request, job_id)
+    return JsonResponse(get_job_status(job))
+
+
+def cancel_analysis_job(request, job_id):
+    job = get_job(request, job_id)
+    if request.method == 'POST':
+        cancel_job(job)
+    if request.is_ajax():
+        return JsonResponse(get_job_status(job))
+    return redirect('analysis_job', job_id=job.pk)
+
+
+def analysis_timings(request, analysis_id):
+    """
+    The timings of the stages of creating an analysis, see linker.instrumentation
+    """
+    analysis = get_object_or_404(Analysis, pk=analysis_id)
+    if not access_allowed(analysis, request):
+        raise PermissionDenied()
+    return JsonResponse({
+        'id': analysis.pk,
+        'name': analysis.name,
+        'timings': analysis.metadata.get('timings') if analysis.metadata is not None else None
+    })
+
+
+@staff_member_required
+def recent_analysis_timings(request):
+    """
+    The timings of the most recently created analyses, for comparing the cost of each stage across analyses
+    """
+    limit = int(request.GET.get('limit', 50))
+    results = []
+    for analysis in Analysis.objects.order_by('-timestamp')[:limit]:
+        timings = analysis.metadata.get('timings') if analysis.metadata is not None else None
+        if timings is not None:
+            results.append({'id': analysis.pk, 'name': analysis.name, 'timings': timings})
+    return JsonResponse({'analyses': results})
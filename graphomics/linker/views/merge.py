@@ -1,113 +1,109 @@
-import copy
+import collections
 
 import numpy as np
+import pandas as pd
 from loguru import logger
 
 from linker.constants import PKS, PATHWAY_PK, NA
 
 
+class ResultColumns(object):
+    """
+    The result columns of a sequence of analysis histories, to be merged into the rows of their analysis data in a
+    single pass. Each column is a series indexed by primary key. When a later history has a column with the same
+    label, e.g. the same comparison computed again, it replaces the earlier one and moves to the end, like merging
+    the histories one at a time would.
+    """
+
+    def __init__(self):
+        self.columns = collections.OrderedDict()
+
+    def add(self, label, values, missing=None):
+        """
+        :param values: a series of the results indexed by primary key
+        :param missing: the value of the rows that are not in values
+        """
+        self.columns.pop(label, None)
+        self.columns[label] = (values, missing)
+
+    def add_comparison(self, case, control, result_df):
+        label = '%s_vs_%s' % (case, control)
+        padj = result_df['padj'] if 'padj' in result_df.columns else empty_series()
+        fc = result_df['log2FoldChange'] if 'log2FoldChange' in result_df.columns else empty_series()
+        self.add('padj_%s' % label, padj)
+        self.add('FC_%s' % label, fc.replace([np.inf, -np.inf], np.nan))
+
+    def add_pathway_analysis(self, pathway_df):
+        # select the columns containing the results ('ending with comb_p'), and remove 'comb_p' from their names
+        result_cols = list(filter(lambda x: x.endswith('comb_p'), pathway_df.columns))
+        for col in result_cols:
+            comparison = '_'.join(col.split(' ')[0:-1]).strip()
+            self.add(comparison_to_key(comparison), pathway_df[col], missing=NA)
+
+    def add_mofa(self, history_id, view, factor, result_df):
+        d = {0: 'genes', 2: 'proteins', 3: 'compounds'}
+        weight_label = 'weight_%s_factor%s_%s' % (str(d[view]), str(factor), str(history_id))
+        weights = result_df[weight_label] if weight_label in result_df.columns else empty_series()
+        self.add(weight_label, weights)
+
+    def merge(self, json_data, pk_col):
+        """
+        Merge the columns into the rows of a table. The rows are not modified.
+        :param json_data: the rows of the table, a list of dictionaries
+        :param pk_col: the primary key column of the rows
+        :return: new rows with the columns set. Missing results and NaNs are None.
+        """
+        if len(self.columns) == 0:
+            return json_data
+
+        # align all the columns on the primary keys of the rows at once
+        pks = pd.Index([row[pk_col] for row in json_data], dtype=object)
+        labels = list(self.columns.keys())
+        arrays = [align(values, pks, missing) for values, missing in self.columns.values()]
+
+        merged = []
+        for row, values in zip(json_data, zip(*arrays)):
+            new_row = {key: value for key, value in row.items() if key not in self.columns}
+            new_row.update(zip(labels, values))
+            merged.append(new_row)
+        logger.debug('Merged %d result columns into %d rows' % (len(labels), len(merged)))
+        return merged
+
+
+def align(values, pks, missing):
+    """
+    Look up the values of the primary keys pks, the last value wins if a key is duplicated
+    :return: an object array with None for NaNs and missing for the keys that are not found
+    """
+    values = values[~values.index.duplicated(keep='last')]
+    aligned = values.reindex(pks)
+    found = pks.isin(values.index)
+    result = aligned.to_numpy(dtype=object)
+    result[pd.isnull(aligned).values] = None
+    result[~found] = missing
+    return result
+
+
+def empty_series():
+    return pd.Series([], dtype=float)
+
+
 def merge_json_data(json_data, data_type, case, control, result_df):
-    new_json_data = copy.deepcopy(json_data)
-    res = result_df.to_dict()
-    label = '%s_vs_%s' % (case, control)
-    padj_label = 'padj_%s' % label
-    fc_label = 'FC_%s' % label
-
-    #  remove the previous DE result if exists
-    for i in range(len(new_json_data)):
-        item = new_json_data[i]
-        if padj_label in item:
-            del item[padj_label]
-            # logger.debug('Removed old padj value')
-        if fc_label in item:
-            del item[fc_label]
-            # logger.debug('Removed old FC value')
-
-    # set new DE result to json_data
-    for i in range(len(new_json_data)):
-        item = new_json_data[i]
-        key = item[PKS[data_type]]
-        try:
-            padj = res['padj'][key]
-            if np.isnan(padj):
-                padj = None
-        except KeyError:
-            padj = None
-        try:
-            lfc = res['log2FoldChange'][key]
-            if np.isnan(lfc) or np.isinf(lfc):
-                lfc = None
-        except KeyError:
-            lfc = None
-        item[padj_label] = padj
-        item[fc_label] = lfc
-    return new_json_data
+    columns = ResultColumns()
+    columns.add_comparison(case, control, result_df)
+    return columns.merge(json_data, PKS[data_type])
 
 
 def update_pathway_analysis_data(json_data, pathway_df):
-    new_json_data = copy.deepcopy(json_data)
-
-    # select the columns containing the results ('ending with comb_p')
-    result_cols = list(filter(lambda x: x.endswith('comb_p'), pathway_df.columns))
-    pals_df = pathway_df[result_cols]
-
-    # remove 'comb_p' from the column names and turn it to dictionary
-    pals_df = pals_df.rename(columns={
-        col: '_'.join(col.split(' ')[0:-1]).strip() for col in pals_df.columns
-    })
-    pals_dict = pals_df.to_dict()
-
-    #  remove the previous PALS if exists
-    for pathway_dict in new_json_data:
-        for comparison in pals_dict:
-            key = comparison_to_key(comparison)
-            if key in pathway_dict:
-                del pathway_dict[key]
-
-    # get pathway analysis data and modify its json_data to include the PALS results
-    hits = 0
-    for pathway_dict in new_json_data:
-        pathway_pk = pathway_dict[PATHWAY_PK]
-        found = False
-        for comparison in pals_dict:
-            key = comparison_to_key(comparison)
-            try:
-                pals_results = pals_dict[comparison]
-                pathway_dict[key] = pals_results[pathway_pk]
-                found = True
-            except KeyError:  # pathway is not present in dataset, so it isn't included in PALS results
-                pathway_dict[key] = NA
-        if found:
-            hits += 1
-    logger.debug('Updated %d pathways' % hits)
-    return new_json_data
+    columns = ResultColumns()
+    columns.add_pathway_analysis(pathway_df)
+    return columns.merge(json_data, PATHWAY_PK)
+
 
 def merge_json_data_mofa(json_data, data_type, history_id, view, factor, result_df):
-    new_json_data = copy.deepcopy(json_data)
-    res = result_df.to_dict()
-    d = {0: 'genes', 2: 'proteins', 3: 'compounds'}
-    weight_label = 'weight_%s_factor%s_%s' % (str(d[view]), str(factor), str(history_id))
-
-    #  remove the previous DE result if exists
-    for i in range(len(new_json_data)):
-        item = new_json_data[i]
-        if weight_label in item:
-            del item[weight_label]
-
-    # set new DE result to json_data
-    for i in range(len(new_json_data)):
-        item = new_json_data[i]
-        key = item[PKS[data_type]]
-        try:
-            weight = res[weight_label][key]
-            if np.isnan(weight):
-                weight = None
-        except KeyError:
-            weight = None
-
-        item[weight_label] = weight
-
-    return new_json_data
+    columns = ResultColumns()
+    columns.add_mofa(history_id, view, factor, result_df)
+    return columns.merge(json_data, PKS[data_type])
 
 
 def comparison_to_key(comparison):
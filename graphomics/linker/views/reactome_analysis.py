@@ -11,6 +11,7 @@ from sklearn import preprocessing
 from linker.constants import PKS, FC_COL_PREFIX, NA, AddNewDataDict, SELECT_WIDGET_ATTRS, PADJ_COL_PREFIX, \
     REACTOME_PVALUE_COLNAME, REACTOME_FOLD_CHANGE_COLNAME, INFERENCE_T_TEST, INFERENCE_DESEQ, INFERENCE_LIMMA, \
     INFERENCE_LOADED
+from linker.inference_store import load_dataframe
 from linker.models import AnalysisHistory
 from linker.views.functions import get_last_analysis_data, get_dataframes
 
@@ -81,7 +82,7 @@ def get_data(form_data, omics_data, used_dtypes, threshold):
         # get the analysis history selected from the form
         analysis_history_id = int(form_data[fieldname])
         analysis_history = AnalysisHistory.objects.get(pk=analysis_history_id)
-        result_df = pd.read_json(analysis_history.inference_data['result_df'])
+        result_df = load_dataframe(analysis_history.inference_data, 'result_df')
 
         padj_colname = 'padj'
         fc_colname = 'log2FoldChange'
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+
+def encode(ids):
+    """
+    Dictionary-encode a sequence of ids
+    :param ids: a list or array of ids
+    :return: a tuple of (the unique ids, the position of each id in the unique ids)
+    """
+    ids = np.asarray(ids, dtype=object)
+    if len(ids) == 0:
+        return ids, np.zeros(0, dtype=np.int64)
+    codes, uniques = pd.factorize(ids)
+    return np.asarray(uniques, dtype=object), codes.astype(np.int64)
+
+
+class Relation(object):
+    """
+    A de-duplicated set of links from source_pk ids to target_pk ids, e.g. genes -> proteins.
+    Ids are dictionary-encoded: the unique ids of each side are kept in object arrays and
+    each link is a pair of integer codes into them, so that merging, reversing, de-duplicating and
+    expanding relations are array operations.
+    """
+
+    def __init__(self, source_pk, target_pk, sources, targets):
+        """
+        Create a relation from parallel lists of source and target ids, duplicate links are removed
+        :param source_pk: the label of the source ids in mapping_list, e.g. 'gene_pk'
+        :param target_pk: the label of the target ids in mapping_list, e.g. 'protein_pk'
+        :param sources: the source id of each link
+        :param targets: the target id of each link
+        """
+        assert len(sources) == len(targets)
+        self.source_pk = source_pk
+        self.target_pk = target_pk
+        self.key_ids, source_codes = encode(sources)
+        self.value_ids, target_codes = encode(targets)
+
+        # remove duplicate links by combining both codes into a single integer
+        combined = source_codes.astype(np.int64) * max(len(self.value_ids), 1) + target_codes
+        combined = np.unique(combined)
+        self.source_codes = combined // max(len(self.value_ids), 1)
+        self.target_codes = combined % max(len(self.value_ids), 1)
+
+        self._keys = None
+        self._values = None
+        self._key_set = None
+        self._value_set = None
+
+    @classmethod
+    def from_mapping(cls, mapping, source_pk, target_pk, value_key=None):
+        """
+        Create a relation from the results of the mapping functions in linker.reactome
+        :param mapping: a dictionary of source id to a list of target ids, or a list of dicts
+        :param value_key: the key of the target id if the mapping values are dicts
+        """
+        sources = []
+        targets = []
+        for key in mapping:
+            value_list = mapping[key]
+
+            # value_list can be either a list of strings or dictionaries
+            # check if the first element is a dict, else assume it's a string
+            assert len(value_list) > 0
+            if isinstance(value_list[0], dict):
+                assert value_key is not None, 'value_key is missing'
+                value_list = [value[value_key] for value in value_list]
+            sources.extend([key] * len(value_list))
+            targets.extend(value_list)
+        return cls(source_pk, target_pk, sources, targets)
+
+    @property
+    def sources(self):
+        return self.key_ids[self.source_codes]
+
+    @property
+    def targets(self):
+        return self.value_ids[self.target_codes]
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            self._keys = self.key_ids.tolist()
+        return self._keys
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = self.value_ids.tolist()
+        return self._values
+
+    @property
+    def key_set(self):
+        if self._key_set is None:
+            self._key_set = frozenset(self.keys)
+        return self._key_set
+
+    @property
+    def value_set(self):
+        if self._value_set is None:
+            self._value_set = frozenset(self.values)
+        return self._value_set
+
+    @property
+    def mapping_list(self):
+        return [{self.source_pk: s, self.target_pk: t} for s, t in zip(self.sources.tolist(), self.targets.tolist())]
+
+    def __len__(self):
+        return len(self.source_codes)
+
+    def merge(self, other):
+        assert (self.source_pk, self.target_pk) == (other.source_pk, other.target_pk), 'Incompatible relations'
+        return Relation(self.source_pk, self.target_pk,
+                        np.concatenate([self.sources, other.sources]),
+                        np.concatenate([self.targets, other.targets]))
+
+    def reverse(self):
+        return Relation(self.target_pk, self.source_pk, self.targets, self.sources)
+
+    def add_links(self, source_ids, target_ids):
+        """
+        Link every id in source_ids to every id in target_ids
+        """
+        source_ids = np.asarray(source_ids, dtype=object)
+        target_ids = np.asarray(target_ids, dtype=object)
+        return Relation(self.source_pk, self.target_pk,
+                        np.concatenate([self.sources, np.repeat(source_ids, len(target_ids))]),
+                        np.concatenate([self.targets, np.tile(target_ids, len(source_ids))]))
+
+    def link_orphans(self, na, source_ids=None, target_ids=None):
+        """
+        Link na to na, every id in source_ids that has no links to na, and na to every id in target_ids
+        that has no links. Membership is checked against the hashed key and value sets, so this is
+        a single linear pass over the ids.
+        """
+        orphan_sources = [x for x in source_ids if x not in self.key_set] if source_ids is not None else []
+        orphan_targets = [x for x in target_ids if x not in self.value_set] if target_ids is not None else []
+        sources = [na] + orphan_sources + [na] * len(orphan_targets)
+        targets = [na] + [na] * len(orphan_sources) + orphan_targets
+        return Relation(self.source_pk, self.target_pk,
+                        np.concatenate([self.sources, np.asarray(sources, dtype=object)]),
+                        np.concatenate([self.targets, np.asarray(targets, dtype=object)]))
+
+    def expand(self, mapping, pk_col):
+        """
+        Replace the ids on the pk_col side of the relation, where each id in mapping is replaced by
+        all the ids it maps to. Links to ids that are not in mapping, or that map to no ids, are kept as they are.
+        """
+        if pk_col == self.source_pk:
+            return self.reverse().expand(mapping, pk_col).reverse()
+        assert pk_col == self.target_pk, 'Unknown column %s' % pk_col
+
+        # expand the unique ids once, then repeat each link by the number of replacements of its target
+        replacements = [mapping.get(x) or [x] for x in self.values]
+        counts = np.array([len(r) for r in replacements], dtype=np.int64)
+        expanded_ids = np.array([x for r in replacements for x in r], dtype=object)
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+        link_counts = counts[self.target_codes]
+        sources = np.repeat(self.sources, link_counts)
+        # the position of each expanded link within the replacements of its target
+        within = np.arange(link_counts.sum()) - np.repeat(np.cumsum(link_counts) - link_counts, link_counts)
+        targets = expanded_ids[np.repeat(offsets[self.target_codes], link_counts) + within]
+        return Relation(self.source_pk, self.target_pk, sources, targets)
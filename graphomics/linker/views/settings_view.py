@@ -1,11 +1,17 @@
+import functools
+
 from django.contrib import messages
 from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
-from django.shortcuts import render, get_object_or_404
+from django.shortcuts import render, get_object_or_404, redirect
+from loguru import logger
 
 from linker.common import access_allowed
-from linker.forms import ShareAnalysisForm, MakePublicForm
+from linker.constants import GENOMICS, PROTEOMICS, METABOLOMICS, REACTIONS, PATHWAYS, JOB_TYPE_EXTEND
+from linker.forms import ShareAnalysisForm, MakePublicForm, ExtendAnalysisForm
+from linker.jobs import submit_job, run_pending_job, job_stage, use_jobs
 from linker.models import Analysis, Share
+from linker.views.functions import extend_analysis_data
 
 User = get_user_model()
 
@@ -17,11 +23,13 @@ def settings(request, analysis_id):
 
     make_public_form = MakePublicForm(initial={'make_public': analysis.public})
     share_analysis_form = ShareAnalysisForm()
+    extend_analysis_form = ExtendAnalysisForm()
     shares = Share.objects.filter(analysis=analysis)
     context = {
         'analysis_id': analysis.pk,
         'make_public_form': make_public_form,
         'share_analysis_form': share_analysis_form,
+        'extend_analysis_form': extend_analysis_form,
         'shares': shares
     }
     return render(request, 'linker/settings.html', context)
@@ -87,3 +95,49 @@ def make_public(request, analysis_id):
             else:
                 messages.success(request, 'Analysis set to private mode')
     return settings(request, analysis_id)
+
+
+def extend_analysis(request, analysis_id):
+    if request.method == 'POST':
+        analysis = get_object_or_404(Analysis, pk=analysis_id)
+        if not access_allowed(analysis, request) or analysis.get_read_only_status(request.user):
+            raise PermissionDenied()
+
+        form = ExtendAnalysisForm(request.POST, request.FILES)
+        if form.is_valid():
+            genes_str = form.cleaned_data['genes']
+            proteins_str = form.cleaned_data['proteins']
+            compounds_str = form.cleaned_data['compounds']
+            if len(genes_str.strip()) == 0 and len(proteins_str.strip()) == 0 and len(compounds_str.strip()) == 0:
+                messages.warning(request, 'No data to add')
+            else:
+                parameters = {
+                    'analysis_name': analysis.name,
+                    'genes_str': genes_str,
+                    'proteins_str': proteins_str,
+                    'compounds_str': compounds_str
+                }
+                job = submit_job(request.user, parameters, job_type=JOB_TYPE_EXTEND, analysis=analysis)
+                # without background workers, the job is run in this request
+                if not use_jobs():
+                    run_pending_job(job, run_extend_job)
+                return redirect('analysis_job', job_id=job.pk)
+        else:
+            messages.warning(request, 'Extend analysis failed')
+
+    return settings(request, analysis_id)
+
+
+def run_extend_job(job):
+    """
+    Add the data in the parameters of a job to the analysis of the job, see extend_analysis_data()
+    """
+    if job.analysis is None:
+        raise ValueError('The analysis has been deleted')
+
+    parameters = job.parameters
+    counts = extend_analysis_data(job.analysis, parameters['genes_str'], parameters['proteins_str'],
+                                  parameters['compounds_str'], stage=functools.partial(job_stage, job))
+    logger.info('Analysis %d extended: %d genes, %d proteins, %d compounds, %d reactions and %d pathways added or '
+                'updated' % (job.analysis.pk, counts[GENOMICS], counts[PROTEOMICS], counts[METABOLOMICS],
+                             counts[REACTIONS], counts[PATHWAYS]))
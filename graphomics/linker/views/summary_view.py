@@ -6,6 +6,7 @@ from django.shortcuts import render, get_object_or_404
 from linker.common import access_allowed
 from linker.constants import *
 from linker.models import Analysis, AnalysisData, AnalysisAnnotation
+from linker.table_store import get_table, get_num_rows
 from linker.views.functions import get_last_analysis_data
 
 
@@ -65,8 +66,7 @@ def download_list(request, analysis_id, data_type, observed, id_or_pk):
 
 def get_counts(analysis, data_type):
     analysis_data = get_last_analysis_data(analysis, data_type)
-    json_data = analysis_data.json_data
-    df = pd.DataFrame(json_data)
+    df = get_table(analysis_data, columns=['obs'])
     observed = df[df['obs'] == True].shape[0]
     inferred = df[df['obs'] == False].shape[0] - 1  # -1 to account for dummy item
     total = observed + inferred
@@ -75,8 +75,6 @@ def get_counts(analysis, data_type):
 
 def get_names(analysis, data_type, id_or_pk):
     analysis_data = get_last_analysis_data(analysis, data_type)
-    json_data = analysis_data.json_data
-    df = pd.DataFrame(json_data)
     if id_or_pk == 'id':
         id_names = {
             GENOMICS: 'gene_id',
@@ -90,6 +88,7 @@ def get_names(analysis, data_type, id_or_pk):
             METABOLOMICS: 'compound_pk'
         }
     id_name = id_names[data_type]
+    df = get_table(analysis_data, columns=['obs', id_name])
     observed = df[df['obs'] == True][id_name].tolist()
     inferred = df[df['obs'] == False][id_name].tolist()
     return sorted(observed), sorted(inferred)
@@ -97,9 +96,9 @@ def get_names(analysis, data_type, id_or_pk):
 
 def get_reaction_pathway_counts(analysis):
     analysis_data = AnalysisData.objects.filter(analysis=analysis, data_type=REACTIONS).first()
-    reaction_count = pd.DataFrame(analysis_data.json_data).shape[0] - 1
+    reaction_count = get_num_rows(analysis_data) - 1
     analysis_data = AnalysisData.objects.filter(analysis=analysis, data_type=PATHWAYS).first()
-    pathway_count = pd.DataFrame(analysis_data.json_data).shape[0] - 1
+    pathway_count = get_num_rows(analysis_data) - 1
     return reaction_count, pathway_count
 
 
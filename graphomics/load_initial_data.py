@@ -10,18 +10,24 @@ from tqdm import tqdm
 
 sys.path.append('.')
 
-from linker.reactome import get_all_compound_ids
+from linker.reactome import get_all_compound_ids, get_mapping_backend, BACKEND_INDEX, BACKEND_NEO4J
 from linker.metadata import get_compound_metadata_online
 from linker.common import save_obj, download_file, extract_zip_file
 from linker.GTF import lines
 from linker.gene_ontologies_utils import download_ontologies, download_associations
-from linker.constants import EXTERNAL_COMPOUND_NAMES, EXTERNAL_KEGG_TO_CHEBI, EXTERNAL_GENE_NAMES, EXTERNAL_GO_DATA
+from linker.reactome_snapshot import export_snapshot
+from linker.reactome_index import build_closure_index, build_formula_index, build_pathway_index
+from linker.reactome_catalogue import catalogue
+from linker.reference_data import build_reference_data, build_go_data, GENE_NAMES, COMPOUND_NAMES, KEGG_TO_CHEBI
+from linker.constants import EXTERNAL_COMPOUND_NAMES, EXTERNAL_KEGG_TO_CHEBI, EXTERNAL_GENE_NAMES, EXTERNAL_GO_DATA, \
+    DEFAULT_SPECIES
 
 
 def kegg_id_to_display_names():
     compound_ids = get_all_compound_ids()
     metadata = get_compound_metadata_online(compound_ids)
     save_obj(metadata, EXTERNAL_COMPOUND_NAMES)
+    build_reference_data(COMPOUND_NAMES, metadata)
 
 
 def kegg_id_to_chebi_id():
@@ -52,6 +58,7 @@ def kegg_id_to_chebi_id():
         kegg_to_chebi[kegg] = chebi
 
     save_obj(kegg_to_chebi, EXTERNAL_KEGG_TO_CHEBI)
+    build_reference_data(KEGG_TO_CHEBI, kegg_to_chebi)
     os.remove(extracted_file)
 
 
@@ -81,6 +88,7 @@ def parse_gtf():
             continue
 
     save_obj(gene_names, EXTERNAL_GENE_NAMES)
+    build_reference_data(GENE_NAMES, gene_names)
     shutil.rmtree('gtf')
 
 
@@ -96,10 +104,23 @@ def download_go():
     # we need to do this because ontology terms are recursive, with parents/children relationships
     sys.setrecursionlimit(100000)
     save_obj(go_data, EXTERNAL_GO_DATA)
+    build_go_data(go_data)
     delete_by_pattern('*.obo')
     delete_by_pattern('*.gaf')
 
 
+def export_reactome_data():
+    backend = get_mapping_backend()
+    for species in tqdm(DEFAULT_SPECIES):
+        if backend != BACKEND_NEO4J:
+            export_snapshot(species)
+        build_closure_index(species, references=backend == BACKEND_INDEX)
+        build_formula_index(species)
+        build_pathway_index(species)
+    catalogue.refresh()
+    catalogue.get_all_pathways(DEFAULT_SPECIES)
+
+
 def delete_by_pattern(extension):
     for p in Path('.').glob(extension):
         p.unlink()
@@ -108,25 +129,30 @@ def delete_by_pattern(extension):
 if __name__ == '__main__':
     # Create the mapping between KEGG to display names, see notebooks/mapping/get_all_compounds.ipynb
     logger.debug('\n---------------------------------------------------')
-    logger.debug('1/4 Exporting KEGG -> display names')
+    logger.debug('1/5 Exporting KEGG -> display names')
     logger.debug('---------------------------------------------------')
     kegg_id_to_display_names()
 
     # Create a mapping between KEGG ID to ChEBI ID, see notebooks/mapping/kegg_to_chebi.ipynb
     logger.debug('\n---------------------------------------------------')
-    logger.debug('2/4 Exporting KEGG -> ChEBI mapping')
+    logger.debug('2/5 Exporting KEGG -> ChEBI mapping')
     logger.debug('---------------------------------------------------')
     kegg_id_to_chebi_id()
 
     # Create a mapping between Ensemble gene ID to gene names, see notebooks/mapping/parse_gtf.ipynb
     logger.debug('\n---------------------------------------------------')
-    logger.debug('3/4 Exporting gene ID -> gene name')
+    logger.debug('3/5 Exporting gene ID -> gene name')
     logger.debug('---------------------------------------------------')
     parse_gtf()
 
     # Download gene ontology and association files
     logger.debug('\n---------------------------------------------------')
-    logger.debug('4/4 Downloading gene ontology and association files')
+    logger.debug('4/5 Downloading gene ontology and association files')
     logger.debug('---------------------------------------------------')
     download_go()
 
+    # Export the Reactome subgraph and build the local indexes of each default species for offline mapping
+    logger.debug('\n---------------------------------------------------')
+    logger.debug('5/5 Exporting Reactome snapshots and indexes')
+    logger.debug('---------------------------------------------------')
+    export_reactome_data()